@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# benchmarks for cyan's hot paths, using synthetic apps only
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import contextlib
+from tempfile import TemporaryDirectory
+from typing import Callable, Optional
+
+from bench import fixtures
+
+BASELINE = f"{os.path.dirname(__file__)}/baseline.json"
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(
+    description="benchmark cyan against synthetic ipas"
+  )
+
+  parser.add_argument(
+    "--files", metavar="count", type=int, default=200,
+    help="number of asset files in the app (defaults to 200)"
+  )
+  parser.add_argument(
+    "--asset-size", metavar="bytes", type=int, default=64 * 1024,
+    help="size of each asset file (defaults to 64 KiB)"
+  )
+  parser.add_argument(
+    "--frameworks", metavar="count", type=int, default=4,
+    help="number of bundled frameworks (defaults to 4)"
+  )
+  parser.add_argument(
+    "--appexes", metavar="count", type=int, default=2,
+    help="number of app extensions (defaults to 2)"
+  )
+  parser.add_argument(
+    "--fat", action="store_true",
+    help="make every binary fat (arm64 + arm64e)"
+  )
+  parser.add_argument(
+    "-r", "--repeat", metavar="count", type=int, default=5,
+    help="how many times to run each benchmark (defaults to 5)"
+  )
+  parser.add_argument(
+    "-k", metavar="name", nargs="+",
+    help="only run the given benchmarks"
+  )
+
+  parser.add_argument(
+    "--baseline", metavar="file", default=BASELINE,
+    help="the baseline file to compare against/save to"
+  )
+  parser.add_argument(
+    "--save", action="store_true",
+    help="save the results as the new baseline"
+  )
+  parser.add_argument(
+    "--threshold", metavar="ratio", type=float, default=1.25,
+    help="slowdown ratio counted as a regression (defaults to 1.25)"
+  )
+
+  args = parser.parse_args()
+  results = run(args)
+
+  key = scenario_key(args)
+  baselines = load_baselines(args.baseline)
+  regressed = report(results, baselines.get(key), args.threshold)
+
+  if args.save:
+    baselines[key] = baselines.get(key, {}) | results
+    with open(args.baseline, "w") as f:
+      json.dump(baselines, f, indent=2, sort_keys=True)
+      f.write("\n")
+    print(f"[*] saved baseline to {args.baseline}")
+  elif regressed:
+    sys.exit(f"[!] {len(regressed)} benchmark(s) regressed")
+
+
+def scenario_key(args: argparse.Namespace) -> str:
+  # timings are only comparable on the same machine and fixture
+  return (
+    f"{platform.system()}-{platform.machine()}"
+    f"/files={args.files},asset={args.asset_size}"
+    f",fw={args.frameworks},appex={args.appexes}"
+    f",{'fat' if args.fat else 'thin'}"
+  )
+
+
+def load_baselines(path: str) -> dict[str, dict[str, float]]:
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except FileNotFoundError:
+    return {}
+
+
+def timeit(
+    func: Callable[[str], object],
+    setup: Callable[[str], str],
+    repeat: int
+) -> float:
+  """best of `repeat` runs, each in a fresh directory from `setup`."""
+  times = []
+
+  for _ in range(repeat):
+    with TemporaryDirectory() as tmpdir:
+      arg = setup(tmpdir)
+      with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        start = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - start)
+
+  return min(times)
+
+
+def run(args: argparse.Namespace) -> dict[str, float]:
+  from cyan import tbhutils, tbhtypes
+  from cyan.tbhtypes import app_bundle
+
+  # don't time network round trips
+  app_bundle.send_telegram_message = lambda *_, **__: None  # type: ignore
+
+  fixture = {
+    "files": args.files,
+    "asset_size": args.asset_size,
+    "frameworks": args.frameworks,
+    "appexes": args.appexes,
+    "fat": args.fat
+  }
+
+  work = TemporaryDirectory()
+  src = f"{work.name}/src"
+  ipa = fixtures.make_ipa(src, f"{work.name}/Bench.ipa", **fixture)
+  tweaks = {
+    f"Tweak{i}.dylib": fixtures.make_tweak(
+      f"{work.name}/tweaks/Tweak{i}.dylib", seed=i
+    )
+    for i in range(4)
+  }
+  with open(f"{work.name}/merge.plist", "wb") as f:
+    f.write(fixtures.plistlib.dumps({"UIFileSharingEnabled": True}))
+
+  def fresh_app(tmpdir: str) -> str:
+    dst = f"{tmpdir}/Payload/Bench.app"
+    shutil.copytree(f"{src}/Payload/Bench.app", dst)
+    return dst
+
+  def inject(app: str) -> None:
+    tmpdir = os.path.dirname(os.path.dirname(app))
+    tbhtypes.AppBundle(app).executable.inject(dict(tweaks), tmpdir)
+
+  def plist_ops(app: str) -> None:
+    pl = tbhtypes.Plist(f"{app}/Info.plist", app)
+    pl.change_name("Renamed")
+    pl.change_version("9.9")
+    pl.change_bundle_id("com.cyan.renamed")
+    pl.remove_uisd()
+    pl.merge_plist(f"{work.name}/merge.plist")
+
+  benches: dict[str, tuple[Callable[[str], object], Callable[[str], str]]]
+  benches = {
+    "get_app": (
+      lambda tmpdir: tbhutils.get_app(ipa, tmpdir, True),
+      lambda tmpdir: tmpdir
+    ),
+    "get_executables": (
+      lambda app: tbhtypes.AppBundle(app).get_executables(),
+      fresh_app
+    ),
+    "mass_operate": (
+      lambda app: tbhtypes.AppBundle(app).mass_operate(
+        "fakesigned", "fakesign"
+      ),
+      fresh_app
+    ),
+    "inject": (inject, fresh_app),
+    "plist": (plist_ops, fresh_app),
+    "make_ipa": (
+      lambda app: tbhutils.make_ipa(
+        os.path.dirname(os.path.dirname(app)),
+        f"{os.path.dirname(os.path.dirname(app))}/out.ipa", 6
+      ),
+      fresh_app
+    )
+  }
+
+  results: dict[str, float] = {}
+  try:
+    for name, (func, setup) in benches.items():
+      if args.k is not None and name not in args.k:
+        continue
+      results[name] = timeit(func, setup, args.repeat)
+  finally:
+    work.cleanup()
+
+  return results
+
+
+def report(
+    results: dict[str, float],
+    baseline: Optional[dict[str, float]],
+    threshold: float
+) -> list[str]:
+  regressed: list[str] = []
+  width = max(len(name) for name in results) if results else 0
+
+  for name, took in results.items():
+    line = f"{name.ljust(width)}  {took * 1000:10.2f} ms"
+    if baseline is not None and name in baseline:
+      ratio = took / baseline[name]
+      line += f"  ({ratio:.2f}x baseline)"
+      if ratio > threshold:
+        line += "  <-- regression"
+        regressed.append(name)
+    print(line)
+
+  if baseline is not None and results:
+    ratios = [
+      results[n] / baseline[n] for n in results if n in baseline
+    ]
+    if ratios:
+      print(f"[*] geometric mean: {statistics.geometric_mean(ratios):.2f}x")
+
+  return regressed
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,284 @@
+import os
+import struct
+import random
+import plistlib
+import zipfile
+from typing import Optional
+
+# only what's needed to build binaries the bundled tools will accept
+MH_MAGIC_64 = 0xfeedfacf
+FAT_MAGIC = 0xcafebabe
+MH_EXECUTE = 0x2
+MH_DYLIB = 0x6
+
+LC_SYMTAB = 0x2
+LC_DYSYMTAB = 0xb
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_SEGMENT_64 = 0x19
+LC_ENCRYPTION_INFO_64 = 0x2c
+LC_RPATH = 0x8000001c
+
+N_EXT = 0x01
+N_SECT = 0x0e
+
+PAGE = 0x4000
+ARCHS = {
+  "arm64": (0x0100000c, 0),
+  "arm64e": (0x0100000c, 2),
+  "x86_64": (0x01000007, 3)
+}
+
+
+def _align(n: int, to: int) -> int:
+  return (n + to - 1) // to * to
+
+
+def _segment(
+    name: str, vmaddr: int, vmsize: int, fileoff: int, filesize: int,
+    prot: int, sections: Optional[list[bytes]] = None
+) -> bytes:
+  sections = sections or []
+  return struct.pack(
+    "<II16sQQQQiiII", LC_SEGMENT_64, 72 + 80 * len(sections),
+    name.encode(), vmaddr, vmsize, fileoff, filesize, prot, prot,
+    len(sections), 0
+  ) + b"".join(sections)
+
+
+def _section(
+    name: str, seg: str, addr: int, size: int, offset: int
+) -> bytes:
+  return struct.pack(
+    "<16s16sQQIIIIIIII", name.encode(), seg.encode(),
+    addr, size, offset, 2, 0, 0, 0x80000400, 0, 0, 0
+  )
+
+
+def _dylib(cmd: int, name: str) -> bytes:
+  raw = name.encode() + b"\0"
+  size = _align(24 + len(raw), 8)
+  return struct.pack("<IIIIII", cmd, size, 24, 2, 0x10000, 0x10000) \
+    + raw.ljust(size - 24, b"\0")
+
+
+def _rpath(path: str) -> bytes:
+  raw = path.encode() + b"\0"
+  size = _align(12 + len(raw), 8)
+  return struct.pack("<III", LC_RPATH, size, 12) + raw.ljust(size - 12, b"\0")
+
+
+def macho_slice(
+    arch: str = "arm64",
+    dylib_id: Optional[str] = None,
+    deps: tuple[str, ...] = ("/usr/lib/libSystem.B.dylib",),
+    rpaths: tuple[str, ...] = (),
+    encrypted: bool = False,
+    code_size: int = PAGE,
+    local_syms: int = 16,
+    seed: int = 0
+) -> bytes:
+  """a minimal, but structurally valid, 64-bit mach-o slice."""
+  cputype, cpusubtype = ARCHS[arch]
+  filetype = MH_DYLIB if dylib_id is not None else MH_EXECUTE
+  rng = random.Random(seed)
+
+  # symbols: locals, then one exported, then one undefined
+  names = [f"_local_{i}" for i in range(local_syms)] + ["_exported", "_dep"]
+  strtab = b"\0" + b"".join(n.encode() + b"\0" for n in names)
+  strtab = strtab.ljust(_align(len(strtab), 8), b"\0")
+
+  # the load commands only depend on the layout through offsets,
+  # so build them twice: once to get their size, once for real
+  def commands(text_size: int) -> list[bytes]:
+    base = 0 if filetype == MH_DYLIB else 0x100000000
+    le_off = text_size
+    nsyms = len(names)
+    le_size = _align(nsyms * 16 + len(strtab), 8)
+
+    cmds = []
+    if filetype == MH_EXECUTE:
+      cmds.append(_segment("__PAGEZERO", 0, base, 0, 0, 0))
+    cmds.append(_segment(
+      "__TEXT", base, text_size, 0, text_size, 5,
+      [_section(
+        "__text", "__TEXT", base + text_size - code_size,
+        code_size, text_size - code_size
+      )]
+    ))
+    cmds.append(_segment(
+      "__LINKEDIT", base + text_size, _align(le_size, PAGE),
+      le_off, le_size, 1
+    ))
+    if dylib_id is not None:
+      cmds.append(_dylib(LC_ID_DYLIB, dylib_id))
+    for dep in deps:
+      cmds.append(_dylib(LC_LOAD_DYLIB, dep))
+    for rpath in rpaths:
+      cmds.append(_rpath(rpath))
+    cmds.append(struct.pack(
+      "<IIIIII", LC_SYMTAB, 24, le_off, nsyms,
+      le_off + nsyms * 16, len(strtab)
+    ))
+    cmds.append(struct.pack(
+      "<" + "I" * 20, LC_DYSYMTAB, 80,
+      0, local_syms, local_syms, 1, local_syms + 1, 1,
+      *([0] * 12)
+    ))
+    cmds.append(struct.pack(
+      "<IIIIII", LC_ENCRYPTION_INFO_64, 24,
+      text_size - code_size, code_size, 1 if encrypted else 0, 0
+    ))
+    return cmds
+
+  # leave some slack after the load commands, like ld does,
+  # so tools that add commands have room to work with
+  sizeofcmds = sum(len(c) for c in commands(code_size + PAGE))
+  text_size = _align(32 + sizeofcmds + 0x400 + code_size, PAGE)
+  cmds = commands(text_size)
+
+  header = struct.pack(
+    "<IiiIIIII", MH_MAGIC_64, cputype, cpusubtype, filetype,
+    len(cmds), sum(len(c) for c in cmds), 0x00200085, 0
+  )
+  head = header + b"".join(cmds)
+  code = rng.randbytes(code_size)
+  text = head.ljust(text_size - code_size, b"\0") + code
+
+  symtab = b""
+  strx = 1
+  for ind, name in enumerate(names):
+    if ind < local_syms:
+      ntype, sect, value = N_SECT, 1, text_size - code_size + ind * 4
+    elif name == "_exported":
+      ntype, sect, value = N_SECT | N_EXT, 1, text_size - code_size
+    else:
+      ntype, sect, value = N_EXT, 0, 0
+    symtab += struct.pack("<IBBHQ", strx, ntype, sect, 0, value)
+    strx += len(name) + 1
+
+  return text + symtab + strtab
+
+
+def macho(
+    archs: tuple[str, ...] = ("arm64",), **kwargs  # type: ignore
+) -> bytes:
+  """a thin binary for one arch, or a fat one for several."""
+  if len(archs) == 1:
+    return macho_slice(archs[0], **kwargs)
+
+  slices = [macho_slice(arch, **kwargs) for arch in archs]
+  header = struct.pack(">II", FAT_MAGIC, len(slices))
+  offset = _align(len(header) + 20 * len(slices), PAGE)
+  table = b""
+  body = b""
+  for arch, data in zip(archs, slices):
+    cputype, cpusubtype = ARCHS[arch]
+    table += struct.pack(
+      ">iiIII", cputype, cpusubtype, offset + len(body), len(data), 14
+    )
+    body += data.ljust(_align(len(data), PAGE), b"\0")
+
+  return (header + table).ljust(offset, b"\0") + body
+
+
+def _write(path: str, data: bytes) -> None:
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path, "wb") as f:
+    f.write(data)
+
+
+def _info_plist(name: str, bundle_id: str, package: str = "APPL") -> bytes:
+  return plistlib.dumps({
+    "CFBundleExecutable": name,
+    "CFBundleIdentifier": bundle_id,
+    "CFBundleName": name,
+    "CFBundleDisplayName": name,
+    "CFBundlePackageType": package,
+    "CFBundleVersion": "1",
+    "CFBundleShortVersionString": "1.0",
+    "MinimumOSVersion": "14.0",
+    "UISupportedDevices": ["iPhone12,1"]
+  })
+
+
+def make_app(
+    root: str,
+    files: int = 200,
+    asset_size: int = 64 * 1024,
+    frameworks: int = 4,
+    appexes: int = 2,
+    encrypted_appexes: int = 0,
+    fat: bool = False,
+    code_size: int = PAGE * 4,
+    seed: int = 0
+) -> str:
+  """build `Payload/Bench.app` inside `root`, returns the app path."""
+  rng = random.Random(seed)
+  archs = ("arm64", "arm64e") if fat else ("arm64",)
+  app = f"{root}/Payload/Bench.app"
+
+  _write(f"{app}/Info.plist", _info_plist("Bench", "com.cyan.bench"))
+  _write(f"{app}/Bench", macho(
+    archs, code_size=code_size, seed=seed,
+    deps=(
+      "/System/Library/Frameworks/UIKit.framework/UIKit",
+      "/usr/lib/libSystem.B.dylib",
+      *(f"@rpath/Bench{i}.framework/Bench{i}" for i in range(frameworks))
+    ),
+    rpaths=("@executable_path/Frameworks",)
+  ))
+
+  # half text-like (compressible), half noise (already compressed)
+  for i in range(files):
+    if i % 2 == 0:
+      data = (f"asset {i} " * (asset_size // 8 + 1)).encode()[:asset_size]
+      _write(f"{app}/Assets/text{i}.strings", data)
+    else:
+      _write(f"{app}/Assets/image{i}.png", rng.randbytes(asset_size))
+
+  for i in range(frameworks):
+    fw = f"{app}/Frameworks/Bench{i}.framework"
+    _write(f"{fw}/Info.plist", _info_plist(
+      f"Bench{i}", f"com.cyan.bench.fw{i}", "FMWK"
+    ))
+    _write(f"{fw}/Bench{i}", macho(
+      archs, code_size=code_size, seed=seed + i + 1,
+      dylib_id=f"@rpath/Bench{i}.framework/Bench{i}"
+    ))
+
+  for i in range(appexes):
+    ext = f"{app}/PlugIns/Ext{i}.appex"
+    _write(f"{ext}/Info.plist", _info_plist(
+      f"Ext{i}", f"com.cyan.bench.ext{i}", "XPC!"
+    ))
+    _write(f"{ext}/Ext{i}", macho(
+      archs, code_size=code_size, seed=seed + 100 + i,
+      encrypted=i < encrypted_appexes
+    ))
+
+  return app
+
+
+def make_tweak(path: str, seed: int = 0) -> str:
+  """a tweak dylib depending on substrate, like most real ones do."""
+  _write(path, macho(
+    dylib_id=f"/Library/MobileSubstrate/DynamicLibraries/"
+             f"{os.path.basename(path)}",
+    deps=(
+      "/Library/Frameworks/CydiaSubstrate.framework/CydiaSubstrate",
+      "/usr/lib/libSystem.B.dylib"
+    ),
+    seed=seed
+  ))
+  return path
+
+
+def make_ipa(root: str, output: str, **kwargs) -> str:  # type: ignore
+  """build an app with `make_app()` and zip it up into `output`."""
+  make_app(root, **kwargs)
+  with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zf:
+    for dp, _, fs in os.walk(f"{root}/Payload"):
+      for f in sorted(fs):
+        zf.write(f"{dp}/{f}", os.path.relpath(f"{dp}/{f}", root))
+  return output
@@ -1,8 +1,14 @@
 import os
 import sys
 import json
-import zipfile
 import argparse
+import concurrent.futures
+from typing import Any
+
+from cyan import zipwriter
+from cyan.errors import CyanFileError
+from cyan.tbhtypes.macho import is_macho
+from cyan.tbhutils import CYAN_INDEX, hash_file
 
 
 def main() -> None:
@@ -71,6 +77,11 @@ def main() -> None:
     "-q", "--thin", action="store_true",
     help="thin all binaries to arm64, may largely reduce size"
   )
+  parser.add_argument(
+    "--strip", action="store_true",
+    help="strip debug and local symbols from all binaries (locals are "
+    "kept when injecting tweaks), re-sign afterwards"
+  )
   parser.add_argument(
     "-e", "--remove-extensions", action="store_true",
     help="remove all app extensions"
@@ -80,6 +91,17 @@ def main() -> None:
     help="only remove encrypted app extensions"
   )
 
+  parser.add_argument(
+    "--dedup-frameworks", action="store_true",
+    help="share identical frameworks between app extensions and the app"
+  )
+
+  parser.add_argument(
+    "--format", metavar="version", type=int, choices=(1, 2), default=2,
+    help="the .cyan format to write, 1 is for very old cyan versions "
+    "(defaults to 2)"
+  )
+
   generate_cyan(parser)
 
 
@@ -118,41 +140,143 @@ def generate_cyan(parser: argparse.ArgumentParser) -> None:
 
   real_args = {k: v for k, v in dict(vars(args)).items() if v}
   del real_args["output"]
+  del real_args["format"]
 
   for key in "fkxl":  # these need files
     if key in real_args:
       real_args[key] = True
 
+  # arcname -> source file, sorted later so output is reproducible
+  entries: dict[str, str] = {}
+
+  if args.f is not None:
+    for f in args.f:
+      if os.path.isfile(f):
+        entries[f"inject/{os.path.basename(f)}"] = f
+      else:  # G YHUJMNFTGYHNFTGYHTGYHUT6Y7UJM8RFTYHNR564TY
+        if f.endswith("/"):
+          f = f[:-1]  # yes this is needed to prevent a bug wtf
+        for dp, _, files in os.walk(f):
+          for f2 in files:
+            thing = f"{dp}/{f2}"
+            entries[
+              f"inject/{os.path.relpath(thing, os.path.dirname(f))}"
+            ] = thing  # no, i don't know what this is doing.
+
+  if args.k is not None:
+    entries["icon.idk"] = args.k
+
+  if args.l:
+    entries["merge.plist"] = args.l
+
+  if args.x:
+    entries["new.entitlements"] = args.x
+
   print("[*] generating..")
-  with zipfile.ZipFile(
-      args.output, "w", zipfile.ZIP_DEFLATED, compresslevel=1
-  ) as zf:
-    with zf.open("config.json", "w") as f:
-      f.write(json.dumps(real_args).encode())
-
-    if args.f is not None:
-      for f in args.f:
-        if os.path.isfile(f):
-          zf.write(f, f"inject/{os.path.basename(f)}")
-        else:  # G YHUJMNFTGYHNFTGYHTGYHUT6Y7UJM8RFTYHNR564TY
-          if f.endswith("/"):
-            f = f[:-1]  # yes this is needed to prevent a bug wtf
-          for dp, _, files in os.walk(f):
-            for f2 in files:
-              thing = f"{dp}/{f2}"
-              zf.write(
-                thing,
-                f"inject/{os.path.relpath(thing, os.path.dirname(f))}"
-              )  # no, i don't know what this is doing.
-
-    if args.k is not None:
-      zf.write(args.k, "icon.idk")
-
-    if args.l:
-      zf.write(args.l, "merge.plist")
-
-    if args.x:
-      zf.write(args.x, "new.entitlements")
+  try:
+    write_cyan(args.output, real_args, entries, version=args.format)
+  except CyanFileError as e:
+    sys.exit(f"[!] {e}")
+
+
+def encode(name: str, data: dict[str, Any], level: int) -> zipwriter.Member:
+  return zipwriter.compress(
+    name, [json.dumps(data, sort_keys=True).encode()], level
+  )
+
+
+def write_cyan(
+    output: str, config: dict[str, Any], entries: dict[str, str],
+    level: int = 1, version: int = 2
+) -> None:
+  """
+  writes a byte-for-byte reproducible .cyan: sorted entries,
+  fixed timestamps and modes, plus the hash of every payload.
+
+  v2 starts with an index of where each payload's data is,
+  and stores binaries as-is, so they can be read with mmap.
+  both are still normal zips, so older cyans can read them.
+  """
+  def method(src: str) -> int:
+    # formats that are already compressed (debs, pngs, ..) are stored
+    if os.path.splitext(src)[1].lower() in zipwriter.INCOMPRESSIBLE:
+      return 0
+    return 0 if version >= 2 and is_macho(src) else level
+
+  with concurrent.futures.ThreadPoolExecutor() as executor:
+    names = sorted(entries)
+    hashes = dict(zip(
+      names, executor.map(lambda n: hash_file(entries[n]), names)
+    ))
+
+    # identical files are only compressed once
+    unique = {hashes[n]: entries[n] for n in names}
+    members = dict(zip(unique, executor.map(
+      lambda src: zipwriter.compress_file(
+        "", src, method(src), zipwriter.EPOCH
+      ), unique.values()
+    )))
+
+  if version < 2:
+    write_cyan_v1(output, config, names, hashes, members, level)
+    return
+
+  # offsets are relative to the end of the index,
+  # so that the index doesn't have to know its own size
+  conf = encode("config.json", config, level)
+  offset = zipwriter.header_size(conf.name, conf) + conf.csize
+  files = {}
+  for name in names:
+    m = members[hashes[name]]
+    offset += zipwriter.header_size(name, m)
+    files[name] = {
+      "offset": offset,
+      "size": m.size,
+      "csize": m.csize,
+      "method": m.method,
+      "mode": m.mode,
+      "sha256": m.sha256
+    }
+    offset += m.csize
+
+  index = encode(
+    CYAN_INDEX, {"version": 2, "config": config, "files": files}, 0
+  )
+
+  try:
+    with zipwriter.ZipWriter(output) as zf:
+      base = zf.write(index) + index.csize
+      zf.write(conf)
+      for name in names:
+        start = zf.write(members[hashes[name]], name)
+        if start - base != files[name]["offset"]:
+          raise CyanFileError(
+            f"{name} was written at {start - base}, "
+            f"but the index says {files[name]['offset']}"
+          )
+  except CyanFileError:
+    os.remove(output)  # its index is wrong, it's useless
+    raise
+
+
+def write_cyan_v1(
+    output: str, config: dict[str, Any], names: list[str],
+    hashes: dict[str, str], members: dict[str, zipwriter.Member],
+    level: int
+) -> None:
+  manifest = {
+    "version": 1,
+    "files": {
+      n: {"sha256": hashes[n], "size": members[hashes[n]].size}
+      for n in names
+    }
+  }
+
+  with zipwriter.ZipWriter(output) as zf:
+    zf.write(encode("config.json", config, level))
+    zf.write(encode("manifest.json", manifest, level))
+    for name in names:
+      zf.write(members[hashes[name]], name)
 
 
 if __name__ == "__main__":
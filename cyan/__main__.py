@@ -10,13 +10,22 @@ def main() -> None:
   if sys.platform == "win32":
     sys.exit("[!] windows is not supported")
 
+  # `cyan info` and `cyan cache` don't run jobs, so they're kept apart
+  # from the job options
+  if sys.argv[1:2] == ["info"]:
+    from cyan import info
+    return info.main(sys.argv[2:])
+  if sys.argv[1:2] == ["cache"]:
+    from cyan import cache
+    return cache.main(sys.argv[2:])
+
   parser = argparse.ArgumentParser(
     description="cyan, an azule \"clone\" for modifying iOS apps"
   )
 
   parser.add_argument(
     "--remove-plugins", metavar="PLUGIN", nargs="+",
-    help="remove specific plugins (by name or path)"
+    help="remove specific plugins (by name, bundle id or path)"
   )
 
   parser.add_argument(
@@ -86,6 +95,11 @@ def main() -> None:
     "-q", "--thin", action="store_true",
     help="thin all binaries to arm64, may largely reduce size"
   )
+  parser.add_argument(
+    "--strip", action="store_true",
+    help="strip debug and local symbols from all binaries (locals are "
+    "kept when injecting tweaks), re-sign afterwards"
+  )
   parser.add_argument(
     "-e", "--remove-extensions", action="store_true",
     help="remove all app extensions"
@@ -95,6 +109,43 @@ def main() -> None:
     help="only remove encrypted app extensions"
   )
 
+  parser.add_argument(
+    "--dedup-frameworks", action="store_true",
+    help="share identical frameworks between app extensions and the app"
+  )
+
+  parser.add_argument(
+    "--variant", metavar="name=options", dest="variants", action="append",
+    help="also build a variant with more options (e.g. \"signed=-s\"), "
+    "written to <output>-<name>; extracted and injected only once, "
+    "can be repeated. --no-<flag> (and --keep-watch) turn flags off"
+  )
+
+  # so a variant can turn off what the job itself turns on
+  for flag in (
+      "remove-supported-devices", "enable-documents", "fakesign", "thin",
+      "strip", "dedup-frameworks"
+  ):
+    parser.add_argument(
+      f"--no-{flag}", dest=flag.replace("-", "_"), action="store_false",
+      default=False, help=argparse.SUPPRESS
+    )
+  parser.add_argument(
+    "--keep-watch", dest="no_watch", action="store_false", default=False,
+    help=argparse.SUPPRESS
+  )
+
+  parser.add_argument(
+    "--verify", action="store_true",
+    help="check the output once it's built: crcs, binaries, signatures, "
+    "injected dylibs and bundle ids"
+  )
+
+  parser.add_argument(
+    "--no-cache", dest="cache", action="store_false",
+    help="don't reuse (or cache) the ipa of an identical earlier job"
+  )
+
   parser.add_argument(
     "-c", "--compress", metavar="level", type=int, default=6,
     help="the compression level of the ipa (0-9, defaults to 6)",
@@ -108,12 +159,22 @@ def main() -> None:
     "--overwrite", action="store_true",
     help="overwrite existing files without confirming"
   )
+  parser.add_argument(
+    "--plan", metavar="file", nargs="?", const="-",
+    help="only print what would be done and its cost as json "
+    "(to stdout, or the given file), nothing is extracted"
+  )
 
   parser.add_argument(
     "--version", action="version", version="cyan v1.4.4"
   )
 
-  from cyan import logic
+  from cyan.errors import CyanError
+  try:
+    from cyan import logic
+  except CyanError as e:  # e.g. no tools for this platform
+    sys.exit(f"[!] {e}")
+
   logic.main(parser)
 
 
@@ -0,0 +1,656 @@
+"""
+cyan as a library, for running many jobs in one long-lived process.
+
+    from cyan import api
+    from cyan.errors import CyanError
+
+    try:
+      result = api.process(
+        "in.ipa", "out.ipa", tweaks=["Tweak.dylib"], fakesign=True
+      )
+    except CyanError as e:
+      ...  # e.g. `InvalidAppError`, `ToolError`, see `cyan/errors.py`
+
+    for step in result.steps:
+      print(step.name, step.took, step.output)
+
+nothing here exits the process or asks for input.
+"""
+
+import io
+import os
+import sys
+import time
+import shutil
+import threading
+import contextlib
+import contextvars
+import concurrent.futures
+from argparse import Namespace
+from typing import Any, Callable, Iterator, Optional, TextIO
+
+from cyan import (
+  jobcache, planner, plugins, staging, tbhutils, tbhtypes, verify
+)
+from cyan.errors import EncryptedAppError, UsageError, VerificationError
+from cyan.workspace import Workspace, choose_root, input_size
+
+# every option the cli has, with its default
+DEFAULTS: dict[str, Any] = {
+  "cyan": None,
+  "f": None,
+  "n": None,
+  "v": None,
+  "b": None,
+  "m": None,
+  "k": None,
+  "l": None,
+  "x": None,
+  "remove_plugins": None,
+  "remove_supported_devices": False,
+  "no_watch": False,
+  "enable_documents": False,
+  "fakesign": False,
+  "thin": False,
+  "strip": False,
+  "remove_extensions": False,
+  "remove_encrypted": False,
+  "dedup_frameworks": False,
+  "compress": 6,
+  "ignore_encrypted": False,
+  "overwrite": False,
+  "plan": None,
+  "cache": True,
+  "verify": False,
+  "variants": None
+}
+
+# `process()`'s keyword names for the cli's short options
+ALIASES = {
+  "cyans": "cyan",
+  "tweaks": "f",
+  "name": "n",
+  "version": "v",
+  "bundle_id": "b",
+  "minimum": "m",
+  "icon": "k",
+  "plist": "l",
+  "entitlements": "x"
+}
+
+# what variants may change, everything else is shared by all of them
+VARIANT_OPTIONS = frozenset((
+  "output", "n", "v", "b", "m", "k", "l", "x", "remove_supported_devices",
+  "no_watch", "enable_documents", "dedup_frameworks", "fakesign", "thin",
+  "strip", "compress"
+))
+
+
+class Step:
+  def __init__(self, name: str):
+    self.name = name
+    self.output = ""  # everything the step printed
+    self.started = 0.0  # `time.perf_counter()` when it started
+    self.took = 0.0
+
+  def __repr__(self) -> str:
+    return f"<Step {self.name} {self.took:.2f}s>"
+
+
+class Result:
+  """what `process()` did: the output path and every step that ran."""
+
+  def __init__(self, output: str):
+    self.output = output
+    self.steps: list[Step] = []
+    self.workspace_peak = 0
+    self.cached = False  # the output came from the output cache
+
+    # the other variants' results, by name (see `expand_variants()`)
+    self.variants: dict[str, "Result"] = {}
+
+    # per-class sizes and cpu time of the ipa's entries, see
+    # `compression.Policy.report()`
+    self.compression: dict[str, dict[str, float]] = {}
+
+  @property
+  def log(self) -> str:
+    return "".join(s.output for s in self.steps)
+
+  def timeline(self, width: int = 40) -> str:
+    """every step as a bar on one clock, so overlapping ones show."""
+    if len(self.steps) == 0:
+      return ""
+
+    start = min(s.started for s in self.steps)
+    total = max(s.started + s.took for s in self.steps) - start or 1.0
+    pad = max(len(s.name) for s in self.steps)
+
+    lines = []
+    for s in sorted(self.steps, key=lambda s: s.started):
+      a = int((s.started - start) / total * width)
+      b = max(int((s.started + s.took - start) / total * width), a + 1)
+      lines.append(
+        f"{s.name:<{pad}} |{' ' * a}{'#' * (b - a):<{width - a}}| "
+        f"{s.started - start:.2f}s +{s.took:.2f}s"
+      )
+    return "\n".join(lines)
+
+
+# where the current step's prints go, and whether they're echoed too.
+# pool threads only see it if they're given the caller's context,
+# see `tbhutils.in_context()`
+_capture: "contextvars.ContextVar[Optional[tuple[io.StringIO, bool]]]" = (
+  contextvars.ContextVar("cyan_capture", default=None)
+)
+
+
+class _Output(io.TextIOBase):
+  """
+  stands in for `sys.stdout`, so each job's prints go to its steps.
+
+  prints from pool threads are captured too where the pool runs its
+  work in the caller's context, like `mass_operate()`'s. what tools
+  print themselves goes to the real stdout, it never passes through
+  `sys.stdout`.
+  """
+
+  def __init__(self, real: TextIO):
+    self.real = real
+
+  def write(self, s: str) -> int:
+    if (capture := _capture.get()) is not None:
+      buf, echo = capture
+      buf.write(s)
+      if not echo:
+        return len(s)
+    return self.real.write(s)
+
+  def flush(self) -> None:
+    self.real.flush()
+
+
+_install_lock = threading.Lock()
+
+
+def _output() -> _Output:
+  with _install_lock:
+    if not isinstance(sys.stdout, _Output):
+      sys.stdout = _Output(sys.stdout)
+    return sys.stdout
+
+
+@contextlib.contextmanager
+def _step(result: Result, name: str, echo: bool) -> Iterator[Step]:
+  _output()
+  step = Step(name)
+  buf = io.StringIO()
+  token = _capture.set((buf, echo))
+
+  step.started = time.perf_counter()
+  try:
+    yield step
+  finally:
+    step.took = time.perf_counter() - step.started
+    step.output = buf.getvalue()
+    _capture.reset(token)
+    result.steps.append(step)
+
+
+def make_args(
+    input: str, output: Optional[str] = None, **options: Any
+) -> Namespace:
+  """the `Namespace` the cli would've parsed, see `process()`."""
+  args = Namespace(input=input, output=output, **DEFAULTS)
+  for key, value in options.items():
+    key = ALIASES.get(key, key)
+    if key not in DEFAULTS:
+      raise TypeError(f"unknown option: {key}")
+    setattr(args, key, value)
+
+  return args
+
+
+def prepare(args: Namespace) -> None:
+  """normalize the input and output paths, like the cli does."""
+  args.i = os.path.normpath(args.input)
+
+  if args.output is not None:
+    args.o = os.path.normpath(args.output)
+    if not args.o.endswith((".app", ".ipa", ".tipa")):
+      print("[?] valid file extension not found; will create ipa")
+      args.o += ".ipa"
+  else:
+    args.o = args.i
+
+
+def _variant_options(options: dict[str, Any]) -> dict[str, Any]:
+  """a variant's options, by their names in args."""
+  found = {}
+  for key, value in options.items():
+    key = ALIASES.get(key, key)
+    if key not in VARIANT_OPTIONS:
+      raise UsageError(f"variants can't change {key}, it's shared")
+    found[key] = value
+  return found
+
+
+def expand_variants(args: Namespace) -> list[tuple[str, Namespace]]:
+  """
+  the job itself (named "") and every variant in `args.variants`,
+  each with its own prepared args.
+
+  variants add to the job's options and are written next to its
+  output (`out.ipa` -> `out-{name}.ipa`) unless they have an `output`.
+  """
+  jobs = [("", args)]
+  base, ext = os.path.splitext(args.o)
+  for name, options in (args.variants or {}).items():
+    if not name or "/" in name:
+      raise UsageError(f"invalid variant name: {name!r}")
+
+    job = Namespace(**vars(args))
+    job.variants = None
+    job.output = f"{base}-{name}{ext}"
+    for key, value in _variant_options(options).items():
+      setattr(job, key, value)
+
+    prepare(job)
+    jobs.append((name, job))
+
+  outputs = [os.path.realpath(job.o) for _, job in jobs]
+  if len(set(outputs)) != len(outputs):
+    raise UsageError("every variant needs its own output")
+  return jobs
+
+
+def _changes(
+    app: tbhtypes.AppBundle, output_is_ipa: bool, hooked: bool
+) -> list[tuple[str, str, Callable[[Any], None]]]:
+  """
+  every change made after injection, in the order they're made:
+  (step, option, what to call with the option's value).
+
+  `hooked` is whether tweaks were injected, which may look up
+  local symbols, so stripping keeps those.
+  """
+  return [
+    ("change_name", "n", app.plist.change_name),
+    ("change_version", "v", app.plist.change_version),
+    ("change_bundle_id", "b", app.plist.change_bundle_id),
+    ("change_minimum_version", "m", app.plist.change_minimum_version),
+    ("change_icon", "k", lambda k: app.change_icon(k, output_is_ipa)),
+    ("merge_plist", "l", app.plist.merge_plist),
+    ("merge_entitlements", "x", app.executable.merge_entitlements),
+    ("remove_uisd", "remove_supported_devices",
+      lambda _: app.plist.remove_uisd()),
+    ("remove_watch_apps", "no_watch", lambda _: app.remove_watch_apps()),
+    ("enable_documents", "enable_documents",
+      lambda _: app.plist.enable_documents()),
+    ("dedup_frameworks", "dedup_frameworks",
+      lambda _: app.dedup_frameworks()),
+    # before signing, it invalidates signatures
+    ("strip", "strip", lambda _: app.strip_all(keep_locals=hooked)),
+    ("fakesign", "fakesign", lambda _: app.fakesign_all()),
+    ("thin", "thin", lambda _: app.thin_all())
+  ]
+
+
+def run(
+    args: Namespace, echo: bool = False,
+    workdir: Optional[str] = None, quota: Optional[int] = None
+) -> Result:
+  """
+  run a job from already `prepare()`d args.
+
+  `echo` also prints each step's output as it happens, like the cli.
+  `workdir`/`quota` are passed to the job's `Workspace`.
+
+  with `args.variants`, the app is extracted, injected and given
+  the changes all variants share once, then copied for each
+  variant's own changes (hardlinked if every output is an ipa).
+  their ipas copy each other's entries for files none of them
+  changed, see `expand_variants()`.
+  """
+  jobs = expand_variants(args)
+  for _, job in jobs:
+    # this also modifies some args, like -f,
+    # to ensure there are no duplicates, etc
+    tbhutils.validate_inputs(job)
+
+  results = {name: Result(job.o) for name, job in jobs}
+  shared = Result(args.o)  # steps done once, for every variant
+
+  def step(name: str, result: Result = shared) -> Any:
+    return _step(result, name, echo)
+
+  # .cyan payloads are staged here for as long as the jobs run,
+  # the cache may evict its own copies any time
+  payloads = Workspace(workdir) if args.cyan is not None else None
+  try:
+    return _run(
+      args, jobs, results, shared, step, payloads, workdir, quota
+    )
+  finally:
+    if payloads is not None:
+      payloads.cleanup()
+
+
+def _run(
+    args: Namespace, jobs: list[tuple[str, Namespace]],
+    results: dict[str, Result], shared: Result, step: Callable[..., Any],
+    payloads: Optional[Workspace], workdir: Optional[str],
+    quota: Optional[int]
+) -> Result:
+  input_is_ipa = args.i.endswith((".ipa", ".tipa"))
+  caches: dict[str, tuple[jobcache.OutputCache, str, dict[str, Any]]] = {}
+  pending: list[tuple[str, Namespace]] = []
+  for name, job in jobs:
+    result = results[name]
+
+    # merged first, since the cache key depends on what they set
+    # (`cyan` is shared, so every job has payloads or none does)
+    if job.cyan is not None and payloads is not None:
+      with step("parse_cyans", result):
+        tbhutils.parse_cyans(vars(job), payloads.path)
+
+      # what a variant sets itself still wins over the configs
+      if name:
+        for key, value in _variant_options(args.variants[name]).items():
+          if key != "output":
+            setattr(job, key, value)
+
+    cache = jobcache.OutputCache()
+    if job.cache and job.o.endswith((".ipa", ".tipa")) and cache.enabled:
+      with step("cache_lookup", result):
+        key, recipe = jobcache.key(job)
+        if cache.get(key, job.o):
+          print("[*] reused the ipa built before from the same input/recipe")
+          print(f"[*] generated ipa at {job.o}")
+          result.cached = True
+        else:
+          caches[name] = (cache, key, recipe)
+
+      if result.cached:
+        if job.verify:
+          _verify(job, result, step)
+        continue
+
+    pending.append((name, job))
+
+  if len(pending) != 0:
+    # the shared steps go after each job's own lookup
+    done = {name: len(results[name].steps) for name, _ in pending}
+    _build(pending, results, caches, step, input_is_ipa, workdir, quota)
+    for name, _ in pending:
+      results[name].steps[done[name]:done[name]] = shared.steps
+
+  result = results[""]
+  result.variants = {name: r for name, r in results.items() if name != ""}
+  return result
+
+
+def _build(
+    jobs: list[tuple[str, Namespace]], results: dict[str, Result],
+    caches: dict[str, tuple[jobcache.OutputCache, str, dict[str, Any]]],
+    step: Callable[..., Any], input_is_ipa: bool,
+    workdir: Optional[str], quota: Optional[int]
+) -> None:
+  first = jobs[0][1]
+
+  # what's removed is known from the input alone, so it's never
+  # extracted. if that's all the job does, the ipa is only filtered
+  removals: dict[str, Any] = {}
+  if plugins.removes(first):
+    with step("find_removals"):
+      tree = planner.Tree(first.i, input_is_ipa)
+      removals = plugins.removals(first, tree)
+
+    name, job = jobs[0]
+    if (
+        len(jobs) == 1 and plugins.filters(job, input_is_ipa)
+        and _filter(tree, job, removals, results[name], caches.get(name), step)
+    ):
+      return
+
+  # hardlinking input files is only safe if every output is an ipa
+  all_ipa = all(job.o.endswith((".ipa", ".tipa")) for _, job in jobs)
+
+  root = workdir or choose_root(input_size(first.i, input_is_ipa))
+  with Workspace(root, quota) as ws:
+    tmpdir = ws.path
+
+    with step("extract"):
+      extraction = tbhutils.Extraction(
+        first.i, tmpdir, input_is_ipa, all_ipa,
+        [p for paths, _, _ in removals.values() for p in paths]
+      )
+      app = tbhtypes.AppBundle(extraction.start())
+
+    def background(name: str, func: Callable[[], Any]) -> Any:
+      with step(name):
+        return func()
+
+    # only the Info.plist and main binary may be there yet, whatever
+    # just reads them (or doesn't need the app) runs while the rest
+    # is extracted. leaving this waits for everything in it, so the
+    # workspace is never removed from under it
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+      rest = executor.submit(background, "extract_rest", extraction.finish)
+      tweaks = None
+      try:
+        if first.f is not None:
+          tweaks = executor.submit(
+            background, "prepare_tweaks",
+            lambda: app.executable.prepare_tweaks(first.f, tmpdir)
+          )
+
+        with step("check_encryption"):
+          if app.executable.is_encrypted():
+            if not first.ignore_encrypted:
+              raise EncryptedAppError("main binary is encrypted")
+            print("[?] main binary is encrypted, ignoring")
+      except BaseException:
+        # don't wait for the rest of the ipa just to throw it away
+        extraction.cancel()
+        raise
+
+      # everything after this may touch the whole bundle
+      rest.result()
+      ws.check("extracting")
+
+      # this goes before injection,
+      # since user might inject their own extensions.
+      # usually they weren't extracted, this removes any leftovers
+      for change, (paths, removed, unmatched) in removals.items():
+        with step(change):
+          app.remove(*paths)
+          plugins.report(change, paths, removed, unmatched)
+
+      if tweaks is not None:
+        with step("inject"):
+          app.executable.inject(first.f, tmpdir, all_ipa, tweaks.result())
+          ws.check("injecting")
+
+    # changes are shared until the first one that a variant does
+    # differently, everything after that is done to each copy
+    changes = _changes(app, all_ipa, first.f is not None)
+    split = next((
+      ind for ind, (_, option, _) in enumerate(changes)
+      if len({repr(getattr(job, option)) for _, job in jobs}) != 1
+    ), len(changes))
+
+    for name, option, func in changes[:split]:
+      value = getattr(first, option)
+      if value is not None and value is not False:
+        with step(name):
+          func(value)
+
+    reuse: Optional[dict[tuple, tuple[str, int, Any]]] = None
+    if len(jobs) > 1:
+      reuse = {}
+
+    for ind, (name, job) in enumerate(jobs):
+      result = results[name]
+      output_is_ipa = job.o.endswith((".ipa", ".tipa"))
+
+      # the last one gets the shared copy itself
+      variant_dir, variant = tmpdir, app
+      if ind != len(jobs) - 1:
+        with step("fork", result):
+          variant_dir = f"{tmpdir}/variants/{ind}"
+          stats = staging.stage_tree(
+            app.path, f"{variant_dir}/Payload/{os.path.basename(app.path)}",
+            all_ipa
+          )
+          variant = tbhtypes.AppBundle(
+            f"{variant_dir}/Payload/{os.path.basename(app.path)}"
+          )
+          print(f"[*] copied the app for variant {name or '(base)'}: {stats}")
+          ws.check("copying the app")
+
+      for change, option, func in _changes(
+        variant, output_is_ipa, first.f is not None
+      )[split:]:
+        value = getattr(job, option)
+        if value is not None and value is not False:
+          with step(change, result):
+            func(value)
+
+      with step("package", result):
+        _package(variant, job, variant_dir, result, reuse)
+        result.workspace_peak = ws.peak
+      _finish(job, result, caches.get(name), step)
+
+      if variant_dir != tmpdir:
+        shutil.rmtree(variant_dir, ignore_errors=True)
+
+    ws.cleanup()
+
+
+def _filter(
+    tree: planner.Tree, job: Namespace, removals: dict[str, Any],
+    result: Result,
+    cache: Optional[tuple[jobcache.OutputCache, str, dict[str, Any]]],
+    step: Callable[..., Any]
+) -> bool:
+  """
+  a job that only removes extensions: the ipa is copied without them,
+  its other entries still compressed (`tbhutils.filter_ipa()`).
+
+  returns False if the ipa can't be copied like that, before anything
+  is written, so the job is done the usual way instead.
+  """
+  with step("check_encryption"):
+    main = tree.plist("Info.plist").get("CFBundleExecutable")
+    if main in tree.files and tree.macho(main).encrypted:
+      if not job.ignore_encrypted:
+        raise EncryptedAppError("main binary is encrypted")
+      print("[?] main binary is encrypted, ignoring")
+
+  if "/" in job.o:
+    os.makedirs(os.path.dirname(job.o), exist_ok=True)
+
+  with step("filter_ipa", result):
+    try:
+      count, size = tbhutils.filter_ipa(job.i, job.o, [
+        f"{tree.prefix}{p}/" for paths, _, _ in removals.values()
+        for p in paths
+      ])
+    except ValueError as e:
+      print(f"[?] can't copy the ipa as it is ({e}), extracting it")
+      return False
+
+    for change, (paths, removed, unmatched) in removals.items():
+      plugins.report(change, paths, removed, unmatched)
+    print(
+      f"[*] left out {count} entries ({tbhutils.human_size(size)}), "
+      "the rest was copied without extracting"
+    )
+    print(f"[*] generated ipa at {job.o}")
+
+  _finish(job, result, cache, step)
+  return True
+
+
+def _verify(job: Namespace, result: Result, step: Callable[..., Any]) -> None:
+  with step("verify", result):
+    problems = verify.verify(job.o, job)
+    for problem in problems:
+      print(f"[!] {problem}")
+    if len(problems) != 0:
+      raise VerificationError(
+        f"{job.o} failed verification, {len(problems)} problem(s)"
+      )
+    print(f"[*] verified {job.o}")
+
+
+def _finish(
+    job: Namespace, result: Result,
+    cache: Optional[tuple[jobcache.OutputCache, str, dict[str, Any]]],
+    step: Callable[..., Any]
+) -> None:
+  """verify the output if asked to, then cache it (only if it's sound)."""
+  if job.verify:
+    _verify(job, result, step)
+
+  if cache is not None:
+    try:
+      cache[0].put(cache[1], job.o, cache[2])
+    except OSError as e:
+      print(f"[?] couldn't cache the output: {e}")
+
+
+def _package(
+    app: tbhtypes.AppBundle, job: Namespace, tmpdir: str, result: Result,
+    reuse: Optional[dict[tuple, tuple[str, int, Any]]]
+) -> None:
+  # create subdirectories if necessary
+  if "/" in job.o:
+    os.makedirs(os.path.dirname(job.o), exist_ok=True)
+
+  if not job.o.endswith((".ipa", ".tipa")):
+    if os.path.isdir(job.o):
+      shutil.rmtree(job.o)
+
+    shutil.move(app.path, job.o)
+    print(f"[*] generated app at {job.o}")
+    return
+
+  print(f"[*] generating ipa with compression level {job.compress}..")
+  policy = tbhutils.make_ipa(
+    tmpdir, os.path.realpath(job.o), job.compress, reuse
+  )
+  result.compression = policy.report()
+  if policy.reused != 0:
+    print(
+      f"[*] reused {tbhutils.human_size(policy.reused)} "
+      "already compressed for another variant"
+    )
+  if os.environ.get("CYAN_ZIP_STATS"):
+    print(f"[*] compression:\n{policy.summary()}")
+  print(f"[*] generated ipa at {job.o}")
+
+
+def process(
+    input: str, output: Optional[str] = None, *,
+    overwrite: bool = False, workdir: Optional[str] = None,
+    quota: Optional[int] = None, echo: bool = False, **options: Any
+) -> Result:
+  """
+  modify an app, like the `cyan` command, but raising a `CyanError`
+  instead of exiting. an existing output is only replaced if
+  `overwrite` is set (`OutputExistsError` otherwise).
+
+  `options` are the cli's options by their long names (`fakesign`,
+  `remove_encrypted`, `compress`, ..), or these for the short ones:
+  `cyans`, `tweaks`, `name`, `version`, `bundle_id`, `minimum`,
+  `icon`, `plist` and `entitlements`. lists are lists, not strings.
+
+  `variants` maps names to more options (and maybe an `output`) for
+  other builds of the same app, see `expand_variants()`. their
+  results are in the returned result's `variants`.
+  """
+  args = make_args(input, output, overwrite=overwrite, **options)
+  prepare(args)
+  return run(args, echo, workdir, quota)
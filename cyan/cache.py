@@ -0,0 +1,400 @@
+"""
+every on-disk cache (ipas, input hashes, .cyan payloads, icons), kept
+under `$CYAN_CACHE_DIR` and safe to share between any number of cyan
+processes, even on different machines on one nfs volume.
+
+- an entry (a file or a folder) is made next to where it goes, then
+  published with a link or rename that never replaces anything, so
+  half of one is never seen. losing a race to publish is fine, the
+  winner's entry (and its sidecar) is just as good
+- its `<key>.json` sidecar has its size and sha256, and is written
+  last: an entry without one isn't there yet. reads check the size
+  (or the hash too, where entries are small), `cyan cache prune
+  --verify` rehashes everything
+- recency is the sidecar's mtime, entries themselves are never
+  touched: they're only ever read (outputs are reflinked or copied out
+  of them), so they keep matching their sidecar
+- eviction takes the cache's lock (`fcntl.lockf()`, which nfs honors
+  too), nothing else ever waits for it. entries used in the last
+  minute are left alone, someone is probably still copying them
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import contextlib
+from uuid import uuid4
+from typing import Any, Callable, Iterator, Optional
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None  # type: ignore
+
+from cyan import staging, tbhutils
+from cyan.workspace import parse_size
+
+# every cache and its default size, `$CYAN_<NAME>_CACHE` changes it
+LIMITS = {
+  "outputs": 4 << 30,
+  "inputs": 16 << 20,
+  "cyans": 1 << 30,
+  "icons": 256 << 20
+}
+
+# what's still in use (probably) is never evicted
+GRACE = 60
+
+# leftovers of processes that died while publishing or removing
+STALE_AFTER = 24 * 60 * 60
+
+
+def limit(name: str) -> int:
+  """the size of a cache, `0` disables the ones that can be skipped."""
+  var = f"CYAN_{name.upper().removesuffix('S')}_CACHE"
+  if var in os.environ:
+    return parse_size(os.environ[var])
+  return LIMITS.get(name, 1 << 30)
+
+
+def measure(path: str) -> tuple[int, str]:
+  """(size, sha256) of a file, or of everything in a folder."""
+  if os.path.isdir(path):
+    return tbhutils.get_size(path), tbhutils.hash_tree(path)
+  return os.path.getsize(path), tbhutils.hash_file(path)
+
+
+def _delete(path: str) -> None:
+  if os.path.isdir(path) and not os.path.islink(path):
+    shutil.rmtree(path, ignore_errors=True)
+  else:
+    with contextlib.suppress(FileNotFoundError):
+      os.remove(path)
+
+
+class Cache:
+  def __init__(
+      self, name: str, size: Optional[int] = None, check: bool = False
+  ):
+    self.name = name
+    self.root = tbhutils.get_cache_dir(name)
+    self.size = limit(name) if size is None else size
+
+    # whether reads rehash entries, instead of only checking sizes
+    self.check = check
+
+  @property
+  def enabled(self) -> bool:
+    return self.size > 0
+
+  def path(self, key: str) -> str:
+    return os.path.join(self.root, key)
+
+  def meta(self, key: str) -> Optional[dict[str, Any]]:
+    try:
+      with open(f"{self.path(key)}.json") as f:
+        meta = json.load(f)
+    except (OSError, ValueError):
+      return None
+    return meta if isinstance(meta, dict) else None
+
+  def get(self, key: str) -> Optional[str]:
+    """the entry for `key`, if there's a sound one."""
+    meta = self.meta(key)
+    entry = self.path(key)
+    if meta is None:
+      return None
+
+    try:
+      if self.check:
+        sound = measure(entry) == (meta.get("size"), meta.get("sha256"))
+      else:
+        sound = tbhutils.get_size(entry) == meta.get("size")
+    except OSError:
+      return None  # just removed
+
+    if not sound:
+      print(f"[?] dropped a corrupted {self.name} cache entry")
+      self.remove(key)
+      return None
+
+    with contextlib.suppress(FileNotFoundError):
+      os.utime(f"{entry}.json")
+    return entry
+
+  def publish(
+      self, key: str, fill: Callable[[str], Any],
+      extra: Optional[dict[str, Any]] = None
+  ) -> str:
+    """
+    `fill(path)` makes the entry (a file or a folder) at `path`,
+    which is then published as `key`. returns the entry's path.
+    """
+    entry = self.path(key)
+    tmp = os.path.join(self.root, f".{key}.{uuid4().hex}")
+    try:
+      fill(tmp)
+      size, digest = measure(tmp)
+      with open(f"{tmp}.json", "w") as f:
+        json.dump({
+          "size": size, "sha256": digest, "created": time.time(),
+          **(extra or {})
+        }, f)
+
+      # only the winner of a race publishes, and only its sidecar goes
+      # with it. the same key doesn't mean the same bytes (zip dates)
+      if self._claim(tmp, entry):
+        os.replace(f"{tmp}.json", f"{entry}.json")
+    finally:
+      _delete(tmp)
+      _delete(f"{tmp}.json")
+
+    self.evict()
+    return entry
+
+  @staticmethod
+  def _claim(tmp: str, entry: str) -> bool:
+    """move `tmp` to `entry`, unless something already is there."""
+    if not os.path.isdir(tmp):
+      try:
+        os.link(tmp, entry)  # unlike a rename, never replaces anything
+        return True
+      except FileExistsError:
+        return False
+      except OSError:
+        pass  # no hardlinks on this filesystem
+
+    try:
+      # a folder can't be renamed over one that has anything in it
+      os.rename(tmp, entry)
+    except OSError:
+      if not os.path.exists(entry):  # not just someone else being faster
+        raise
+      return False
+    return True
+
+  def put_file(
+      self, key: str, src: str, extra: Optional[dict[str, Any]] = None
+  ) -> str:
+    """
+    publish a reflink of `src`, or a copy. never a hardlink, whoever
+    has `src` may write to it later.
+    """
+    def copy(tmp: str) -> None:
+      staging.stage_file(src, tmp, staging.StageStats(), links=False)
+
+    return self.publish(key, copy, extra)
+
+  def put_bytes(self, key: str, data: bytes) -> str:
+    def write(tmp: str) -> None:
+      with open(tmp, "wb") as f:
+        f.write(data)
+
+    return self.publish(key, write)
+
+  def remove(self, key: str) -> None:
+    # the sidecar goes first, so nobody picks up a half-removed entry.
+    # the entry is renamed away, anyone already reading it keeps going
+    with contextlib.suppress(FileNotFoundError):
+      os.remove(f"{self.path(key)}.json")
+
+    gone = os.path.join(self.root, f".{key}.{uuid4().hex}.gone")
+    try:
+      os.rename(self.path(key), gone)
+    except FileNotFoundError:
+      return
+    _delete(gone)
+
+  def entries(self) -> list[tuple[float, int, str]]:
+    """(last used, size, key) of every entry, least recent first."""
+    found = []
+    for name in os.listdir(self.root):
+      if name.startswith(".") or not name.endswith(".json"):
+        continue
+
+      key = name[:-5]
+      meta = self.meta(key)
+      try:
+        used = os.path.getmtime(f"{self.path(key)}.json")
+      except FileNotFoundError:
+        continue  # evicted by someone else meanwhile
+      if meta is not None and isinstance(meta.get("size"), int):
+        found.append((used, meta["size"], key))
+    return sorted(found)
+
+  @contextlib.contextmanager
+  def lock(self, wait: bool = True) -> Iterator[bool]:
+    """the cache's lock, without `wait` it's skipped if taken."""
+    if fcntl is None:
+      yield True
+      return
+
+    with open(os.path.join(self.root, ".lock"), "a") as f:
+      try:
+        fcntl.lockf(f, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+      except OSError:
+        yield False  # someone else is already at it
+        return
+      try:
+        yield True
+      finally:
+        fcntl.lockf(f, fcntl.LOCK_UN)
+
+  def junk(self) -> list[str]:
+    """leftovers: unpublished, half-removed and unknown files."""
+    now = time.time()
+    found = []
+    for name in os.listdir(self.root):
+      path = os.path.join(self.root, name)
+      if name == ".lock":
+        continue
+      if name.endswith(".json") and not name.startswith("."):
+        if not os.path.lexists(path[:-5]):
+          found.append(path)  # an entry removed halfway
+        continue
+      if not name.startswith(".") and os.path.exists(f"{path}.json"):
+        continue  # a published entry
+
+      with contextlib.suppress(FileNotFoundError):
+        if now - os.lstat(path).st_mtime > STALE_AFTER:
+          found.append(path)
+    return found
+
+  def evict(
+      self, size: Optional[int] = None, unused_for: Optional[float] = None,
+      wait: bool = False
+  ) -> tuple[int, int]:
+    """
+    remove junk and the least recently used entries, until the cache
+    fits in `size` (its own size by default). `unused_for` seconds
+    also removes whatever wasn't used in that long.
+
+    returns (entries removed, bytes freed).
+    """
+    size = self.size if size is None else size
+    with self.lock(wait) as locked:
+      if not locked:
+        return 0, 0
+
+      for path in self.junk():
+        _delete(path)
+
+      entries = self.entries()
+      total = sum(s for _, s, _ in entries)
+      now = time.time()
+      removed = freed = 0
+      for used, esize, key in entries:
+        stale = unused_for is not None and now - used > unused_for
+        if not stale and (total <= size or now - used < GRACE):
+          continue
+
+        self.remove(key)
+        total -= esize
+        removed += 1
+        freed += esize
+
+    return removed, freed
+
+  def verify(self) -> list[str]:
+    """rehash every entry, corrupted ones are removed and returned."""
+    bad = []
+    for _, _, key in self.entries():
+      meta = self.meta(key)
+      try:
+        found = measure(self.path(key))
+      except OSError:
+        continue
+      if meta is None or found != (meta.get("size"), meta.get("sha256")):
+        self.remove(key)
+        bad.append(key)
+    return bad
+
+  def stats(self) -> dict[str, Any]:
+    entries = self.entries()
+    return {
+      "name": self.name,
+      "path": self.root,
+      "entries": len(entries),
+      "bytes": sum(s for _, s, _ in entries),
+      "limit": self.size,
+      "oldest_use": entries[0][0] if entries else None,
+      "junk": len(self.junk())
+    }
+
+
+def main(argv: list[str]) -> None:
+  parser = argparse.ArgumentParser(
+    prog="cyan cache",
+    description="look at or trim cyan's caches, in $CYAN_CACHE_DIR "
+    "(or ~/.cache/cyan)"
+  )
+  sub = parser.add_subparsers(dest="command", required=True)
+
+  stats = sub.add_parser("stats", help="how big each cache is")
+  stats.add_argument("--json", action="store_true", help="print json")
+
+  prune = sub.add_parser(
+    "prune", help="remove junk, and entries until each cache fits"
+  )
+  prune.add_argument(
+    "names", metavar="cache", nargs="*",
+    help=f"which caches ({', '.join(LIMITS)}), all by default"
+  )
+  prune.add_argument(
+    "--max-size", metavar="size", type=parse_size,
+    help="shrink each cache to this (like 512M) instead of its limit"
+  )
+  prune.add_argument(
+    "--unused-for", metavar="days", type=float,
+    help="also remove what wasn't used in this many days"
+  )
+  prune.add_argument(
+    "--verify", action="store_true",
+    help="rehash every entry, removing corrupted ones"
+  )
+  prune.add_argument(
+    "--all", action="store_true", help="remove everything"
+  )
+  args = parser.parse_args(argv)
+
+  names = getattr(args, "names", None) or list(LIMITS)
+  if unknown := [n for n in names if n not in LIMITS]:
+    parser.error(f"unknown cache: {', '.join(unknown)}")
+  caches = [Cache(name) for name in names]
+
+  h = tbhutils.human_size
+  if args.command == "stats":
+    found = [c.stats() for c in caches]
+    if args.json:
+      print(json.dumps(found, indent=2))
+      return
+
+    for s in found:
+      used = "never" if s["oldest_use"] is None else time.strftime(
+        "%Y-%m-%d %H:%M", time.localtime(s["oldest_use"])
+      )
+      print(
+        f"{s['name']:<8} {s['entries']:>6} entries  "
+        f"{h(s['bytes']):>10} of {h(s['limit']):>10}  "
+        f"least recent use: {used}, junk: {s['junk']}"
+      )
+    return
+
+  for c in caches:
+    if args.verify and (bad := c.verify()):
+      print(f"[*] {c.name}: removed {len(bad)} corrupted entries")
+
+    unused = None if args.unused_for is None else args.unused_for * 86400
+    if args.all:
+      unused = -1.0
+    removed, freed = c.evict(
+      0 if args.all else args.max_size, unused, wait=True
+    )
+    print(f"[*] {c.name}: removed {removed} entries, {h(freed)}")
+
+
+if __name__ == "__main__":
+  main(sys.argv[1:])
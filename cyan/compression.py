@@ -0,0 +1,163 @@
+"""
+how each file of an ipa gets compressed.
+
+every file is put in a class by its extension (or magic), each class
+has its own level, and big files are sampled first so content that
+won't shrink (encrypted binaries, packed assets) is just stored.
+"""
+
+import os
+import time
+import zlib
+import threading
+from typing import Optional
+
+from cyan import tbhutils, zipwriter
+from cyan.errors import UsageError
+from cyan.tbhtypes.macho import is_macho
+
+# compressing these is wasted cpu
+MEDIA = zipwriter.INCOMPRESSIBLE
+
+# shrinks a lot, and deflate is fast on it even at its best level
+TEXT = frozenset((
+  ".plist", ".strings", ".stringsdict", ".json", ".xml", ".txt", ".md",
+  ".js", ".html", ".htm", ".css", ".svg", ".nib", ".storyboard", ".xib",
+  ".entitlements", ".mobileprovision", ".lua", ".csv", ".yaml", ".yml"
+))
+
+CLASSES = ("media", "text", "binary", "other", "incompressible")
+
+# files at least this big are sampled before they're compressed
+SAMPLE_MIN = 1 << 20
+SAMPLES = 8
+SAMPLE_SIZE = 16 << 10
+
+# a sample that doesn't get at least this much smaller isn't compressed
+STORE_RATIO = 0.97
+
+
+def parse_levels(spec: str) -> dict[str, int]:
+  """`text=9,binary=4` into levels, like `$CYAN_ZIP_LEVELS` holds."""
+  levels: dict[str, int] = {}
+  for part in filter(None, (p.strip() for p in spec.split(","))):
+    name, _, level = part.partition("=")
+    if name not in CLASSES or not level.isdigit() or int(level) > 9:
+      raise UsageError(f"invalid compression level: {part}")
+    levels[name] = int(level)
+  return levels
+
+
+def by_extension(name: str) -> Optional[str]:
+  """"media" or "text", if the extension is enough to tell."""
+  ext = os.path.splitext(name)[1].lower()
+  if ext in MEDIA:
+    return "media"
+  if ext in TEXT:
+    return "text"
+  return None
+
+
+def sample(path: str, size: int) -> bytes:
+  """
+  evenly spread pieces of a file, from the middle of each part so
+  a compressible header doesn't count for more than it should.
+  """
+  parts = []
+  with open(path, "rb") as f:
+    for ind in range(SAMPLES):
+      f.seek(max((2 * ind + 1) * size // (2 * SAMPLES) - SAMPLE_SIZE // 2, 0))
+      parts.append(f.read(SAMPLE_SIZE))
+  return b"".join(parts)
+
+
+class Stats:
+  def __init__(self) -> None:
+    self.files = 0
+    self.size = 0
+    self.csize = 0
+    self.cpu = 0.0  # seconds, sampling included
+
+  @property
+  def saved(self) -> int:
+    return self.size - self.csize
+
+  def to_dict(self) -> dict[str, float]:
+    return {
+      "files": self.files, "size": self.size, "csize": self.csize,
+      "saved": self.saved, "cpu": round(self.cpu, 3)
+    }
+
+
+class Policy:
+  """
+  picks a level for every file, and keeps track of what it cost.
+
+  `level` is the cli's `-c`: binaries and other files get it, text
+  gets 9, media and incompressible files are stored. 0 stores all.
+  """
+
+  def __init__(
+      self, level: int, levels: Optional[dict[str, int]] = None
+  ):
+    self.levels = {
+      "media": 0,
+      "text": 9 if level != 0 else 0,
+      "binary": level,
+      "other": level,
+      "incompressible": 0
+    }
+
+    if levels is None and "CYAN_ZIP_LEVELS" in os.environ:
+      levels = parse_levels(os.environ["CYAN_ZIP_LEVELS"])
+    self.levels.update(levels or {})
+
+    self.stats = {name: Stats() for name in CLASSES}
+    self.reused = 0  # bytes copied from another zip, see `make_ipa()`
+    self._lock = threading.Lock()
+
+  def classify(self, path: str, size: int) -> str:
+    if (kind := by_extension(path)) is not None:
+      return kind
+
+    kind = "binary" if is_macho(path) else "other"
+    if size >= SAMPLE_MIN and self.levels[kind] != 0:
+      data = sample(path, size)
+      if len(zlib.compress(data, 1)) > len(data) * STORE_RATIO:
+        return "incompressible"
+
+    return kind
+
+  def compress(self, name: str, path: str) -> zipwriter.Member:
+    """a member for the file at `path`, compressed by its class."""
+    start = time.thread_time()
+    kind = self.classify(path, os.path.getsize(path))
+    m = zipwriter.compress_file(name, path, self.levels[kind])
+    took = time.thread_time() - start
+
+    with self._lock:
+      s = self.stats[kind]
+      s.files += 1
+      s.size += m.size
+      s.csize += m.csize
+      s.cpu += took
+
+    return m
+
+  def add_reused(self, size: int) -> None:
+    with self._lock:
+      self.reused += size
+
+  def report(self) -> dict[str, dict[str, float]]:
+    return {
+      name: s.to_dict() for name, s in self.stats.items() if s.files != 0
+    }
+
+  def summary(self) -> str:
+    h = tbhutils.human_size
+    return "\n".join(
+      f"{name}: {s.files} file(s) at level {self.levels[name]}, "
+      f"{h(s.size)} -> {h(s.csize)} (saved {h(s.saved)}), "
+      f"{s.cpu:.2f}s cpu"
+      for name, s in self.stats.items() if s.files != 0
+    )
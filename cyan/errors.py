@@ -0,0 +1,45 @@
+class CyanError(Exception):
+  """
+  anything that stops a job. the message is meant for users,
+  the cli prints it as `[!] <message>` and exits.
+  """
+
+
+class UsageError(CyanError):
+  """the arguments themselves make no sense."""
+
+
+class InputError(CyanError):
+  """a given file is missing or can't be used."""
+
+
+class OutputExistsError(InputError):
+  """the output exists, and overwriting it wasn't allowed."""
+
+
+class InvalidAppError(CyanError):
+  """the input isn't a valid app, or is missing something it needs."""
+
+
+class EncryptedAppError(CyanError):
+  """the main binary is encrypted, see `ignore_encrypted`."""
+
+
+class CyanFileError(CyanError):
+  """a .cyan file is damaged."""
+
+
+class ToolError(CyanError):
+  """an external tool (or lief) failed, or isn't available."""
+
+
+class VerificationError(CyanError):
+  """the output was built, but `--verify` found something wrong with it."""
+
+
+class QuotaExceededError(CyanError):
+  """the job's workspace grew past its quota."""
+
+
+class UnsupportedPlatformError(CyanError):
+  """there are no tools for this os/architecture."""
@@ -0,0 +1,113 @@
+import os
+import hashlib
+import concurrent.futures
+from typing import Any
+
+from cyan import cache, staging, tbhutils
+
+# (points, scale, idiom suffix), the full set xcode asks for
+ICONS = (
+  ("20x20", 2, ""), ("20x20", 3, ""),
+  ("29x29", 2, ""), ("29x29", 3, ""),
+  ("40x40", 2, ""), ("40x40", 3, ""),
+  ("60x60", 2, ""), ("60x60", 3, ""),
+  ("20x20", 1, "~ipad"), ("20x20", 2, "~ipad"),
+  ("29x29", 1, "~ipad"), ("29x29", 2, "~ipad"),
+  ("40x40", 1, "~ipad"), ("40x40", 2, "~ipad"),
+  ("76x76", 1, "~ipad"), ("76x76", 2, "~ipad"),
+  ("83.5x83.5", 2, "~ipad"),
+  ("1024x1024", 1, "")
+)
+
+# bump when `_render()` changes, so old renders aren't reused
+RENDER_VERSION = 1
+
+IPHONE_FILES = ("20x20", "29x29", "40x40", "60x60")
+IPAD_FILES = IPHONE_FILES + ("76x76", "83.5x83.5")
+
+
+def file_suffix(points: str, scale: int, idiom: str) -> str:
+  """e.g. `60x60@2x.png`, appended to the icon's name."""
+  return f"{points}{f'@{scale}x' if scale != 1 else ''}{idiom}.png"
+
+
+def pixels(points: str, scale: int) -> int:
+  return round(float(points.split("x")[0]) * scale)
+
+
+def sizes() -> list[int]:
+  """every size in pixels that's rendered, each one once."""
+  return sorted({pixels(p, s) for p, s, _ in ICONS})
+
+
+def _render(source: str, out: str) -> None:
+  from PIL import Image  # type: ignore
+
+  # decode once, then resample every size from the same pixels
+  with Image.open(source) as img:
+    img.load()
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+    src = img.convert("RGBA" if has_alpha else "RGB")
+
+  def render(px: int) -> None:
+    src.resize((px, px), Image.LANCZOS).save(
+      f"{out}/{px}.png", "PNG", optimize=False
+    )
+
+  with concurrent.futures.ThreadPoolExecutor() as executor:
+    list(executor.map(render, sizes()))
+
+
+def generate(source: str) -> tuple[str, str]:
+  """
+  renders every icon size for `source`, returns (cache folder, hash).
+
+  results are cached by the hash of the source image (and of what's
+  rendered from it), so repeated jobs with the same icon don't even
+  need pillow. the hash returned is the source image's.
+  """
+  digest = tbhutils.hash_file(source)
+  recipe = hashlib.sha256(f"{RENDER_VERSION}:{sizes()}".encode())
+  key = f"{digest}-{recipe.hexdigest()[:16]}"
+
+  renders = cache.Cache("icons", check=True)
+  if (cached := renders.get(key)) is not None:
+    return cached, digest
+
+  def render(tmp: str) -> None:
+    os.mkdir(tmp)
+    _render(source, tmp)
+
+  return renders.publish(key, render), digest
+
+
+def install(
+    source: str, app_path: str, links: bool = False
+) -> dict[str, Any]:
+  """copy the rendered icons into the app, returns the plist changes."""
+  cached, digest = generate(source)
+  uid = f"cyan_{digest[:7]}a"  # can't have it end with a num
+
+  stats = staging.StageStats()
+  for points, scale, idiom in ICONS:
+    dst = f"{app_path}/{uid}{file_suffix(points, scale, idiom)}"
+    if os.path.exists(dst):
+      os.remove(dst)
+    staging.stage_file(
+      f"{cached}/{pixels(points, scale)}.png", dst, stats, links
+    )
+
+  return {
+    "CFBundleIcons": {
+      "CFBundlePrimaryIcon": {
+        "CFBundleIconFiles": [uid + f for f in IPHONE_FILES],
+        "CFBundleIconName": uid
+      }
+    },
+    "CFBundleIcons~ipad": {
+      "CFBundlePrimaryIcon": {
+        "CFBundleIconFiles": [uid + f for f in IPAD_FILES],
+        "CFBundleIconName": uid
+      }
+    }
+  }
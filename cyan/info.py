@@ -0,0 +1,188 @@
+"""
+`cyan info`: what's in an app, as json, without extracting anything.
+
+only the central directory, plists and mach-o headers are read, straight
+out of the ipa, so whole folders of them are triaged in seconds.
+"""
+
+import os
+import sys
+import json
+import plistlib
+import argparse
+import concurrent.futures
+from typing import Any, Optional
+
+from cyan import plugins
+from cyan.errors import CyanError
+from cyan.planner import Tree
+from cyan.tbhtypes import Executable, Plist
+
+APP_EXTS = (".ipa", ".tipa", ".app")
+
+# where a dependency has to be to be a system one
+SYSTEM_PREFIXES = ("/System/", "/usr/lib/")
+
+
+def read_plist(tree: Tree, rel: str) -> Optional[Plist]:
+  if rel not in tree.files:
+    return None
+
+  with tree.open(rel) as f:
+    pl = Plist.from_bytes(f.read(), rel, throw=False)
+  return pl if pl.success else None
+
+
+def injected(dependencies: list[str]) -> list[str]:
+  """
+  what doesn't belong to a stock app: dylibs that aren't the system's,
+  and the frameworks tweaks usually bring along (substrate, ..).
+  """
+  return [
+    dep for dep in dependencies
+    if not dep.startswith(SYSTEM_PREFIXES) and (
+      dep.endswith(".dylib")
+      or any(common in dep.lower() for common in Executable.common)
+    )
+  ]
+
+
+def bundle(tree: Tree, rel: str) -> Optional[dict[str, Any]]:
+  """a watch app, by its folder."""
+  pl = read_plist(tree, f"{rel}/Info.plist")
+  if pl is None:
+    return None
+
+  found: dict[str, Any] = {
+    "path": rel,
+    "bundle_id": pl["CFBundleIdentifier"],
+    "executable": pl["CFBundleExecutable"]
+  }
+  exe = f"{rel}/{pl['CFBundleExecutable']}"
+  if exe in tree.files:
+    found["encrypted"] = tree.macho(exe).encrypted
+  return found
+
+
+def inspect(path: str) -> dict[str, Any]:
+  """everything `cyan info` says about one app."""
+  tree = Tree(path, path.endswith((".ipa", ".tipa")))
+  pl = read_plist(tree, "Info.plist")
+  if pl is None:
+    raise CyanError("no Info.plist, invalid app")
+
+  result: dict[str, Any] = {
+    "path": path,
+    "size": tree.total,
+    "bundle_id": pl["CFBundleIdentifier"],
+    "name": pl["CFBundleDisplayName"] or pl["CFBundleName"],
+    "version": pl["CFBundleShortVersionString"],
+    "build": pl["CFBundleVersion"],
+    "minimum_os": pl["MinimumOSVersion"],
+    "executable": pl["CFBundleExecutable"]
+  }
+  if tree.is_ipa:
+    result["compressed_size"] = tree.compressed
+
+  exe = pl["CFBundleExecutable"]
+  if exe in tree.files:
+    main = tree.macho(exe)
+    result |= {
+      "archs": main.archs,
+      "encrypted": main.encrypted,
+      "signed": main.signed,
+      "injected": injected(main.dependencies)
+    }
+
+    try:
+      ents = plistlib.loads(tree.entitlements(exe, main))
+      result["entitlements"] = sorted(ents)
+    except Exception:
+      result["entitlements"] = []  # unsigned, or none
+
+  nested = [rel for rel in sorted(tree.dirs) if rel.count("/") == 1]
+
+  result["extensions"] = plugins.inventory(tree)
+  result["watch_apps"] = list(filter(None, (
+    bundle(tree, rel) for rel in nested
+    if rel.startswith(("Watch/", "WatchKit/")) and rel.endswith(".app")
+  )))
+  result["frameworks"] = [
+    rel[11:] for rel in nested
+    if rel.startswith("Frameworks/") and rel.endswith(".framework")
+  ]
+  result["dylibs"] = sorted(
+    rel[11:] for rel in tree.files
+    if rel.startswith("Frameworks/") and rel.count("/") == 1
+    and rel.endswith(".dylib")
+  )
+  return result
+
+
+def safe_inspect(path: str) -> dict[str, Any]:
+  """`inspect()`, but a broken app is an error in the output instead."""
+  try:
+    return inspect(path)
+  except (CyanError, OSError, ValueError, KeyError) as e:
+    return {"path": path, "error": str(e) or type(e).__name__}
+  except Exception as e:  # struct.error, zlib.error, ..
+    return {"path": path, "error": f"{type(e).__name__}: {e}"}
+
+
+def find_apps(paths: list[str]) -> list[str]:
+  """the apps in `paths`, folders are searched (but not inside apps)."""
+  found = []
+  for path in paths:
+    if path.endswith(APP_EXTS) or not os.path.isdir(path):
+      found.append(path)
+      continue
+
+    for dp, dirs, files in os.walk(path):
+      found += [
+        os.path.join(dp, f) for f in sorted(files) if f.endswith(APP_EXTS)
+      ]
+      found += [
+        os.path.join(dp, d) for d in sorted(dirs) if d.endswith(".app")
+      ]
+      dirs[:] = sorted(d for d in dirs if not d.endswith(".app"))
+
+  return found
+
+
+def main(argv: list[str]) -> None:
+  parser = argparse.ArgumentParser(
+    prog="cyan info",
+    description="print what's in apps as json, without extracting them"
+  )
+  parser.add_argument(
+    "paths", metavar="path", nargs="+",
+    help="ipas/tipas/apps, or folders to look for them in"
+  )
+  parser.add_argument(
+    "-o", "--output", metavar="file",
+    help="write the json here instead of stdout"
+  )
+  args = parser.parse_args(argv)
+
+  apps = find_apps(args.paths)
+  if len(apps) == 0:
+    parser.error("no apps found")
+
+  # mostly waiting on reads, and zlib lets go of the gil
+  with concurrent.futures.ThreadPoolExecutor(
+      min(32, 4 * (os.cpu_count() or 1))
+  ) as executor:
+    results = list(executor.map(safe_inspect, apps))
+
+  single = len(args.paths) == 1 and apps == args.paths
+  out = json.dumps(
+    results[0] if single else results, indent=2, default=str
+  )
+  if args.output is None:
+    print(out)
+  else:
+    with open(args.output, "w") as f:
+      f.write(out + "\n")
+
+  if any("error" in r for r in results):
+    sys.exit(1)
@@ -0,0 +1,160 @@
+"""
+finished ipas, cached by what went into them.
+
+the key is the input's hash plus a hash of the job's effective options
+(after .cyan files are merged), with every file option replaced by the
+hash of its contents, so the same app with the same recipe is only
+built once. storing, sharing and evicting them is `cyan/cache.py`'s
+job, `$CYAN_OUTPUT_CACHE` is the cache's size (`0` disables it).
+"""
+
+import os
+import json
+import glob
+import hashlib
+import contextlib
+import concurrent.futures
+from uuid import uuid4
+from argparse import Namespace
+from typing import Any, Optional
+
+from cyan import cache, staging, tbhutils
+from cyan.tbhtypes import codesign
+
+# options that don't change the output
+IGNORED = frozenset((
+  "input", "output", "i", "o", "cyan", "overwrite", "plan",
+  "ignore_encrypted", "cache", "variants", "verify"
+))
+
+# options that are paths, their contents are what matters
+FILES = ("k", "l", "x")
+
+_code_hash: Optional[str] = None
+
+
+def code_hash() -> str:
+  """cyan's own source, so a changed cyan doesn't reuse old outputs."""
+  global _code_hash
+  if _code_hash is None:
+    h = hashlib.sha256()
+    root = os.path.dirname(__file__)
+    for path in sorted(glob.glob(f"{root}/**/*.py", recursive=True)):
+      h.update(os.path.relpath(path, root).encode() + b"\0")
+      h.update(tbhutils.hash_file(path).encode())
+    _code_hash = h.hexdigest()
+  return _code_hash
+
+
+def hash_path(path: str) -> str:
+  if os.path.isdir(path):
+    return tbhutils.hash_tree(path)
+  return tbhutils.hash_file(path)
+
+
+def hash_input(path: str) -> str:
+  """
+  the input's hash, remembered by its path, size, mtime and inode,
+  so an ipa that's seen again isn't read again.
+  """
+  if os.path.isdir(path):
+    return tbhutils.hash_tree(path)
+
+  st = os.stat(path)
+  stamp = f"{os.path.realpath(path)}\0{st.st_size}\0{st.st_mtime_ns}"
+  stamp += f"\0{st.st_ino}"
+  memos = cache.Cache("inputs", check=True)
+  key = hashlib.sha256(stamp.encode()).hexdigest()
+
+  if (memo := memos.get(key)) is not None:
+    with contextlib.suppress(OSError):
+      with open(memo) as f:
+        return f.read().strip()
+
+  digest = tbhutils.hash_file(path)
+  memos.put_bytes(key, digest.encode())
+  return digest
+
+
+def recipe(args: Namespace) -> dict[str, Any]:
+  """
+  everything about a job that changes its output, with file options
+  as hashes. call it after `parse_cyans()`, so merged options count.
+  """
+  opts = {
+    k: v for k, v in sorted(vars(args).items())
+    if k not in IGNORED and v is not None and v is not False
+  }
+
+  tweaks: dict[str, str] = opts.get("f") or {}
+  paths = [opts[k] for k in FILES if isinstance(opts.get(k), str)]
+  paths += list(tweaks.values())
+
+  with concurrent.futures.ThreadPoolExecutor() as executor:
+    hashes = dict(zip(paths, executor.map(hash_path, paths)))
+
+  for k in FILES:
+    if isinstance(opts.get(k), str):
+      opts[k] = hashes[opts[k]]
+  if tweaks:
+    # the name matters too, it's what the file is called in the app
+    opts["f"] = {name: hashes[path] for name, path in sorted(tweaks.items())}
+
+  opts["code"] = code_hash()
+  opts["zip_levels"] = os.environ.get("CYAN_ZIP_LEVELS", "")
+  # ldid signs differently from the in-process signer
+  opts["use_ldid"] = not codesign.enabled()
+  return opts
+
+
+def key(args: Namespace) -> tuple[str, dict[str, Any]]:
+  """(cache key, recipe) of a job, the input is hashed meanwhile."""
+  with concurrent.futures.ThreadPoolExecutor(1) as executor:
+    digest = executor.submit(hash_input, args.i)
+    opts = recipe(args)
+
+  return hashlib.sha256(json.dumps(
+    {"input": digest.result(), "recipe": opts},
+    sort_keys=True, separators=(",", ":")
+  ).encode()).hexdigest(), opts
+
+
+def _place(src: str, dst: str) -> None:
+  """
+  reflink `src` to `dst` (or copy it), atomically. a hardlink would
+  let anyone who overwrites `dst` change the cache entry too.
+  """
+  tmp = os.path.join(os.path.dirname(dst) or ".", f".{uuid4().hex}")
+  try:
+    staging.stage_file(src, tmp, staging.StageStats(), links=False)
+    os.replace(tmp, dst)
+  except BaseException:
+    if os.path.lexists(tmp):
+      os.remove(tmp)
+    raise
+
+
+class OutputCache:
+  """ipas by job key, kept in the "outputs" `cache.Cache`."""
+
+  def __init__(self, size: Optional[int] = None):
+    self.store = cache.Cache("outputs", size)
+
+  @property
+  def enabled(self) -> bool:
+    return self.store.enabled
+
+  def get(self, key: str, output: str) -> bool:
+    """put the cached ipa for `key` at `output`, if there is one."""
+    entry = self.store.get(key)
+    if entry is None:
+      return False
+
+    try:
+      _place(entry, output)
+    except FileNotFoundError:
+      return False  # just evicted
+    return True
+
+  def put(self, key: str, output: str, recipe: dict[str, Any]) -> None:
+    self.store.put_file(key, output, {"recipe": recipe})
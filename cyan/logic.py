@@ -1,115 +1,101 @@
 import os
 import sys
-import shutil
-from argparse import ArgumentParser
-from tempfile import TemporaryDirectory
-
-from cyan import tbhutils, tbhtypes
+import shlex
+from typing import Any
+from argparse import ArgumentParser, Namespace
+
+from cyan import api, staging, tbhutils
+from cyan.errors import CyanError, UsageError
+from cyan.runner import runner
+
+
+def parse_variants(
+    parser: ArgumentParser, specs: list[str]
+) -> dict[str, dict[str, Any]]:
+  """
+  `name=options` into the options each variant sets, only the ones
+  really given, so a variant can set one back to its default.
+  """
+  # options already in the namespace aren't given their defaults
+  unset = object()
+  dests = vars(parser.parse_args(["-i", "-"]))
+
+  variants: dict[str, dict[str, Any]] = {}
+  for spec in specs:
+    name, sep, options = spec.partition("=")
+    if not sep or not name:
+      parser.error(f"invalid variant: {spec} (expected name=options)")
+
+    ns = parser.parse_args(
+      ["-i", "-", *shlex.split(options)],
+      Namespace(**{k: unset for k in dests})
+    )
+    variants[name] = {
+      k: v for k, v in vars(ns).items() if k != "input" and v is not unset
+    }
+  return variants
 
 
 def main(parser: ArgumentParser) -> None:
-
   args = parser.parse_args()
-  args.i = os.path.normpath(args.input)
-
-  # Create app after args are parsed
-  app = None
-  if getattr(args, "remove_plugins", None):
-    # app will be created after app_path is determined
-    pass
-
-
-  if args.output is not None:
-    args.o = os.path.normpath(args.output)
-    if not (
-      args.o.endswith(".app")
-      or args.o.endswith(".ipa")
-      or args.o.endswith(".tipa")
-    ):
-      print("[?] valid file extension not found; will create ipa")
-      args.o += ".ipa"
-  else:
-    args.o = args.i
-
-
-  # this also modifies some args, like -f,
-  # to ensure there are no duplicates, etc
-  arg_err = tbhutils.validate_inputs(args)
-  if arg_err is not None:
-    parser.error(arg_err)
-
-
-  # mfw when "True if True else False" HAHAHAH
-  INPUT_IS_IPA = args.i.endswith(".ipa") or args.i.endswith(".tipa")
-  OUTPUT_IS_IPA = args.o.endswith(".ipa") or args.o.endswith(".tipa")
-
-  with TemporaryDirectory() as tmpdir, tbhtypes.LeavingCM():
-    app_path = tbhutils.get_app(args.i, tmpdir, INPUT_IS_IPA)
-    app = tbhtypes.AppBundle(app_path)
-
-
-    if app.executable.is_encrypted():
-      if args.ignore_encrypted:
-        print("[?] main binary is encrypted, ignoring")
+  if args.variants is not None:
+    args.variants = parse_variants(parser, args.variants)
+  api.prepare(args)
+
+  try:
+    existing = [
+      job.o for _, job in api.expand_variants(args)
+      if os.path.exists(job.o)
+    ]
+  except UsageError as e:
+    parser.error(str(e))
+
+  if existing and not args.overwrite and args.plan is None and (
+      os.path.exists(args.i)
+  ):
+    try:
+      if len(existing) > 1 or existing[0] != args.o:
+        question = f"[<] {', '.join(existing)} already exist, overwrite? "
+      elif args.output is not None:
+        question = f"[<] {args.o} already exists, overwrite it? "
       else:
-        sys.exit("[!] main binary is encrypted; exiting")
-
-
-    if args.cyan is not None:
-      changing = vars(args)
-      tbhutils.parse_cyans(changing, tmpdir)
-
-
-    # this goes before injection,
-    # since user might inject their own extensions
-    if args.remove_extensions:
-      app.remove_all_extensions()
-    elif args.remove_encrypted:
-      app.remove_encrypted_extensions()
-
-
-    if args.f is not None:
-      app.executable.inject(args.f, tmpdir)
-    if args.n is not None:
-      app.plist.change_name(args.n)
-    if args.v is not None:
-      app.plist.change_version(args.v)
-    if args.b is not None:
-      app.plist.change_bundle_id(args.b)
-    if args.m is not None:
-      app.plist.change_minimum_version(args.m)
-    if args.k is not None:
-      app.change_icon(args.k, tmpdir)
-    if args.l is not None:
-      app.plist.merge_plist(args.l)
-    if args.x is not None:
-      app.executable.merge_entitlements(args.x)
-
-    if args.remove_supported_devices:
-      app.plist.remove_uisd()
-    if args.no_watch:
-      app.remove_watch_apps()
-    if args.enable_documents:
-      app.plist.enable_documents()
-    if args.fakesign:
-      app.fakesign_all()
-    if args.thin:
-      app.thin_all()
-
-
-    # create subdirectories if necessary
-    if "/" in args.o:
-      os.makedirs(os.path.dirname(args.o), exist_ok=True)
-
-    # done !
-    if OUTPUT_IS_IPA:
-      print(f"[*] generating ipa with compression level {args.compress}..")
-      tbhutils.make_ipa(tmpdir, os.path.realpath(args.o), args.compress)
-      print(f"[*] generated ipa at {args.o}")
-    else:
-      if os.path.isdir(args.o):
-        shutil.rmtree(args.o)
-
-      shutil.move(app.path, args.o)
-      print(f"[*] generated app at {args.o}")
-
+        question = "[<] no output was specified. overwrite the input? "
+      overwrite = input(f"{question}[Y/n] ").strip().lower()
+    except (KeyboardInterrupt, EOFError):
+      sys.exit("[>] bye!")
+
+    if overwrite not in ("y", "yes", ""):
+      print("[>] quitting.")
+      sys.exit(0)
+    args.overwrite = True
+
+  try:
+    if args.plan is not None:
+      from cyan import planner
+
+      if args.variants:
+        raise UsageError("--plan can't plan variants yet")
+      tbhutils.validate_inputs(args)
+      return planner.main(
+        args, args.i.endswith((".ipa", ".tipa")),
+        args.o.endswith((".ipa", ".tipa"))
+      )
+
+    result = api.run(args, echo=True)
+  except UsageError as e:
+    parser.error(str(e))
+  except CyanError as e:
+    sys.exit(f"[!] {e}")
+
+  if staging.unshared.copied != 0:
+    print(
+      f"[*] copied {tbhutils.human_size(staging.unshared.copied)} "
+      "of hardlinked files before modifying them"
+    )
+
+  if os.environ.get("CYAN_TIMELINE"):
+    for name, r in [("", result), *result.variants.items()]:
+      print(f"[*] timeline{f' of {name}' if name else ''}:\n{r.timeline()}")
+
+  if os.environ.get("CYAN_TOOL_STATS"):
+    print(f"[*] tool usage:\n{runner.summary()}")
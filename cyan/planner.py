@@ -0,0 +1,512 @@
+import os
+import sys
+import json
+import zipfile
+import plistlib
+import contextlib
+from argparse import Namespace
+from collections import Counter
+from typing import Any, BinaryIO, Callable, Optional
+
+from cyan import compression, icons, plugins, tbhutils, zipwriter
+from cyan.errors import InvalidAppError
+from cyan.tbhtypes import Executable, MachO, codesign
+from cyan.tbhtypes.macho import parse_superblob
+
+EXECUTABLE_EXTS = (".dylib", ".appex", ".framework")
+WATCH_DIRS = ("Watch", "WatchKit", "com.apple.WatchPlaceholder")
+
+
+class Tree:
+  """
+  the files of an app, inside an ipa or a folder, without extracting.
+
+  paths are relative to the .app, only headers are ever read.
+  """
+
+  def __init__(self, path: str, is_ipa: bool):
+    self.path = path
+    self.is_ipa = is_ipa
+    self.files: dict[str, int] = {}
+    self.compressed = 0
+    self.entries: dict[str, zipwriter.Entry] = {}
+
+    if is_ipa:
+      try:
+        entries = zipwriter.read_central(path)
+      except ValueError:
+        raise InvalidAppError(f"{path} is not a zipfile (ipa)")
+
+      apps = sorted({
+        parts[1] for parts in (e.name.split("/", 2) for e in entries)
+        if len(parts) == 3 and parts[0] == "Payload"
+        and parts[1].endswith(".app")
+      })
+      if len(apps) == 0:
+        raise InvalidAppError(
+          "couldn't find either Payload or app folder, invalid ipa"
+        )
+
+      self.prefix = f"Payload/{apps[0]}/"
+      for e in entries:
+        self.compressed += e.csize
+        if e.name.startswith(self.prefix) and not e.name.endswith("/"):
+          self.files[e.name[len(self.prefix):]] = e.size
+          self.entries[e.name[len(self.prefix):]] = e
+    else:
+      for dp, _, files in os.walk(path):
+        for f in files:
+          full = f"{dp}/{f}"
+          if not os.path.islink(full):
+            self.files[os.path.relpath(full, path)] = os.path.getsize(full)
+
+    self.dirs = {
+      rel.rsplit("/", i)[0]
+      for rel in self.files
+      for i in range(1, rel.count("/") + 1)
+    }
+
+  @property
+  def total(self) -> int:
+    return sum(self.files.values())
+
+  def exists(self, rel: str) -> bool:
+    return rel in self.files or rel in self.dirs
+
+  def size(self, rel: str) -> int:
+    """size of a file, or of everything inside a folder."""
+    if rel in self.files:
+      return self.files[rel]
+    return sum(
+      size for name, size in self.files.items()
+      if name.startswith(f"{rel}/")
+    )
+
+  def open(self, rel: str) -> BinaryIO:
+    if not self.is_ipa:
+      return open(f"{self.path}/{rel}", "rb")
+
+    # read straight from the ipa, seeking skips what isn't needed
+    e = self.entries[rel]
+    with open(self.path, "rb") as f:
+      start = zipwriter.data_offset(f, e.header_offset)
+    if e.method == zipwriter.STORED:
+      return zipwriter.Slice(self.path, start, e.size)  # type: ignore
+
+    # deflated ones only get decompressed as far as they're read
+    return zipwriter.Inflated(  # type: ignore
+      self.path, start, e.csize, e.size
+    )
+
+  def plist(self, rel: str) -> dict[str, Any]:
+    if rel not in self.files:
+      return {}
+
+    try:
+      with self.open(rel) as f:
+        return plistlib.load(f)
+    except Exception:
+      return {}
+
+  def macho(self, rel: str) -> MachO:
+    with self.open(rel) as f:
+      return MachO.from_file(f, rel, self.files[rel])
+
+  def entitlements(self, rel: str, info: MachO) -> bytes:
+    for sl in info.slices:
+      if (cs := sl.code_signature) is None:
+        continue
+
+      with self.open(rel) as f:
+        f.seek(sl.offset + cs[0])
+        blob = parse_superblob(f.read(cs[1])).get(5, b"")
+      return blob[8:]
+    return b""
+
+  def executables(self) -> list[str]:
+    """the binaries `AppBundle.mass_operate()` would go through."""
+    found = []
+    for rel in sorted(self.files.keys() | self.dirs):
+      if not rel.endswith(EXECUTABLE_EXTS):
+        continue
+      if rel.endswith(".dylib") and rel in self.files:
+        found.append(rel)
+        continue
+
+      name = self.plist(f"{rel}/Info.plist").get("CFBundleExecutable")
+      if name is not None and f"{rel}/{name}" in self.files:
+        found.append(f"{rel}/{name}")
+    return found
+
+
+class Plan:
+  def __init__(self) -> None:
+    self.steps: list[dict[str, Any]] = []
+    self.tools: Counter[str] = Counter()
+    self.binaries: set[str] = set()
+    self.bytes: Counter[str] = Counter()
+    self.error: Optional[str] = None
+
+    # binaries that only exist after injecting, path -> size
+    self.injected: dict[str, int] = {}
+
+  def step(self, name: str, **detail: Any) -> None:
+    self.steps.append({"step": name, "tools": Counter(), **detail})
+
+  def tool(self, name: str, count: int = 1) -> None:
+    if count != 0:
+      self.tools[name] += count
+      self.steps[-1]["tools"][name] += count
+
+  def rewrite(
+      self, rel: str, size: int, tool: Optional[str] = None,
+      binary: bool = False
+  ) -> None:
+    """`tool` rewrites the file at `rel`, which is `size` bytes big."""
+    if tool is not None:
+      self.tool(tool)
+    if tool is not None or binary:
+      self.binaries.add(rel)
+    self.bytes["rewritten"] += size
+
+  def sign(self, rel: str, size: int) -> None:
+    # in-process unless it's disabled, see `codesign.py`
+    self.rewrite(rel, size, None if codesign.enabled() else "ldid", True)
+
+  def to_dict(self) -> dict[str, Any]:
+    return {
+      "steps": [
+        {k: dict(v) if k == "tools" else v for k, v in s.items()}
+        for s in self.steps
+      ],
+      "binaries": sorted(self.binaries),
+      "tools": dict(self.tools),
+      "bytes": dict(self.bytes),
+      "error": self.error
+    }
+
+
+def open_member(path: str, name: str) -> BinaryIO:
+  """
+  one member of a zip, closing the zip's file along with it
+  (an open member keeps it open until then).
+  """
+  with zipfile.ZipFile(path) as zf:
+    return zf.open(name)  # type: ignore
+
+
+def cyan_payloads(
+    args: dict[str, Any]
+) -> dict[str, tuple[int, Optional[Callable[[], BinaryIO]]]]:
+  """
+  merge the .cyan configs into `args` like `parse_cyans()` would,
+  returns the payloads' sizes and openers instead of extracting them.
+  """
+  cyans: list[str] = args["cyan"]
+  metas = [tbhutils.read_cyan(c) for c in cyans]
+  jobs = tbhutils.merge_cyans(args, cyans, metas)
+
+  found: dict[str, tuple[int, Optional[Callable[[], BinaryIO]]]] = {}
+  for ind, member in jobs:
+    with zipfile.ZipFile(cyans[ind]) as zf:
+      infos = [
+        zi for zi in zf.infolist()
+        if zi.filename == member or zi.filename.startswith(f"{member}/")
+      ]
+    size = sum(zi.file_size for zi in infos)
+    opener = None
+    if len(infos) == 1 and infos[0].filename == member:
+      opener = (lambda path, name: lambda: open_member(path, name))(
+        cyans[ind], member
+      )
+    found[member] = (size, opener)
+
+    if member.startswith("inject/"):
+      args["f"] = args["f"] if args["f"] is not None else {}
+      args["f"][member[7:]] = f"{cyans[ind]}:{member}"
+    else:
+      key = next(k for k, v in tbhutils.CYAN_FILES.items() if v == member)
+      args[key] = f"{cyans[ind]}:{member}"
+
+  return found
+
+
+def plan_inject(
+    plan: Plan, tree: Tree, main: str, main_info: MachO,
+    tweaks: dict[str, tuple[int, Optional[Callable[[], BinaryIO]]]]
+) -> None:
+  main_size = tree.files[main]
+  plan.step("inject", items=sorted(tweaks))
+
+  entitlements = tree.entitlements(main, main_info)
+  if main_info.signed:
+    plan.rewrite(main, main_size, "ldid")
+
+  if any(t.endswith((".deb", ".dylib", ".framework")) for t in tweaks):
+    if "@executable_path/Frameworks" not in main_info.rpaths:
+      plan.rewrite(main, main_size, "install_name_tool")
+
+  has_idylib = os.path.isfile(Executable.idylib)
+  needed: set[str] = set()
+  unknown = []
+  for bn, (size, opener) in sorted(tweaks.items()):
+    plan.bytes["added"] += size
+
+    if bn.endswith(".deb"):
+      # the contents are only known after extracting it
+      plan.tool("ar")
+      plan.tool("tar")
+      plan.bytes["extracted"] += size
+      unknown.append(bn)
+      continue
+
+    if bn.endswith(".dylib"):
+      plan.injected[f"Frameworks/{bn}"] = size
+    elif bn.endswith(".framework"):
+      plan.injected[f"Frameworks/{bn}/{bn[:-10]}"] = size
+
+    if bn.endswith((".dylib", ".framework")):
+      if has_idylib:
+        plan.rewrite(main, main_size, "insert_dylib")
+
+    if not bn.endswith(".dylib") or opener is None:
+      continue
+
+    with opener() as f:
+      info = MachO.from_file(f, bn, size)
+
+    if info.signed:
+      plan.rewrite(bn, size, "ldid")
+    for dep in info.dependencies:
+      if not dep.startswith(Executable.starters):
+        continue
+
+      for common, ci in Executable.common.items():
+        if common in dep.lower():
+          needed.add(common)
+          if dep != ci["path"]:
+            plan.rewrite(bn, size, "install_name_tool")
+
+      for cname in tweaks:
+        if cname in dep:
+          npath = (
+            f"@rpath/{cname}/{cname[:-10]}"
+            if cname.endswith(".framework") else f"@rpath/{cname}"
+          )
+          if dep != npath:
+            plan.rewrite(bn, size, "install_name_tool")
+
+  if "orion." in needed:
+    needed.add("substrate.")
+  auto = sorted(Executable.common[n]["name"] for n in needed)
+  for real in auto:
+    extra = f"{Executable.install_dir}/extras/{real}"
+    plan.bytes["added"] += tbhutils.get_size(extra)
+    plan.injected[f"Frameworks/{real}/{real[:-10]}"] = os.path.getsize(
+      f"{extra}/{real[:-10]}"
+    )
+  plan.steps[-1]["auto_injected"] = auto
+  plan.steps[-1]["unknown_contents"] = unknown
+
+  if not has_idylib:
+    plan.rewrite(main, main_size)  # lief writes it once, in-process
+  if len(entitlements) != 0:
+    plan.sign(main, main_size)
+
+
+def plan_removals(plan: Plan, args: Namespace, tree: Tree) -> list[str]:
+  """the removal steps, returns every folder they remove."""
+  gone: list[str] = []
+  for step, (paths, _, unmatched) in plugins.removals(args, tree).items():
+    removed = sum(tree.size(p) for p in paths)
+    detail: dict[str, Any] = {"bytes": removed}
+    if step != "remove_extensions":
+      detail["extensions"] = paths
+    if unmatched:
+      detail["unmatched"] = unmatched
+    plan.step(step, **detail)
+    plan.bytes["removed"] += removed
+    gone += paths
+  return gone
+
+
+def plan_filter(args: Namespace, tree: Tree) -> Plan:
+  """a job that only removes extensions, see `api._filter()`."""
+  plan = Plan()
+  main = tree.plist("Info.plist").get("CFBundleExecutable")
+  encrypted = main in tree.files and tree.macho(main).encrypted
+  plan.step("check_encryption", encrypted=encrypted)
+  if encrypted and not args.ignore_encrypted:
+    plan.error = "main binary is encrypted"
+    return plan
+
+  gone = tuple(f"{d}/" for d in plan_removals(plan, args, tree))
+  kept = [e for rel, e in tree.entries.items() if not rel.startswith(gone)]
+  plan.step(
+    "filter_ipa", files=len(kept), compressed=sum(e.csize for e in kept),
+    bytes=tree.total - plan.bytes["removed"]
+  )
+  plan.bytes["copied"] += sum(e.csize for e in kept)
+  return plan
+
+
+def plan_job(
+    args: Namespace, input_is_ipa: bool, output_is_ipa: bool
+) -> Plan:
+  """what `logic.main()` would do with these args, see `main()`."""
+  tree = Tree(args.i, input_is_ipa)
+  if plugins.filters(args, input_is_ipa):
+    return plan_filter(args, tree)
+
+  plan = Plan()
+
+  plan.step(
+    "extract" if input_is_ipa else "stage",
+    files=len(tree.files), compressed=tree.compressed
+  )
+  if input_is_ipa and tbhutils.HAS_UNZIP:
+    plan.tool("unzip")
+  plan.bytes["extracted" if input_is_ipa else "staged"] += tree.total
+
+  info = tree.plist("Info.plist")
+  main = info.get("CFBundleExecutable")
+  if main is None or main not in tree.files:
+    plan.error = "no main executable"
+    return plan
+
+  main_info = tree.macho(main)
+  plan.step("check_encryption", encrypted=main_info.encrypted)
+  if main_info.encrypted and not args.ignore_encrypted:
+    plan.error = "main binary is encrypted"
+    return plan
+
+  opts = vars(args)
+  tweaks = {
+    bn: (tbhutils.get_size(path), (lambda p: lambda: open(p, "rb"))(path))
+    for bn, path in (args.f or {}).items()
+  }
+  if args.cyan is not None:
+    plan.step("parse_cyans", cyans=len(args.cyan))
+    payloads = cyan_payloads(opts)
+    plan.bytes["extracted"] += sum(size for size, _ in payloads.values())
+    tweaks |= {
+      member[7:]: payload for member, payload in payloads.items()
+      if member.startswith("inject/")
+    }
+
+  # removed folders, nothing in them gets signed. they're never
+  # extracted either, see `tbhutils.Extraction`
+  gone = plan_removals(plan, args, tree)
+  plan.bytes["extracted" if input_is_ipa else "staged"] -= (
+    plan.bytes["removed"]
+  )
+
+  if len(tweaks) != 0:
+    plan_inject(plan, tree, main, main_info, tweaks)
+
+  plist_size = tree.files["Info.plist"]
+  for key, step in (
+      ("n", "change_name"), ("v", "change_version"),
+      ("b", "change_bundle_id"), ("m", "change_minimum_version"),
+      ("l", "merge_plist"), ("remove_supported_devices", "remove_uisd"),
+      ("enable_documents", "enable_documents")
+  ):
+    if opts.get(key):
+      plan.step(step)
+      plan.rewrite("Info.plist", plist_size)
+
+  if opts.get("n"):
+    for rel in tree.files:
+      if rel.count("/") == 1 and rel.endswith(".lproj/InfoPlist.strings"):
+        plan.rewrite(rel, tree.files[rel])
+  if opts.get("b"):
+    for rel in tree.files:
+      if rel.count("/") == 2 and rel.endswith(".appex/Info.plist"):
+        plan.rewrite(rel, tree.files[rel])
+
+  if opts.get("k"):
+    plan.step("change_icon", files=len(icons.ICONS))
+    plan.rewrite("Info.plist", plist_size)
+  if opts.get("x"):
+    plan.step("merge_entitlements")
+    plan.sign(main, tree.files[main])
+
+  if args.no_watch:
+    gone += WATCH_DIRS
+    watch = sum(tree.size(d) for d in WATCH_DIRS)
+    plan.step("remove_watch_apps", bytes=watch)
+    plan.bytes["removed"] += watch
+
+  if args.dedup_frameworks:
+    # which copies are identical is only known after hashing them
+    plan.step("dedup_frameworks", frameworks=sorted(
+      d for d in tree.dirs
+      if d.count("/") == 3 and d.endswith(".framework")
+      and "/Frameworks/" in d and d.split("/")[1].endswith(".appex")
+    ))
+
+  for flag, step, tool in (
+      ("strip", "strip_all", None), ("fakesign", "fakesign_all", None),
+      ("thin", "thin_all", "lipo")
+  ):
+    if not getattr(args, flag):
+      continue
+
+    if flag == "strip":
+      # tweaks may look up local symbols, see `strip.py`
+      plan.step(step, keep_locals=args.f is not None)
+    else:
+      plan.step(step)
+    saved = 0
+    sizes = {rel: tree.files[rel] for rel in tree.executables() + [main]}
+    for rel, size in (sizes | plan.injected).items():
+      if rel.startswith(tuple(f"{d}/" for d in gone)):
+        continue
+      if flag == "strip":
+        plan.rewrite(rel, size, binary=True)  # in-process
+      elif tool is None:
+        plan.sign(rel, size)
+      else:
+        plan.rewrite(rel, size, tool)
+      if flag == "thin" and rel in tree.files:
+        slices = tree.macho(rel).slices
+        if len(slices) > 1 and any(sl.arch == "arm64" for sl in slices):
+          saved += sum(sl.size for sl in slices if sl.arch != "arm64")
+    if flag == "thin":
+      plan.steps[-1]["bytes_saved"] = saved
+      plan.bytes["removed"] += saved
+
+  final = tree.total - plan.bytes["removed"] + plan.bytes["added"]
+  if output_is_ipa:
+    # binaries and incompressible files are only told apart later
+    classes: Counter = Counter()
+    for rel, size in (tree.files | plan.injected).items():
+      if not rel.startswith(tuple(f"{d}/" for d in gone)):
+        classes[compression.by_extension(rel) or "other"] += size
+    plan.step("make_ipa", level=args.compress, bytes_by_class=dict(classes))
+    plan.bytes["recompressed"] += final
+  else:
+    plan.step("move_app")
+  plan.steps[-1]["bytes"] = final
+
+  return plan
+
+
+def main(args: Namespace, input_is_ipa: bool, output_is_ipa: bool) -> None:
+  """
+  print what a job would do as json, without doing any of it.
+
+  only the ipa's central directory, plists and mach-o headers are read.
+  """
+  # anything printed while planning would break the json
+  with contextlib.redirect_stdout(sys.stderr):
+    plan = plan_job(args, input_is_ipa, output_is_ipa)
+
+  out = {"input": args.i, "output": args.o, **plan.to_dict()}
+  if args.plan == "-":
+    json.dump(out, sys.stdout, indent=2)
+    print()
+  else:
+    with open(args.plan, "w") as f:
+      json.dump(out, f, indent=2)
+    print(f"[*] wrote plan to {args.plan}", file=sys.stderr)
@@ -0,0 +1,166 @@
+"""
+an app's extensions ("plugins"), found without extracting anything,
+and which of them a job removes.
+
+removals are decided from the input alone, so what's removed is never
+extracted (see `tbhutils.Extraction`), and a job that only removes
+extensions copies the ipa's other entries into the output as they are,
+still compressed (see `tbhutils.filter_ipa()`).
+"""
+
+import os
+import concurrent.futures
+from argparse import Namespace
+from typing import TYPE_CHECKING, Any
+
+from cyan import tbhutils
+
+if TYPE_CHECKING:
+  from cyan.planner import Tree
+
+FOLDERS = ("PlugIns", "Extensions")
+
+# options that change what's in the app, other than removing extensions
+MODIFYING = (
+  "cyan", "f", "n", "v", "b", "m", "k", "l", "x",
+  "remove_supported_devices", "no_watch", "enable_documents",
+  "dedup_frameworks", "fakesign", "thin", "strip"
+)
+
+
+def inventory(tree: "Tree") -> list[dict[str, Any]]:
+  """
+  every extension in PlugIns/ and Extensions/, with the same keys as
+  `AppBundle.scan_extensions()`, but paths relative to the app.
+  """
+  def scan(rel: str) -> dict[str, Any]:
+    pl = tree.plist(f"{rel}/Info.plist")
+    name = pl.get("CFBundleExecutable")
+    if name is None:
+      name = os.path.splitext(os.path.basename(rel))[0]
+
+    exe = f"{rel}/{name}"
+    return {
+      "name": name,
+      "path": rel,
+      "bundle_id": pl.get("CFBundleIdentifier"),
+      "encrypted": exe in tree.files and tree.macho(exe).encrypted,
+      "size": tree.size(rel)
+    }
+
+  found = sorted(
+    d for d in tree.dirs
+    if d.count("/") == 1 and d.startswith(tuple(f"{f}/" for f in FOLDERS))
+    and (d.endswith(".appex") or d.startswith("Extensions/"))
+  )
+  with concurrent.futures.ThreadPoolExecutor() as executor:
+    return list(executor.map(scan, found))
+
+
+def matches(plugin: dict[str, Any], spec: str) -> bool:
+  """
+  `--remove-plugins` takes paths (in the app, or ending with one),
+  folder names with or without `.appex`, executable names or bundle ids.
+  """
+  spec = spec.rstrip("/")
+  folder = os.path.basename(plugin["path"])
+  return spec.endswith(f"/{plugin['path']}") or spec in (
+    plugin["path"], folder, os.path.splitext(folder)[0], plugin["name"],
+    plugin["bundle_id"]
+  )
+
+
+def select(
+    found: list[dict[str, Any]], specs: list[str]
+) -> tuple[list[dict[str, Any]], list[str]]:
+  """(the plugins any of `specs` match, the specs that matched none)."""
+  return (
+    [p for p in found if any(matches(p, spec) for spec in specs)],
+    [spec for spec in specs if not any(matches(p, spec) for p in found)]
+  )
+
+
+def removals(args: Namespace, tree: "Tree") -> dict[str, Any]:
+  """
+  what each removal step of a job takes out, by step name:
+  (paths in the app, extensions as `inventory()` has them, specs of
+  `--remove-plugins` that matched nothing).
+  """
+  steps: dict[str, Any] = {}
+  if args.remove_extensions:
+    # the whole folders, whatever is in them
+    paths = [f for f in FOLDERS if tree.exists(f)]
+    steps["remove_extensions"] = (paths, inventory(tree), [])
+    return steps  # nothing else is left to remove
+
+  if not args.remove_encrypted and not args.remove_plugins:
+    return steps
+
+  found = inventory(tree)
+  if args.remove_encrypted:
+    enc = [p for p in found if p["encrypted"]]
+    steps["remove_encrypted"] = ([p["path"] for p in enc], enc, [])
+  if args.remove_plugins:
+    chosen, unmatched = select(found, args.remove_plugins)
+    if args.remove_encrypted:
+      chosen = [p for p in chosen if not p["encrypted"]]  # already gone
+    paths = [p["path"] for p in chosen]
+    steps["remove_plugins"] = (paths, chosen, unmatched)
+  return steps
+
+
+def removes(args: Namespace) -> bool:
+  """whether a job removes any extensions."""
+  return bool(
+    args.remove_extensions or args.remove_encrypted or args.remove_plugins
+  )
+
+
+def only_removes(args: Namespace) -> bool:
+  """whether a job does nothing to the app but remove extensions."""
+  return removes(args) and all(
+    getattr(args, k) in (None, False) for k in MODIFYING
+  )
+
+
+def filters(args: Namespace, input_is_ipa: bool) -> bool:
+  """
+  whether a job's ipa is filtered instead of extracted, which leaves
+  the compression of the rest as it was. so a `-c` other than the
+  default means extracting and compressing again anyway.
+  """
+  return (
+    input_is_ipa and args.o.endswith((".ipa", ".tipa"))
+    and args.compress == 6 and only_removes(args)
+  )
+
+
+def report(
+    step: str, paths: list[str], removed: list[dict[str, Any]],
+    unmatched: list[str]
+) -> None:
+  """print what a removal step from `removals()` took out."""
+  h = tbhutils.human_size
+  if step == "remove_extensions":
+    if len(paths) == 0:
+      print("[?] no app extensions")
+    else:
+      print(f"[*] removed app extensions ({len(removed)} of them)")
+    return
+
+  for spec in unmatched:
+    print(f"[?] no plugin matches {spec}")
+
+  if len(removed) == 0:
+    print(
+      "[?] no encrypted plugins" if step == "remove_encrypted"
+      else "[?] no plugins were removed"
+    )
+    return
+
+  kind = "encrypted plugin" if step == "remove_encrypted" else "plugin"
+  print(
+    f"[*] removed {len(removed)} {kind}(s), "
+    f"{h(sum(p['size'] for p in removed))}:",
+    ", ".join(f"{p['name']} ({h(p['size'])})" for p in removed)
+  )
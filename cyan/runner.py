@@ -0,0 +1,166 @@
+import os
+import sys
+import time
+import tempfile
+import threading
+import subprocess
+from typing import Any, Iterator, Optional
+
+from cyan.errors import ToolError
+
+# seconds; ldid and lipo rewrite whole binaries, so they get longer.
+# anything not listed here (unzip, tar, ..) has no timeout
+TIMEOUTS: dict[str, Optional[float]] = {
+  "ldid": 600,
+  "lipo": 300,
+  "otool": 120,
+  "install_name_tool": 120,
+  "insert_dylib": 120
+}
+
+_DEFAULT: Any = object()
+
+
+def _from_env(name: str, kind: type, default: Any) -> Any:
+  """`$name` as `kind`, or `default` (with a warning) if it isn't one."""
+  value = os.environ.get(name, "")
+  if value == "":
+    return default
+
+  try:
+    return kind(value)
+  except ValueError:
+    print(f"[!] ignoring invalid ${name}: {value!r}", file=sys.stderr)
+    return default
+
+
+class ToolRunner:
+  """
+  the one place external tools are started from.
+
+  caps how many tools run at once, kills tools that hang,
+  and keeps per-tool timing totals.
+  """
+
+  def __init__(self, max_procs: Optional[int] = None):
+    if max_procs is None:
+      max_procs = _from_env("CYAN_MAX_PROCS", int, 0) or os.cpu_count()
+
+    self.max_procs: int = max(max_procs or 1, 1)
+    self.timeouts = dict(TIMEOUTS)
+    if (override := _from_env("CYAN_TOOL_TIMEOUT", float, None)) is not None:
+      self.timeouts = {k: override or None for k in self.timeouts}
+
+    self.stats: dict[str, dict[str, float]] = {}
+    self._slots = threading.BoundedSemaphore(self.max_procs)
+    self._lock = threading.Lock()
+
+  def timeout_for(self, tool: str) -> Optional[float]:
+    return self.timeouts.get(os.path.basename(tool))
+
+  def _record(self, tool: str, took: float, failed: bool) -> None:
+    name = os.path.basename(tool)
+    with self._lock:
+      s = self.stats.setdefault(
+        name, {"calls": 0, "failed": 0, "total": 0.0, "max": 0.0}
+      )
+      s["calls"] += 1
+      s["failed"] += failed
+      s["total"] += took
+      s["max"] = max(s["max"], took)
+
+  def run(
+      self, cmd: list[str], timeout: Optional[float] = _DEFAULT,
+      cancel: Optional[threading.Event] = None, **kwargs: Any
+  ) -> subprocess.CompletedProcess:  # type: ignore
+    """
+    like `subprocess.run()`, but waits for a free slot first.
+
+    a tool that times out is killed and reported with returncode -9,
+    so callers only ever have to check the returncode. so is one
+    that's still running when `cancel` is set.
+    """
+    if timeout is _DEFAULT:
+      timeout = self.timeout_for(cmd[0])
+
+    with self._slots:
+      start = time.perf_counter()
+      try:
+        if cancel is None:
+          proc = subprocess.run(cmd, timeout=timeout, **kwargs)
+        else:
+          proc = self._cancellable(cmd, timeout, cancel, **kwargs)
+      except subprocess.TimeoutExpired as e:
+        print(
+          f"[!] {os.path.basename(cmd[0])} timed out after {timeout}s",
+          file=sys.stderr
+        )
+        proc = subprocess.CompletedProcess(cmd, -9, e.stdout, e.stderr)
+      finally:
+        took = time.perf_counter() - start
+
+    self._record(cmd[0], took, proc.returncode != 0)
+    return proc
+
+  @staticmethod
+  def _cancellable(
+      cmd: list[str], timeout: Optional[float], cancel: threading.Event,
+      **kwargs: Any
+  ) -> subprocess.CompletedProcess:  # type: ignore
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with subprocess.Popen(cmd, **kwargs) as proc:
+      while True:
+        left = None if deadline is None else deadline - time.monotonic()
+        try:
+          out, err = proc.communicate(
+            timeout=0.1 if left is None else max(min(left, 0.1), 0)
+          )
+          break
+        except subprocess.TimeoutExpired:
+          if left is not None and left <= 0.1:
+            proc.kill()
+            out, err = proc.communicate()
+            raise subprocess.TimeoutExpired(cmd, timeout, out, err)
+          if cancel.is_set():
+            proc.kill()
+            out, err = proc.communicate()
+            return subprocess.CompletedProcess(cmd, -9, out, err)
+
+    return subprocess.CompletedProcess(cmd, proc.returncode, out, err)
+
+  def lines(
+      self, cmd: list[str], timeout: Optional[float] = _DEFAULT
+  ) -> Iterator[str]:
+    """
+    stdout line by line, without stderr.
+
+    the tool writes to a temporary file, which is read a line at a
+    time once it's done: output of any size never sits in memory,
+    and no slot is held while the caller is suspended (which could
+    deadlock nested calls, always with one slot). a tool that times
+    out raises `ToolError`, so it's never mistaken for one that said
+    nothing.
+    """
+    if timeout is _DEFAULT:
+      timeout = self.timeout_for(cmd[0])
+
+    with tempfile.TemporaryFile("w+") as out:
+      proc = self.run(cmd, timeout, stdout=out, stderr=subprocess.DEVNULL)
+      if proc.returncode == -9:
+        raise ToolError(
+          f"{os.path.basename(cmd[0])} timed out after {timeout}s"
+        )
+
+      out.seek(0)
+      yield from out
+
+  def summary(self) -> str:
+    with self._lock:
+      return "\n".join(
+        f"{name}: {s['calls']:.0f} call(s), {s['total']:.2f}s total, "
+        f"{s['max']:.2f}s max, {s['failed']:.0f} failed"
+        for name, s in sorted(self.stats.items())
+      )
+
+
+runner = ToolRunner()
@@ -0,0 +1,168 @@
+import os
+import stat
+import shutil
+import struct
+import threading
+from uuid import uuid4
+from typing import Collection, Optional
+
+try:
+  import fcntl
+except ImportError:  # not that windows is supported anyway
+  fcntl = None  # type: ignore
+
+# linux's ioctl for reflinks (btrfs, xfs, bcachefs, ..)
+FICLONE = 0x40049409
+
+# and for a file's extents, which says which of them are shared
+FS_IOC_FIEMAP = 0xc020660b
+FIEMAP_EXTENT_LAST = 0x1
+FIEMAP_EXTENT_SHARED = 0x2000
+
+
+class StageStats:
+  """bytes that were cloned, hardlinked or really copied."""
+
+  def __init__(self) -> None:
+    self.cloned = 0
+    self.linked = 0
+    self.copied = 0
+    self._lock = threading.Lock()
+
+  def add(self, kind: str, size: int) -> None:
+    with self._lock:
+      setattr(self, kind, getattr(self, kind) + size)
+
+  def __str__(self) -> str:
+    from cyan.tbhutils import human_size
+
+    return (
+      f"{human_size(self.copied)} copied, {human_size(self.cloned)} "
+      f"cloned, {human_size(self.linked)} hardlinked"
+    )
+
+
+# bytes copied to break hardlinks, for the whole process
+unshared = StageStats()
+
+
+def _reflink(src: str, dst: str) -> bool:
+  if fcntl is None:
+    return False
+
+  try:
+    with open(src, "rb") as s, open(dst, "wb") as d:
+      fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+  except OSError:
+    try:
+      os.remove(dst)
+    except FileNotFoundError:
+      pass
+    return False
+
+  shutil.copystat(src, dst)
+  return True
+
+
+def shared_bytes(path: str) -> Optional[int]:
+  """
+  how much of a file is in blocks shared with other files (it's a
+  reflink, or something was reflinked from it), None if that can't
+  be told on this filesystem.
+  """
+  if fcntl is None:
+    return None
+
+  shared = start = 0
+  try:
+    with open(path, "rb") as f:
+      while True:
+        # struct fiemap, then room for 32 struct fiemap_extent
+        buf = bytearray(
+          struct.pack("=QQIIII", start, (1 << 64) - 1 - start, 0, 0, 32, 0)
+          + bytes(56 * 32)
+        )
+        fcntl.ioctl(f.fileno(), FS_IOC_FIEMAP, buf)
+
+        mapped = struct.unpack_from("=I", buf, 20)[0]
+        if mapped == 0:
+          return shared
+        for ind in range(mapped):
+          logical, _, length, _, _, flags = struct.unpack_from(
+            "=5QI", buf, 32 + ind * 56
+          )
+          if flags & FIEMAP_EXTENT_SHARED:
+            shared += length
+          if flags & FIEMAP_EXTENT_LAST:
+            return shared
+        start = logical + length
+  except OSError:
+    return None
+
+
+def stage_file(
+    src: str, dst: str, stats: StageStats, links: bool = True
+) -> str:
+  """
+  copy a file without copying its data if possible.
+
+  tries a reflink first, then a hardlink (only if `links`),
+  then falls back to a real copy.
+  """
+  size = os.path.getsize(src)
+
+  if _reflink(src, dst):
+    stats.add("cloned", size)
+    return dst
+
+  if links:
+    try:
+      os.link(src, dst)
+      stats.add("linked", size)
+      return dst
+    except OSError:
+      pass  # other filesystem, or links aren't supported
+
+  shutil.copy2(src, dst)
+  stats.add("copied", size)
+  return dst
+
+
+def stage_tree(
+    src: str, dst: str, links: bool = True, skip: Collection[str] = ()
+) -> StageStats:
+  """
+  `shutil.copytree()`, but using `stage_file()` for every file.
+
+  `skip` are paths under `src` that aren't copied at all.
+  """
+  stats = StageStats()
+  shutil.copytree(
+    src, dst,
+    copy_function=lambda s, d: stage_file(s, d, stats, links),
+    ignore=lambda dp, names: [
+      n for n in names if os.path.join(dp, n) in skip
+    ] if skip else []
+  )
+  return stats
+
+
+def unshare(path: str) -> None:
+  """
+  give a hardlinked file its own copy before it's written to.
+
+  must be called before modifying anything that was staged,
+  otherwise the write also changes the original file.
+  """
+  try:
+    st = os.lstat(path)
+  except FileNotFoundError:
+    return
+
+  if not stat.S_ISREG(st.st_mode) or st.st_nlink < 2:
+    return
+
+  tmp = f"{path}.{uuid4().hex[:8]}"
+  shutil.copy2(path, tmp)
+  os.replace(tmp, path)
+  unshared.add("copied", st.st_size)
@@ -1,13 +1,13 @@
 from .app_bundle import AppBundle
 from .executable import Executable
-from .leaving_cm import LeavingCM
+from .macho import MachO
 from .main_executable import MainExecutable
 from .plist import Plist
 
 __all__ = [
   "AppBundle",
   "Executable",
-  "LeavingCM",
+  "MachO",
   "MainExecutable",
   "Plist"
 ]
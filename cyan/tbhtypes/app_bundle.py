@@ -3,11 +3,16 @@ import os
 import shutil
 from glob import glob
 from cyan.telegram_utils import send_telegram_message
-from uuid import uuid4
-from typing import Optional, Literal
+from typing import Any, Optional, Literal
 import logging
+import contextlib
+import subprocess
 import concurrent.futures
 
+import cyan.icons
+import cyan.plugins
+from cyan import tbhutils
+from . import macho
 from .executable import Executable
 from .main_executable import MainExecutable
 from .plist import Plist
@@ -50,31 +55,61 @@ class AppBundle:
                     result.append(os.path.join(root, f))
         return result
 
-    def mass_operate(self, op: str, func: Literal["fakesign", "thin"]) -> None:
+    def get_bundles(self) -> list[str]:
+        """every .appex and .framework folder, their binaries are in them."""
+        result = []
+        for root, dirs, _ in os.walk(self.path):
+            for d in dirs:
+                if d.endswith((".appex", ".framework")):
+                    result.append(os.path.join(root, d))
+        return result
+
+    def mass_operate(
+        self, op: str, func: Literal["fakesign", "thin", "strip"], *args: Any
+    ) -> dict[str, Any]:
+        """call `func` on every binary, returns what it did by path."""
         if self.cached_executables is None:
-            self.cached_executables = self.get_executables()
+            self.cached_executables = (
+                self.get_executables() + self.get_bundles()
+            )
 
         logging.basicConfig(level=logging.INFO)
 
         def operate(ts):
             if ts.endswith(".dylib"):
-                return getattr(Executable(ts), func)()
+                return ts, getattr(Executable(ts), func)(*args)
             else:
-                pl = Plist(f"{ts}/Info.plist")
-                return getattr(Executable(f"{ts}/{pl['CFBundleExecutable']}"), func)()
+                # resource folders can be named like bundles, skip those
+                pl = Plist(f"{ts}/Info.plist", throw=False)
+                if not pl.success or pl["CFBundleExecutable"] is None:
+                    return None, False
+                path = f"{ts}/{pl['CFBundleExecutable']}"
+                if not os.path.isfile(path):
+                    return None, False
+                return path, getattr(Executable(path), func)(*args)
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = list(executor.map(operate, self.cached_executables))
-        count = 1 if getattr(self.executable, func)() else 0
-        count += sum(1 for r in results if r)
+        # threads just wait on tools, so match the runner's process limit
+        with concurrent.futures.ThreadPoolExecutor(
+            Executable.runner.max_procs
+        ) as executor:
+            results = dict(executor.map(
+                tbhutils.in_context(operate), self.cached_executables
+            ))
+        results.pop(None, None)
+        results[self.executable.path] = getattr(self.executable, func)(*args)
+        count = sum(1 for r in results.values() if r)
         logging.info(f"[*] {op} {count} item(s)")
+        return results
 
     def remove_plugins(self, plugins: list[str]) -> None:
+        # matched like --remove-plugins, see cyan/plugins.py
         logging.basicConfig(level=logging.INFO)
-        removed = []
-        for plugin in plugins:
-            if self.remove(plugin):
-                removed.append(plugin)
+        found = [
+            e | {"path": os.path.relpath(e["path"], self.path)}
+            for e in self.scan_extensions()
+        ]
+        chosen, _ = cyan.plugins.select(found, plugins)
+        removed = [p["name"] for p in chosen if self.remove(p["path"])]
         if removed:
             logging.info(f"[*] removed plugins: {', '.join(removed)}")
             send_telegram_message(f"🔌 Plugins removed: {', '.join(removed)}")
@@ -111,62 +146,165 @@ class AppBundle:
         self.mass_operate("thinned", "thin")
         send_telegram_message("📦 All executables thinned! ✅")
 
+    def strip_all(self, keep_locals: bool = False) -> int:
+        """strip every binary, printing what each one shrank by."""
+        results = self.mass_operate("stripped", "strip", keep_locals)
+        saved = sorted(
+            ((n, path) for path, n in results.items() if n), reverse=True
+        )
+        h = tbhutils.human_size
+        for n, path in saved:
+            print(f"[*] stripped {os.path.relpath(path, self.path)}: -{h(n)}")
+
+        total = sum(n for n, _ in saved)
+        if total == 0:
+            print("[?] nothing to strip")
+        else:
+            print(f"[*] stripping saved {h(total)} in {len(saved)} binaries")
+        return total
+
     def remove_all_extensions(self) -> None:
         if self.remove("Extensions", "PlugIns"):
             print("[*] removed app extensions")
         else:
             print("[?] no app extensions")
 
-    def remove_encrypted_extensions(self) -> None:
-        removed: list[str] = []
-        for plugin in glob(f"{self.path}/*/*.appex"):
-            bundle = AppBundle(plugin)
-            if bundle.executable.is_encrypted():
-                self.remove(plugin)
-                removed.append(bundle.executable.bn)
-        if len(removed) == 0:
-            print("[?] no encrypted plugins")
-        else:
-            print("[*] removed encrypted plugins:", ", ".join(removed))
+    def scan_extensions(self) -> list[dict[str, Any]]:
+        """
+        Check every extension's binary for encryption, in parallel.
 
-    def change_icon(self, path: str, tmpdir: str) -> None:
-        try:
-            from PIL import Image  # type: ignore
-        except Exception:
-            return print("[?] pillow is not installed, -k is not available")
+        Only Info.plist and the encryption load command are read,
+        no AppBundle or tool process is created per extension.
+        """
+        def scan(plugin: str) -> dict[str, Any]:
+            pl = Plist(f"{plugin}/Info.plist", throw=False)
+            name = pl["CFBundleExecutable"] if pl.success else None
+            if name is None:
+                name = os.path.basename(plugin)[:-6]
 
-        tmpath = f"{tmpdir}/icon.png"
-        if not path.endswith(".png"):
-            with Image.open(path) as img:
-                img.save(tmpath, "PNG")
-        else:
-            shutil.copyfile(path, tmpath)
+            exe = f"{plugin}/{name}"
+            try:
+                encrypted = macho.is_encrypted(exe)
+            except OSError:
+                encrypted = False  # no binary, nothing to decrypt
 
-        uid = f"cyan_{uuid4().hex[:7]}a"  # can't have it end with a num
-        i60 = f"{uid}60x60"
-        i76 = f"{uid}76x76"
+            bundle_id = pl["CFBundleIdentifier"] if pl.success else None
+            return {
+                "name": name,
+                "path": plugin,
+                "bundle_id": bundle_id,
+                "encrypted": encrypted,
+                "size": tbhutils.get_size(plugin)
+            }
 
-        with Image.open(tmpath) as img:
-            img.resize((120, 120)).save(f"{self.path}/{i60}@2x.png", "PNG")
-            img.resize((152, 152)).save(f"{self.path}/{i76}@2x~ipad.png", "PNG")
+        plugins = sorted(glob(f"{self.path}/*/*.appex"))
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            return list(executor.map(scan, plugins))
 
-        if "CFBundleIcons" not in self.plist:
-            self.plist["CFBundleIcons"] = {}
-        if "CFBundleIcons~ipad" not in self.plist:
-            self.plist["CFBundleIcons~ipad"] = {}
+    def remove_encrypted_extensions(self) -> list[dict[str, Any]]:
+        report = [e for e in self.scan_extensions() if e["encrypted"]]
+        if len(report) == 0:
+            print("[?] no encrypted plugins")
+            return report
 
-        self.plist["CFBundleIcons"] = self.plist["CFBundleIcons"] | {
-            "CFBundlePrimaryIcon": {
-                "CFBundleIconFiles": [i60],
-                "CFBundleIconName": uid
-            }
-        }
-        self.plist["CFBundleIcons~ipad"] = self.plist["CFBundleIcons~ipad"] | {
-            "CFBundlePrimaryIcon": {
-                "CFBundleIconFiles": [i60, i76],
-                "CFBundleIconName": uid
+        for ext in report:
+            self.remove(ext["path"])
+
+        total = tbhutils.human_size(sum(e["size"] for e in report))
+        print(
+            f"[*] removed {len(report)} encrypted plugin(s), {total}:",
+            ", ".join(
+                f"{e['name']} ({tbhutils.human_size(e['size'])})"
+                for e in report
+            )
+        )
+        return report
+
+    def dedup_frameworks(self) -> int:
+        """
+        Replace byte-identical copies of a framework inside extensions
+        with one copy in the main app's Frameworks, returns bytes saved.
+
+        Extensions get an rpath to the main app's Frameworks if needed.
+        """
+        copies = sorted(glob(f"{self.path}/*/*.appex/Frameworks/*.framework"))
+        if len(copies) == 0:
+            print("[?] no frameworks in app extensions")
+            return 0
+
+        # one pool for every file of every tree, hash_tree() fans out
+        # on it, so the trees are walked one after another
+        shared_dir = f"{self.path}/Frameworks"
+        shared: dict[str, str] = {}  # name -> hash of the shared copy
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            digests = {
+                c: tbhutils.hash_tree(c, executor) for c in copies
             }
-        }
+            for name in {os.path.basename(c) for c in copies}:
+                if os.path.isdir(f"{shared_dir}/{name}"):
+                    shared[name] = tbhutils.hash_tree(
+                        f"{shared_dir}/{name}", executor
+                    )
+
+        saved = 0
+        changed: set[str] = set()  # appexes that now need the rpath
+        for copy in copies:
+            name = os.path.basename(copy)
+            appex = os.path.dirname(os.path.dirname(copy))
+
+            if name not in shared:
+                # only worth sharing if another extension has the same
+                if sum(
+                    1 for c in copies
+                    if os.path.basename(c) == name
+                    and digests[c] == digests[copy]
+                ) < 2:
+                    continue
+
+                os.makedirs(shared_dir, exist_ok=True)
+                shutil.move(copy, f"{shared_dir}/{name}")
+                shared[name] = digests[copy]
+            elif shared[name] == digests[copy]:
+                saved += tbhutils.get_size(copy)
+                shutil.rmtree(copy)
+            else:
+                continue  # another version, both are needed
+
+            changed.add(appex)
+            with contextlib.suppress(OSError):
+                os.rmdir(os.path.dirname(copy))  # only if it's empty
+
+        for appex in sorted(changed):
+            pl = Plist(f"{appex}/Info.plist", throw=False)
+            exe = f"{appex}/{pl['CFBundleExecutable']}" if pl.success else ""
+            if not os.path.isfile(exe):
+                continue
+
+            e = Executable(exe)
+            if "@executable_path/../../Frameworks" not in e.info.rpaths:
+                e.edit(
+                    e.nt, "-add_rpath", "@executable_path/../../Frameworks",
+                    exe, stderr=subprocess.DEVNULL
+                )
+
+        self.cached_executables = None
+        if len(changed) == 0:
+            print("[?] no duplicate frameworks in app extensions")
+        else:
+            print(
+                f"[*] shared frameworks of {len(changed)} extension(s), "
+                f"saved {tbhutils.human_size(saved)}"
+            )
+        return saved
+
+    def change_icon(self, path: str, links: bool = False) -> None:
+        try:
+            icons = cyan.icons.install(path, self.path, links)
+        except ImportError:
+            return print("[?] pillow is not installed, -k is not available")
+
+        for key, value in icons.items():
+            self.plist[key] = (self.plist[key] or {}) | value
 
         self.plist.save()
-        print("[*] updated app icon")
\ No newline at end of file
+        print("[*] updated app icon")
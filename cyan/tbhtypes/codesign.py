@@ -0,0 +1,508 @@
+"""
+ad-hoc code signing without ldid.
+
+writes an ad-hoc signature with the same blobs ldid's
+`-S<entitlements> -M -Cadhoc -Q<requirements>` writes (code
+directory, requirements, xml and der entitlements), hashing pages on
+every core over an mmap. it's not byte for byte what ldid would
+write: it always has a sha1 code directory with a sha256 alternate,
+whatever ldid would have picked for the binary. fakesigning signs the
+same way, so it's ad-hoc with cyan's empty requirements too, unlike
+the plain `ldid -S -M` it falls back to.
+
+anything it doesn't know how to lay out, `sign()` says so by
+returning False, so the caller can hand the file to ldid instead.
+"""
+
+import io
+import os
+import mmap
+import shutil
+import struct
+import hashlib
+import plistlib
+import contextlib
+import threading
+import concurrent.futures
+from typing import Any, Optional
+
+from .macho import (
+  FAT_MAGIC, FAT_MAGIC_64, MH_MAGIC, MH_MAGIC_64, LC_SEGMENT,
+  LC_SEGMENT_64, LC_CODE_SIGNATURE, CSMAGIC_EMBEDDED_SIGNATURE,
+  CSMAGIC_EMBEDDED_ENTITLEMENTS, CSMAGIC_EMBEDDED_DER_ENTITLEMENTS,
+  CSSLOT_ENTITLEMENTS, CSSLOT_DER_ENTITLEMENTS, MachO, Slice,
+  parse_superblob, read_slice
+)
+
+CSMAGIC_CODEDIRECTORY = 0xfade0c02
+CSMAGIC_REQUIREMENTS = 0xfade0c01
+CSSLOT_CODEDIRECTORY = 0
+CSSLOT_REQUIREMENTS = 2
+CSSLOT_ALTERNATE_CODEDIRECTORIES = 0x1000
+CS_ADHOC = 0x2
+CS_EXECSEG_MAIN_BINARY = 0x1
+MH_EXECUTE = 0x2
+
+CD_VERSION = 0x20400  # has the exec segment fields
+CD_SIZE = 88
+PAGE_SHIFT = 12
+PAGE_SIZE = 1 << PAGE_SHIFT
+
+# (hash type, digest size, function), in the order they're written:
+# the first one is the code directory, the rest are alternates
+HASHES = ((1, 20, hashlib.sha1), (2, 32, hashlib.sha256))
+
+# entitlements that set exec segment flags, like the kernel expects
+EXECSEG_FLAGS = {
+  "get-task-allow": 0x10,
+  "run-unsigned-code": 0x10,
+  "com.apple.private.cs.debugger": 0x20,
+  "dynamic-codesigning": 0x40,
+  "com.apple.private.skip-library-validation": 0x80,
+  "com.apple.private.amfi.can-load-cdhash": 0x100,
+  "com.apple.private.amfi.can-execute-cdhash": 0x200
+}
+
+# pages hashed per task, small enough to spread a binary over every core
+CHUNK_PAGES = 256
+
+# shared, so signing many binaries at once doesn't start a pool for each
+_pool: Optional[concurrent.futures.ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def enabled() -> bool:
+  """`$CYAN_USE_LDID` sends everything to ldid, like before."""
+  return not os.environ.get("CYAN_USE_LDID")
+
+
+def _executor() -> concurrent.futures.ThreadPoolExecutor:
+  global _pool
+  with _pool_lock:
+    if _pool is None:
+      _pool = concurrent.futures.ThreadPoolExecutor(
+        thread_name_prefix="cyan-codesign"
+      )
+    return _pool
+
+
+def _align(n: int, to: int) -> int:
+  return (n + to - 1) // to * to
+
+
+def _blob(magic: int, data: bytes) -> bytes:
+  return struct.pack(">II", magic, 8 + len(data)) + data
+
+
+def _der_length(n: int) -> bytes:
+  if n < 0x80:
+    return bytes([n])
+  raw = n.to_bytes((n.bit_length() + 7) // 8, "big")
+  return bytes([0x80 | len(raw)]) + raw
+
+
+def _der(tag: int, data: bytes) -> bytes:
+  return bytes([tag]) + _der_length(len(data)) + data
+
+
+def der_entitlements(value: Any) -> bytes:
+  """
+  entitlements in the der form ldid embeds next to the xml.
+
+  raises `ValueError` for types der entitlements can't hold.
+  """
+  if isinstance(value, bool):  # before int, bools are ints too
+    return _der(0x01, b"\x01" if value else b"\x00")
+  if isinstance(value, int):
+    size = (value + (value < 0)).bit_length() // 8 + 1
+    return _der(0x02, value.to_bytes(size, "big", signed=True))
+  if isinstance(value, str):
+    return _der(0x0c, value.encode())
+  if isinstance(value, list):
+    return _der(0x30, b"".join(der_entitlements(v) for v in value))
+  if isinstance(value, dict):
+    # a der set is sorted by its members' encodings
+    return _der(0x31, b"".join(sorted(
+      _der(0x30, der_entitlements(str(k)) + der_entitlements(v))
+      for k, v in value.items()
+    )))
+
+  raise ValueError(f"can't encode {type(value).__name__} entitlements")
+
+
+class _Layout:
+  """where a slice's signature goes, and the header that points to it."""
+
+  def __init__(self, raw: bytes, offset: int, size: int, align: int):
+    self.offset = offset  # of the original slice
+    self.size = size
+    self.align = align
+
+    sl = read_slice(io.BytesIO(raw), 0, len(raw))
+    if sl is None:
+      raise ValueError("not a mach-o slice")
+
+    is64 = sl.is64
+    hsize = 32 if is64 else 28
+    ncmds, sizeofcmds = struct.unpack_from("<II", raw, 16)
+    self.is_main = sl.filetype == MH_EXECUTE
+    self.header = bytearray(raw[:hsize + sizeofcmds])
+
+    seg = "<16sQQQQ" if is64 else "<16sIIII"
+    sect, sect_offset = (80, 48) if is64 else (68, 40)
+    linkedit = text = None
+    first_section = size
+    for cmd, pos, cmd_raw in sl.commands:
+      if cmd not in (LC_SEGMENT, LC_SEGMENT_64):
+        continue
+
+      name, _, _, fileoff, filesize = struct.unpack_from(seg, cmd_raw, 8)
+      name = name.rstrip(b"\0")
+      if name == b"__LINKEDIT":
+        linkedit = (pos, fileoff, filesize)
+      elif name == b"__TEXT":
+        text = (fileoff, filesize)
+
+      base = 72 if is64 else 56
+      nsects = struct.unpack_from("<I", cmd_raw, base - 8)[0]
+      for ind in range(nsects):
+        at = base + ind * sect + sect_offset
+        if at + 4 <= len(cmd_raw):
+          off = struct.unpack_from("<I", cmd_raw, at)[0]
+          if off != 0:
+            first_section = min(first_section, off)
+
+    if linkedit is None or text is None:
+      raise ValueError("no __LINKEDIT or __TEXT")
+
+    self.linkedit_pos, self.linkedit_off, _ = linkedit
+    self.text = text
+    self.is64 = is64
+
+    if (cs := sl.find(LC_CODE_SIGNATURE)):
+      self.cs_pos = cs[0][1]
+      end = min(sl.code_signature[0], size)  # type: ignore
+    else:
+      # no signature yet, so there has to be room for the command
+      if hsize + sizeofcmds + 16 > first_section:
+        raise ValueError("no room for LC_CODE_SIGNATURE")
+      if linkedit[1] + linkedit[2] != size:
+        raise ValueError("__LINKEDIT isn't at the end of the slice")
+
+      self.cs_pos = hsize + sizeofcmds
+      self.header += struct.pack("<IIII", LC_CODE_SIGNATURE, 16, 0, 0)
+      struct.pack_into("<II", self.header, 16, ncmds + 1, sizeofcmds + 16)
+      end = size
+
+    self.data_end = end  # everything before the old signature
+    self.code_limit = _align(end, 16)
+    self.sig_size = 0
+
+  @property
+  def new_size(self) -> int:
+    return self.code_limit + self.sig_size
+
+  def finish_header(self) -> bytes:
+    struct.pack_into(
+      "<II", self.header, self.cs_pos + 8, self.code_limit, self.sig_size
+    )
+
+    filesize = self.new_size - self.linkedit_off
+    vmsize = _align(filesize, 0x4000)
+    if self.is64:
+      struct.pack_into("<Q", self.header, self.linkedit_pos + 32, vmsize)
+      struct.pack_into("<Q", self.header, self.linkedit_pos + 48, filesize)
+    else:
+      struct.pack_into("<I", self.header, self.linkedit_pos + 28, vmsize)
+      struct.pack_into("<I", self.header, self.linkedit_pos + 36, filesize)
+
+    return bytes(self.header)
+
+
+def _hash_pages(
+    view: memoryview, start: int, end: int
+) -> tuple[bytes, ...]:
+  """every hash type's digests of the pages in [start, end)."""
+  out: list[list[bytes]] = [[] for _ in HASHES]
+  for off in range(start, end, PAGE_SIZE):
+    page = view[off:min(off + PAGE_SIZE, end)]
+    for ind, (_, _, func) in enumerate(HASHES):
+      out[ind].append(func(page).digest())
+    page.release()
+
+  return tuple(b"".join(h) for h in out)
+
+
+def _code_directory(
+    hash_type: int, hash_size: int, ident: bytes, special: list[bytes],
+    code: bytes, layout: _Layout, exec_flags: int
+) -> bytes:
+  nspecial = len(special)
+  ncode = len(code) // hash_size
+  ident_off = CD_SIZE
+  hash_off = ident_off + len(ident) + nspecial * hash_size
+  length = hash_off + len(code)
+
+  head = struct.pack(
+    ">IIIIIIIIIBBBBIIIIQQQQ",
+    CSMAGIC_CODEDIRECTORY, length, CD_VERSION, CS_ADHOC, hash_off,
+    ident_off, nspecial, ncode, layout.code_limit, hash_size, hash_type,
+    0, PAGE_SHIFT, 0, 0, 0, 0, 0, layout.text[0], layout.text[1],
+    exec_flags
+  )
+  return head + ident + b"".join(reversed(special)) + code
+
+
+def write_signatures(
+    dst: mmap.mmap, layouts: list[_Layout], starts: list[int],
+    ident: bytes, requirements: bytes, ent_blobs: dict[int, bytes],
+    special_count: int, exec_flags: int
+) -> None:
+  """hash every slice's pages in parallel, then write their signatures."""
+  tasks = [
+    (ind, off, min(off + CHUNK_PAGES * PAGE_SIZE, lay.code_limit))
+    for ind, lay in enumerate(layouts)
+    for off in range(0, lay.code_limit, CHUNK_PAGES * PAGE_SIZE)
+  ]
+
+  with memoryview(dst) as view:
+    # hashlib lets go of the gil for pages this big
+    digests = list(_executor().map(
+      lambda t: _hash_pages(view, starts[t[0]] + t[1], starts[t[0]] + t[2]),
+      tasks
+    ))
+
+    for ind, (lay, start) in enumerate(zip(layouts, starts)):
+      parts = [d for t, d in zip(tasks, digests) if t[0] == ind]
+      blobs = {CSSLOT_REQUIREMENTS: requirements, **ent_blobs}
+
+      cds = []
+      for hind, (htype, hsize, func) in enumerate(HASHES):
+        special = [bytes(hsize)] * special_count
+        for slot, blob in blobs.items():
+          special[slot - 1] = func(blob).digest()
+
+        cds.append(_code_directory(
+          htype, hsize, ident, special,
+          b"".join(p[hind] for p in parts), lay,
+          exec_flags | (CS_EXECSEG_MAIN_BINARY if lay.is_main else 0)
+        ))
+
+      slots = [(CSSLOT_CODEDIRECTORY, cds[0]), *sorted(blobs.items())]
+      slots += [
+        (CSSLOT_ALTERNATE_CODEDIRECTORIES + ind, cd)
+        for ind, cd in enumerate(cds[1:])
+      ]
+
+      offset = 12 + 8 * len(slots)
+      index = b""
+      for slot, blob in slots:
+        index += struct.pack(">II", slot, offset)
+        offset += len(blob)
+
+      superblob = struct.pack(
+        ">III", CSMAGIC_EMBEDDED_SIGNATURE, offset, len(slots)
+      ) + index + b"".join(blob for _, blob in slots)
+      if len(superblob) > lay.sig_size:
+        raise ValueError("code signature is bigger than its space")
+
+      at = start + lay.code_limit
+      view[at:at + len(superblob)] = superblob
+
+
+def sign(
+    path: str, requirements: bytes,
+    entitlements: Optional[dict[str, Any]] = None,
+    identifier: Optional[str] = None
+) -> bool:
+  """
+  ad-hoc sign every slice of `path`, keeping its entitlements and
+  merging `entitlements` over them.
+
+  returns False, without touching the file, if it's laid out in a way
+  only ldid handles (no room for the load command, and such).
+  """
+  info = MachO.load(path)
+  if not info.valid:
+    return False
+
+  current: dict[str, Any] = {}
+  if info.entitlements:
+    try:
+      current = plistlib.loads(info.entitlements)
+    except Exception:
+      return False
+  merged = current | (entitlements or {})
+
+  ent_blobs: dict[int, bytes] = {}
+  if len(merged) != 0:
+    try:
+      der = der_entitlements(merged)
+    except ValueError:
+      return False
+    ent_blobs[CSSLOT_ENTITLEMENTS] = _blob(
+      CSMAGIC_EMBEDDED_ENTITLEMENTS,
+      plistlib.dumps(merged, sort_keys=False)
+    )
+    ent_blobs[CSSLOT_DER_ENTITLEMENTS] = _blob(
+      CSMAGIC_EMBEDDED_DER_ENTITLEMENTS, der
+    )
+
+  exec_flags = 0
+  for key, flag in EXECSEG_FLAGS.items():
+    if merged.get(key) is True:
+      exec_flags |= flag
+
+  ident = (identifier or os.path.basename(path)).encode() + b"\0"
+  special_count = max([CSSLOT_REQUIREMENTS, *ent_blobs])
+
+  with open(path, "rb") as f:
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as src:
+      head = src[:8]
+      fat_magic = struct.unpack(">I", head[:4])[0]
+      fat = fat_magic in (FAT_MAGIC, FAT_MAGIC_64)
+
+      if fat:
+        entry = ">iiQQII" if fat_magic == FAT_MAGIC_64 else ">iiIII"
+        esize = struct.calcsize(entry)
+        nfat = struct.unpack(">I", head[4:])[0]
+        arches = [
+          struct.unpack_from(entry, src, 8 + ind * esize)
+          for ind in range(nfat)
+        ]
+      elif struct.unpack("<I", head[:4])[0] in (MH_MAGIC, MH_MAGIC_64):
+        cputype, cpusubtype = struct.unpack_from("<ii", src, 4)
+        arches = [(cputype, cpusubtype, 0, len(src), 0)]
+      else:
+        return False
+
+      try:
+        layouts = [
+          _Layout(src[off:off + min(size, 1 << 20)], off, size, align)
+          for _, _, off, size, align, *_ in arches
+        ]
+      except (ValueError, struct.error):
+        return False
+
+      # the size of a signature only depends on the number of pages,
+      # this is ldid's estimate, so both leave the same padding
+      for lay in layouts:
+        alloc = 12 + 8 + len(requirements) + sum(
+          8 + len(b) for b in ent_blobs.values()
+        )
+        pages = (lay.code_limit + PAGE_SIZE - 1) // PAGE_SIZE
+        for _, size, _ in HASHES:
+          alloc = _align(
+            alloc + 8 + CD_SIZE + len(ident)
+            + (special_count + pages) * size, 16
+          )
+        lay.sig_size = alloc
+
+      # new slice offsets, keeping each one's alignment
+      pos = 8 + len(arches) * esize if fat else 0
+      starts = []
+      for lay in layouts:
+        pos = _align(pos, 1 << lay.align) if fat else pos
+        starts.append(pos)
+        pos += lay.new_size
+      total = pos
+
+      tmp = f"{path}.cyan-sign"
+      try:
+        with open(tmp, "wb") as out:
+          out.truncate(total)  # gaps and padding are zeros
+          if fat:
+            out.write(head)
+            for arch, lay, start in zip(arches, layouts, starts):
+              out.write(struct.pack(
+                entry, arch[0], arch[1], start, lay.new_size, *arch[4:]
+              ))
+
+          with memoryview(src) as view:
+            for lay, start in zip(layouts, starts):
+              header = lay.finish_header()
+              out.seek(start)
+              out.write(header)
+              # an added load command goes over padding, nothing shifts
+              with view[
+                lay.offset + len(header):lay.offset + lay.data_end
+              ] as body:
+                out.write(body)
+
+        shutil.copymode(path, tmp)
+        with open(tmp, "r+b") as out:
+          with mmap.mmap(out.fileno(), 0) as dst:
+            write_signatures(
+              dst, layouts, starts, ident, requirements, ent_blobs,
+              special_count, exec_flags
+            )
+
+        os.replace(tmp, path)
+      except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+          os.remove(tmp)
+        raise
+
+  MachO.invalidate(path)
+  return True
+
+
+# every hash type a code directory may use, digests are cut to its size
+HASH_FUNCS = {
+  1: hashlib.sha1, 2: hashlib.sha256, 3: hashlib.sha256, 4: hashlib.sha384
+}
+
+
+def check(data: bytes, sl: Slice) -> Optional[str]:
+  """
+  whether the signature of slice `sl` (of the binary in `data`) still
+  matches it: every code directory's page hashes, and the hashes of
+  the requirements and entitlements. returns what's wrong, if anything.
+
+  the Info.plist and resource hashes are left alone, ad-hoc signatures
+  usually don't have them.
+  """
+  if (cs := sl.code_signature) is None:
+    return "not signed"
+
+  start = sl.offset + cs[0]
+  blobs = parse_superblob(data[start:start + cs[1]])
+  cds = [
+    blob for slot, blob in sorted(blobs.items())
+    if slot == CSSLOT_CODEDIRECTORY
+    or CSSLOT_ALTERNATE_CODEDIRECTORIES <= slot < 0x2000
+  ]
+  if len(cds) == 0:
+    return "no code directory"
+
+  with memoryview(data) as view:
+    for cd in cds:
+      magic = struct.unpack_from(">I", cd)[0] if len(cd) >= 40 else 0
+      if magic != CSMAGIC_CODEDIRECTORY:
+        return "bad code directory"
+
+      (
+        hash_off, _, nspecial, ncode, limit, hsize, htype, _, shift
+      ) = struct.unpack_from(">IIIIIBBBB", cd, 16)
+      if (func := HASH_FUNCS.get(htype)) is None:
+        continue  # nothing to compare with
+
+      for slot in (CSSLOT_REQUIREMENTS, CSSLOT_ENTITLEMENTS,
+                   CSSLOT_DER_ENTITLEMENTS):
+        if slot > nspecial or slot not in blobs:
+          continue
+        at = hash_off - slot * hsize
+        if func(blobs[slot]).digest()[:hsize] != cd[at:at + hsize]:
+          return f"hash of blob {slot} doesn't match"
+
+      page = 1 << shift if shift else limit
+      end = sl.offset + limit
+      for ind in range(ncode):
+        off = sl.offset + ind * page
+        with view[off:min(off + page, end)] as chunk:
+          digest = func(chunk).digest()[:hsize]
+        at = hash_off + ind * hsize
+        if digest != cd[at:at + hsize]:
+          return f"page {ind} doesn't match its hash"
+
+  return None
@@ -1,8 +1,14 @@
 import os
-import sys
+import struct
+import plistlib
 import subprocess
+from typing import Any, Callable, Optional
 
-from cyan import tbhutils
+from cyan import staging, tbhutils
+from cyan.errors import InvalidAppError
+from cyan.runner import runner
+from . import codesign, strip
+from .macho import MachO
 
 
 class Executable:
@@ -12,11 +18,15 @@ class Executable:
   lipo = f"{specific}/lipo"
   otool = f"{specific}/otool"
   idylib = f"{specific}/insert_dylib"
+  requirements = f"{install_dir}/extras/zero.requirements"
+
+  # every tool call goes through this, see `cyan/runner.py`
+  runner = runner
 
   # adding /usr/lib/ now, idk why i didnt before. lets hope nothing breaks
   ## LITERALLY 2 DAYS LATER. WHAT THE FUCK IS @LOADER_PATH HELP
   ## i will cry if only checking for '@' will break this.
-  starters = ("\t/Library/", "\t/usr/lib/", "\t@")
+  starters = ("/Library/", "/usr/lib/", "@")
 
   # substrate could show up as
   # CydiaSubstrate.framework, libsubstrate.dylib, EVEN CydiaSubstrate.dylib
@@ -46,8 +56,8 @@ class Executable:
 
   def __init__(self, path: str):
     if not os.path.isfile(path):
-      print(f"[!] {path} does not exist (executable)", file=sys.stderr)
-      sys.exit(
+      raise InvalidAppError(
+        f"{path} does not exist (executable)\n"
         "[?] check the wiki for info: "
         "https://github.com/asdfzxcvbn/pyzule-rw/wiki/"
         "file-does-not-exist-(executable)-%3F"
@@ -56,33 +66,87 @@ class Executable:
     self.path = path
     self.bn = os.path.basename(path)
 
+  @property
+  def info(self) -> MachO:
+    # shared and cached, so asking twice doesn't read the file twice
+    return MachO.get(self.path)
+
+  def edit(
+      self, *cmd: str, **kwargs: Any
+  ) -> subprocess.CompletedProcess:  # type: ignore
+    """run a tool that modifies this binary, dropping the cached info."""
+    staging.unshare(self.path)
+    try:
+      return self.runner.run(list(cmd), **kwargs)
+    finally:
+      MachO.invalidate(self.path)
+
   def is_encrypted(self) -> bool:
-    proc = subprocess.run(
-      [self.otool, "-l", self.path],
-      capture_output=True
-    )
+    return self.info.encrypted
 
-    return b"cryptid 1" in proc.stdout
+  def get_entitlements(self) -> dict[str, Any]:
+    try:
+      return plistlib.loads(self.info.entitlements)
+    except Exception:
+      return {}  # unsigned, or no entitlements
 
   def remove_signature(self) -> None:
-    subprocess.run([self.ldid, "-R", self.path], stderr=subprocess.DEVNULL)
+    if self.info.signed:
+      self.edit(self.ldid, "-R", self.path, stderr=subprocess.DEVNULL)
+
+  def sign(self, entitlements: Optional[dict[str, Any]] = None) -> bool:
+    """
+    ad-hoc sign in-process (see `codesign.py`), merging `entitlements`.
+
+    False if it has to be left to ldid.
+    """
+    if not codesign.enabled():
+      return False
+
+    with open(self.requirements, "rb") as f:
+      requirements = f.read()
+
+    try:
+      # a new file replaces this one, so hardlinks are left alone
+      return codesign.sign(self.path, requirements, entitlements)
+    except (ValueError, struct.error):
+      return False  # let ldid complain about it
+    finally:
+      MachO.invalidate(self.path)
 
   def fakesign(self) -> bool:
-    return subprocess.run([self.ldid, "-S", "-M", self.path]).returncode == 0
+    if self.sign():
+      return True
+    return self.edit(self.ldid, "-S", "-M", self.path).returncode == 0
 
   def thin(self) -> bool:
-    return subprocess.run(
-      [self.lipo, "-thin", "arm64", self.path, "-output", self.path],
+    return self.edit(
+      self.lipo, "-thin", "arm64", self.path, "-output", self.path,
       stderr=subprocess.DEVNULL
     ).returncode == 0
 
+  def strip(self, keep_locals: bool = False) -> int:
+    """
+    strip debug (and local) symbols in-process, see `strip.py`.
+    returns the bytes saved.
+    """
+    try:
+      # a new file replaces this one, so hardlinks are left alone
+      return strip.strip(self.path, keep_locals)
+    except (OSError, ValueError, struct.error):
+      return 0
+    finally:
+      MachO.invalidate(self.path)
+
   def change_dependency(self, old: str, new: str) -> None:
-    subprocess.run(
-      [self.nt, "-change", old, new, self.path],
+    self.edit(
+      self.nt, "-change", old, new, self.path,
       stderr=subprocess.DEVNULL
     )
 
-  def fix_common_dependencies(self, needed: set[str]) -> None:
+  def fix_common_dependencies(
+      self, needed: set[str], log: Callable[[str], Any] = print
+  ) -> None:
     self.remove_signature()
 
     for dep in self.get_dependencies():
@@ -92,12 +156,14 @@ class Executable:
 
           if dep != info["path"]:
             self.change_dependency(dep, info["path"])
-            print(
+            log(
               f"[*] fixed common dependency in {self.bn}: "
               f"{dep} -> {info['path']}"
             )
 
-  def fix_dependencies(self, tweaks: dict[str, str]) -> None:
+  def fix_dependencies(
+      self, tweaks: dict[str, str], log: Callable[[str], Any] = print
+  ) -> None:
     for dep in self.get_dependencies():
       for cname in tweaks:
         if cname in dep:
@@ -111,24 +177,11 @@ class Executable:
 
           if dep != npath:
             self.change_dependency(dep, npath)
-            print(f"[*] fixed dependency in {self.bn}: {dep} -> {npath}")
+            log(f"[*] fixed dependency in {self.bn}: {dep} -> {npath}")
 
   def get_dependencies(self) -> list[str]:
-    proc = subprocess.run(
-      [self.otool, "-L", self.path],
-      capture_output=True, text=True
-    )
-
-    # split at [2:] to avoid otool's line and dylib's id
-    tmp = proc.stdout.strip().split("\n")[2:]
-    for ind, dep in enumerate(tmp):
-      if "(architecture " in dep:  # avoid checking duplicate deps
-        tmp = tmp[:ind]
-
-    deps: list[str] = []
-    for dep in tmp:
-      if any(dep.startswith(s) for s in self.starters):
-        deps.append(dep.split()[0])  # split() removes whitespace
-
-    return deps
+    return [
+      dep for dep in self.info.dependencies
+      if dep.startswith(self.starters)
+    ]
 
@@ -0,0 +1,372 @@
+import os
+import struct
+import threading
+from collections import OrderedDict
+from typing import BinaryIO, Optional
+
+MH_MAGIC = 0xfeedface
+MH_MAGIC_64 = 0xfeedfacf
+FAT_MAGIC = 0xcafebabe
+FAT_MAGIC_64 = 0xcafebabf
+
+LC_REQ_DYLD = 0x80000000
+LC_SEGMENT = 0x1
+LC_SYMTAB = 0x2
+LC_DYSYMTAB = 0xb
+LC_LOAD_DYLIB = 0xc
+LC_ID_DYLIB = 0xd
+LC_SEGMENT_64 = 0x19
+LC_CODE_SIGNATURE = 0x1d
+LC_LAZY_LOAD_DYLIB = 0x20
+LC_ENCRYPTION_INFO = 0x21
+LC_ENCRYPTION_INFO_64 = 0x2c
+LC_LOAD_WEAK_DYLIB = 0x18 | LC_REQ_DYLD
+LC_RPATH = 0x1c | LC_REQ_DYLD
+LC_REEXPORT_DYLIB = 0x1f | LC_REQ_DYLD
+LC_LOAD_UPWARD_DYLIB = 0x23 | LC_REQ_DYLD
+
+# code signature blobs, all big endian
+CSMAGIC_EMBEDDED_SIGNATURE = 0xfade0cc0
+CSMAGIC_EMBEDDED_ENTITLEMENTS = 0xfade7171
+CSMAGIC_EMBEDDED_DER_ENTITLEMENTS = 0xfade7172
+CSSLOT_ENTITLEMENTS = 5
+CSSLOT_DER_ENTITLEMENTS = 7
+
+DYLIB_COMMANDS = (
+  LC_LOAD_DYLIB, LC_LOAD_WEAK_DYLIB, LC_REEXPORT_DYLIB,
+  LC_LAZY_LOAD_DYLIB, LC_LOAD_UPWARD_DYLIB
+)
+
+CPU_NAMES = {
+  (7, 3): "i386",
+  (12, 9): "armv7",
+  (12, 11): "armv7s",
+  (0x01000007, 3): "x86_64",
+  (0x0100000c, 0): "arm64",
+  (0x0100000c, 1): "arm64v8",
+  (0x0100000c, 2): "arm64e"
+}
+
+
+def arch_name(cputype: int, cpusubtype: int) -> str:
+  # the top byte of the subtype holds capability bits (arm64e ptrauth)
+  sub = cpusubtype & 0x00ffffff
+  return CPU_NAMES.get((cputype, sub), f"cpu{cputype}:{sub}")
+
+
+def _cstr(raw: bytes, offset: int) -> str:
+  return raw[offset:].split(b"\0", 1)[0].decode(errors="replace")
+
+
+class Slice:
+  """the header and load commands of one architecture."""
+
+  def __init__(
+      self, arch: str, offset: int, size: int, is64: bool,
+      filetype: int, commands: list[tuple[int, int, bytes]]
+  ):
+    self.arch = arch
+    self.offset = offset  # from the start of the file
+    self.size = size
+    self.is64 = is64
+    self.filetype = filetype
+
+    # (cmd, offset from the start of the slice, raw command)
+    self.commands = commands
+
+  def find(self, *cmds: int) -> list[tuple[int, int, bytes]]:
+    return [c for c in self.commands if c[0] in cmds]
+
+  @property
+  def dependencies(self) -> list[str]:
+    return [
+      _cstr(raw, struct.unpack_from("<I", raw, 8)[0])
+      for _, _, raw in self.find(*DYLIB_COMMANDS)
+    ]
+
+  @property
+  def rpaths(self) -> list[str]:
+    return [
+      _cstr(raw, struct.unpack_from("<I", raw, 8)[0])
+      for _, _, raw in self.find(LC_RPATH)
+    ]
+
+  @property
+  def cryptid(self) -> int:
+    for _, _, raw in self.find(LC_ENCRYPTION_INFO, LC_ENCRYPTION_INFO_64):
+      if len(raw) < 20:
+        break  # truncated, malformed like any other
+      return struct.unpack_from("<I", raw, 16)[0]
+    return 0
+
+  @property
+  def code_signature(self) -> Optional[tuple[int, int]]:
+    """(dataoff, datasize) of the signature, relative to the slice."""
+    for _, _, raw in self.find(LC_CODE_SIGNATURE):
+      return struct.unpack_from("<II", raw, 8)  # type: ignore
+    return None
+
+
+def parse_superblob(raw: bytes) -> dict[int, bytes]:
+  """slot type -> blob (header included) of an embedded signature."""
+  if len(raw) < 12:
+    return {}
+
+  magic, length, count = struct.unpack_from(">III", raw)
+  if magic != CSMAGIC_EMBEDDED_SIGNATURE:
+    return {}
+
+  blobs: dict[int, bytes] = {}
+  for ind in range(count):
+    if 12 + ind * 8 + 8 > len(raw):
+      break
+    slot, offset = struct.unpack_from(">II", raw, 12 + ind * 8)
+    if offset + 8 > len(raw):
+      continue
+    size = struct.unpack_from(">I", raw, offset + 4)[0]
+    blobs[slot] = raw[offset:offset + size]
+
+  return blobs
+
+
+def read_fat(
+    f: BinaryIO, size: Optional[int] = None
+) -> list[tuple[int, int, int, int]]:
+  """
+  (cputype, cpusubtype, offset, size) for every slice in the file.
+
+  pass `size` if it's known, seeking to the end of a compressed
+  zip member means inflating all of it.
+  """
+  f.seek(0)
+  head = f.read(8)
+  if len(head) < 8:
+    return []
+
+  magic, nfat = struct.unpack(">II", head)
+  if magic in (FAT_MAGIC, FAT_MAGIC_64):
+    # java classes share the magic, but never have this many "archs"
+    if nfat > 32:
+      return []
+
+    is64 = magic == FAT_MAGIC_64
+    entry = ">iiQQII" if is64 else ">iiIII"
+    raw = f.read(struct.calcsize(entry) * nfat)
+    return [
+      struct.unpack_from(entry, raw, ind * struct.calcsize(entry))[:4]
+      for ind in range(nfat)
+    ]
+
+  magic = struct.unpack("<I", head[:4])[0]
+  if magic not in (MH_MAGIC, MH_MAGIC_64):
+    return []
+
+  cputype, cpusubtype = struct.unpack("<ii", head[4:] + f.read(4))
+  if size is None:
+    size = f.seek(0, os.SEEK_END)
+  return [(cputype, cpusubtype, 0, size)]
+
+
+def read_slice(f: BinaryIO, offset: int, size: int) -> Optional[Slice]:
+  f.seek(offset)
+  head = f.read(28)
+  if len(head) < 28:
+    return None
+
+  magic, cputype, cpusubtype, filetype, ncmds, sizeofcmds = \
+    struct.unpack_from("<IiiIII", head)
+  if magic not in (MH_MAGIC, MH_MAGIC_64):
+    return None
+
+  is64 = magic == MH_MAGIC_64
+  if is64:
+    f.read(4)  # reserved
+
+  raw = f.read(sizeofcmds)
+  commands: list[tuple[int, int, bytes]] = []
+  pos = 0
+  base = 32 if is64 else 28
+  for _ in range(ncmds):
+    if pos + 8 > len(raw):
+      break
+    cmd, cmdsize = struct.unpack_from("<II", raw, pos)
+    if cmdsize < 8:
+      break
+    commands.append((cmd, base + pos, raw[pos:pos + cmdsize]))
+    pos += cmdsize
+
+  return Slice(
+    arch_name(cputype, cpusubtype), offset, size, is64, filetype, commands
+  )
+
+
+def is_macho(path: str) -> bool:
+  """only checks the magic, for sorting binaries out of other files."""
+  try:
+    with open(path, "rb") as f:
+      head = f.read(4)
+  except OSError:
+    return False
+
+  return len(head) == 4 and (
+    struct.unpack("<I", head)[0] in (MH_MAGIC, MH_MAGIC_64)
+    or struct.unpack(">I", head)[0] in (FAT_MAGIC, FAT_MAGIC_64)
+  )
+
+
+def is_encrypted(path: str) -> bool:
+  """
+  only looks for LC_ENCRYPTION_INFO, stopping as soon as it's found.
+
+  cheaper than a full `MachO` when that's the only question.
+  """
+  with open(path, "rb") as f:
+    for _, _, offset, _ in read_fat(f):
+      f.seek(offset)
+      head = f.read(32)
+      if len(head) < 28:
+        continue
+
+      magic, _, _, _, ncmds, sizeofcmds = struct.unpack_from("<IiiIII", head)
+      if magic not in (MH_MAGIC, MH_MAGIC_64):
+        continue
+
+      f.seek(offset + (32 if magic == MH_MAGIC_64 else 28))
+      raw = f.read(sizeofcmds)
+      pos = 0
+      for _ in range(ncmds):
+        if pos + 8 > len(raw):
+          break
+        cmd, cmdsize = struct.unpack_from("<II", raw, pos)
+        if cmd in (LC_ENCRYPTION_INFO, LC_ENCRYPTION_INFO_64):
+          if cmdsize < 20 or pos + 20 > len(raw):
+            break  # truncated, malformed like any other
+          if struct.unpack_from("<I", raw, pos + 16)[0] != 0:
+            return True
+          break  # every slice has at most one
+        if cmdsize < 8:
+          break
+        pos += cmdsize
+
+  return False
+
+
+class MachO:
+  """
+  everything cyan asks about a binary, read in one pass.
+
+  use `MachO.get()` to share one analysis per file; anything that
+  modifies the file must call `MachO.invalidate()` afterwards.
+  """
+
+  _cache: "OrderedDict[str, tuple[tuple[int, int], MachO]]" = OrderedDict()
+  _cache_lock = threading.Lock()
+  cache_size = 1024
+
+  def __init__(self, slices: list[Slice], path: Optional[str] = None):
+    self.slices = slices
+    self.path = path
+    self._blobs: Optional[dict[int, bytes]] = None
+
+  @classmethod
+  def from_file(
+      cls, f: BinaryIO, path: Optional[str] = None,
+      size: Optional[int] = None
+  ) -> "MachO":
+    slices = []
+    for _, _, offset, ssize in read_fat(f, size):
+      sl = read_slice(f, offset, ssize)
+      if sl is not None:
+        slices.append(sl)
+
+    return cls(slices, path)
+
+  @classmethod
+  def load(cls, path: str) -> "MachO":
+    with open(path, "rb") as f:
+      return cls.from_file(f, path)
+
+  @classmethod
+  def get(cls, path: str) -> "MachO":
+    key = os.path.realpath(path)
+    st = os.stat(key)
+    stamp = (st.st_mtime_ns, st.st_size)
+
+    with cls._cache_lock:
+      hit = cls._cache.get(key)
+      if hit is not None and hit[0] == stamp:
+        cls._cache.move_to_end(key)
+        return hit[1]
+
+    info = cls.load(key)
+    with cls._cache_lock:
+      cls._cache[key] = (stamp, info)
+      while len(cls._cache) > cls.cache_size:
+        cls._cache.popitem(last=False)
+
+    return info
+
+  @classmethod
+  def invalidate(cls, path: str) -> None:
+    with cls._cache_lock:
+      cls._cache.pop(os.path.realpath(path), None)
+
+  @property
+  def valid(self) -> bool:
+    return len(self.slices) != 0
+
+  @property
+  def archs(self) -> list[str]:
+    return [sl.arch for sl in self.slices]
+
+  @property
+  def encrypted(self) -> bool:
+    return any(sl.cryptid != 0 for sl in self.slices)
+
+  @property
+  def dependencies(self) -> list[str]:
+    # every slice links the same libraries, no need to check them all
+    return self.slices[0].dependencies if self.slices else []
+
+  @property
+  def rpaths(self) -> list[str]:
+    return self.slices[0].rpaths if self.slices else []
+
+  @property
+  def signed(self) -> bool:
+    return any(sl.code_signature is not None for sl in self.slices)
+
+  @property
+  def signature_blobs(self) -> dict[int, bytes]:
+    """the blobs of the first signed slice, read on first use."""
+    if self._blobs is not None:
+      return self._blobs
+
+    self._blobs = {}
+    for sl in self.slices:
+      if (cs := sl.code_signature) is None or self.path is None:
+        continue
+
+      with open(self.path, "rb") as f:
+        f.seek(sl.offset + cs[0])
+        self._blobs = parse_superblob(f.read(cs[1]))
+      break
+
+    return self._blobs
+
+  def _blob(self, slot: int, magic: int) -> bytes:
+    blob = self.signature_blobs.get(slot, b"")
+    if len(blob) < 8 or struct.unpack_from(">I", blob)[0] != magic:
+      return b""
+    return blob[8:]
+
+  @property
+  def entitlements(self) -> bytes:
+    """the xml entitlements plist, like `ldid -e` prints."""
+    return self._blob(CSSLOT_ENTITLEMENTS, CSMAGIC_EMBEDDED_ENTITLEMENTS)
+
+  @property
+  def der_entitlements(self) -> bytes:
+    return self._blob(
+      CSSLOT_DER_ENTITLEMENTS, CSMAGIC_EMBEDDED_DER_ENTITLEMENTS
+    )
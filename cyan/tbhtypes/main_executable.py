@@ -1,16 +1,19 @@
 import os
-import sys
 import shutil
+import plistlib
 import subprocess
-from typing import Optional
+import concurrent.futures
+from typing import Any, Optional
 
 try:
   import lief  # type: ignore
 except Exception:
   pass
 
-from cyan import tbhutils
+from cyan import staging, tbhutils
+from cyan.errors import ToolError
 from .executable import Executable
+from .macho import MachO
 
 class MainExecutable(Executable):
   def __init__(self, path: str, bundle_path: str):
@@ -18,17 +21,64 @@ class MainExecutable(Executable):
     self.bundle_path = bundle_path
 
     self.inj: Optional = None  # type: ignore
+    self.skipped = 0
 
     if os.path.isfile(self.idylib):
       self.inj_func = self.idyl_inject
     else:
       self.inj_func = self.lief_inject
 
-  def inject(self, tweaks: dict[str, str], tmpdir: str) -> None:
-    ENT_PATH = f"{self.bundle_path}/cyan.entitlements"
+  def prepare_tweaks(
+      self, tweaks: dict[str, str], tmpdir: str
+  ) -> tuple[dict[str, str], dict[str, tuple[str, set[str], list[str]]]]:
+    """
+    everything about injecting that doesn't touch the bundle, so it
+    can run while the app is still being extracted.
+
+    returns the tweaks with debs replaced by what was in them (at the
+    end, as they always were), and the prepared dylibs (see
+    `prepare_dylib()`), for `inject()`.
+    """
+    # everything here is independent per tweak, so it runs on a pool.
+    # results are used in the order tweaks were given, never in the
+    # order they finish, so output is deterministic
+    with concurrent.futures.ThreadPoolExecutor(
+        self.runner.max_procs
+    ) as executor:
+      debs = [bn for bn in tweaks if bn.endswith(".deb")]
+      contents = executor.map(tbhutils.in_context(
+        lambda bn: tbhutils.extract_deb(tweaks[bn], tmpdir)
+      ), debs)
+
+      # `tweaks` is the caller's, so replace the debs in a copy.
+      # what was in them goes after everything else, in deb order
+      tweaks = dict(tweaks)
+      for bn, found in zip(debs, contents):
+        del tweaks[bn]
+        tweaks |= found
+        print(f"[*] extracted {bn}")
+
+      dylibs = [
+        bn for bn, path in tweaks.items()
+        if bn.endswith(".dylib") and not os.path.islink(path)
+      ]
+      prepared = dict(zip(dylibs, executor.map(tbhutils.in_context(
+        lambda bn: self.prepare_dylib(bn, tweaks, tmpdir)
+      ), dylibs)))
+
+    return tweaks, prepared
+
+  def inject(
+      self, tweaks: dict[str, str], tmpdir: str, links: bool = False,
+      prepared: Optional[tuple[dict[str, str], dict[str, Any]]] = None
+  ) -> None:
+    """`prepared` is what `prepare_tweaks()` returned, if it ran early."""
+    ENT_PATH = f"{tmpdir}/cyan.entitlements"
     PLUGINS_DIR = f"{self.bundle_path}/PlugIns"
     FRAMEWORKS_DIR = f"{self.bundle_path}/Frameworks"
-    has_entitlements = self.write_entitlements(ENT_PATH)
+
+    # read straight from the signature, before we remove it
+    entitlements = self.info.entitlements
 
     # iirc, injecting doesnt work (sometimes) if the file is signed
     self.remove_signature()
@@ -44,53 +94,47 @@ class MainExecutable(Executable):
       os.makedirs(FRAMEWORKS_DIR, exist_ok=True)
 
       # some apps really dont have this lol
-      subprocess.run(
-        [self.nt, "-add_rpath", "@executable_path/Frameworks", self.path],
-        stderr=subprocess.DEVNULL
-      )
+      if "@executable_path/Frameworks" not in self.info.rpaths:
+        self.edit(
+          self.nt, "-add_rpath", "@executable_path/Frameworks", self.path,
+          stderr=subprocess.DEVNULL
+        )
 
-    # `extract_deb()` will modify `tweaks`, which is why we make a copy
-    cwd = os.getcwd()
-    for bn, path in dict(tweaks).items():
-      if bn.endswith(".deb"):
-        tbhutils.extract_deb(path, tweaks, tmpdir)
-        continue
-    os.chdir(cwd)  # i fucking hate jailbroken iOS utils.
+    if prepared is None:
+      prepared = self.prepare_tweaks(tweaks, tmpdir)
+    tweaks, dylibs = prepared
 
     needed: set[str] = set()
+    self.skipped = 0  # bytes of identical copies that weren't replaced
 
-    # inject/fix user things
+    # commit phase: only this touches the bundle and the main binary
     for bn, path in tweaks.items():
       if os.path.islink(path):
         continue  # symlinks can potentially have some security implications
 
       if bn.endswith(".appex"):
-        fpath = f"{PLUGINS_DIR}/{bn}"
-        existed = tbhutils.delete_if_exists(fpath, bn)
-        shutil.copytree(path, fpath)
+        existed = self.install_item(
+          path, f"{PLUGINS_DIR}/{bn}", bn, links
+        )
       elif bn.endswith(".dylib"):
-        path = shutil.copy2(path, tmpdir)
-
-        e = Executable(path)
-        e.fix_common_dependencies(needed)
-        e.fix_dependencies(tweaks)
+        path, found, messages = dylibs[bn]
+        needed |= found
+        for msg in messages:
+          print(msg)
 
-        fpath = f"{FRAMEWORKS_DIR}/{bn}"
-        existed = tbhutils.delete_if_exists(fpath, bn)
         self.inj_func(f"@rpath/{bn}")
-        shutil.move(path, FRAMEWORKS_DIR)
+        existed = self.install_item(
+          path, f"{FRAMEWORKS_DIR}/{bn}", bn, links, move=True
+        )
       elif bn.endswith(".framework"):
-        fpath = f"{FRAMEWORKS_DIR}/{bn}"
-        existed = tbhutils.delete_if_exists(fpath, bn)
         self.inj_func(f"@rpath/{bn}/{bn[:-10]}")
-        shutil.copytree(path, fpath)
+        existed = self.install_item(
+          path, f"{FRAMEWORKS_DIR}/{bn}", bn, links
+        )
       else:
-        fpath = f"{self.bundle_path}/{bn}"
-        existed = tbhutils.delete_if_exists(fpath, bn)
-        try:
-          shutil.copytree(path, fpath)
-        except NotADirectoryError:
-          shutil.copy2(path, self.bundle_path)
+        existed = self.install_item(
+          path, f"{self.bundle_path}/{bn}", bn, links
+        )
 
       if not existed:
         print(f"[*] injected {bn}")
@@ -102,70 +146,129 @@ class MainExecutable(Executable):
     if "orion." in needed:
       needed.add("substrate.")
 
-    for missing in needed:
+    for missing in sorted(needed):
       real = self.common[missing]["name"]  # e.g. "Orion.framework"
-      ip = f"{FRAMEWORKS_DIR}/{real}"
-      existed = tbhutils.delete_if_exists(ip, real)
-      shutil.copytree(f"{self.install_dir}/extras/{real}", ip)
+      existed = self.install_item(
+        f"{self.install_dir}/extras/{real}", f"{FRAMEWORKS_DIR}/{real}",
+        real, links
+      )
 
       if not existed:
         print(f"[*] auto-injected {real}")
 
+    if self.skipped != 0:
+      print(
+        f"[*] skipped {tbhutils.human_size(self.skipped)} "
+        "of copies the app already had"
+      )
+
     # FINALLY !!
     if self.inj is not None:  # type: ignore
+      staging.unshare(self.path)
       self.inj.write(self.path)  # type: ignore
+      MachO.invalidate(self.path)
+
+    if len(entitlements) != 0:
+      with open(ENT_PATH, "wb") as entf:
+        entf.write(entitlements)
 
-    if has_entitlements:
       self.sign_with_entitlements(ENT_PATH)
       print("[*] restored entitlements")
 
-  def write_entitlements(self, output: str) -> bool:
-    with open(output, "wb") as entf:
-      proc = subprocess.run(
-        [self.ldid, "-e", self.path],
-        capture_output=True
-      )
-
-      entf.write(proc.stdout)
+  def install_item(
+      self, src: str, dst: str, bn: str, links: bool, move: bool = False
+  ) -> bool:
+    """
+    put `src` at `dst`, unless an identical copy is already there.
+    returns whether `dst` existed, like `delete_if_exists()`.
+    """
+    if tbhutils.identical(src, dst):
+      print(f"[?] {bn} already existed and is identical, keeping it")
+      self.skipped += tbhutils.get_size(src)
+      if move:
+        os.remove(src)
+      return True
+
+    existed = tbhutils.delete_if_exists(dst, bn)
+    if move:
+      shutil.move(src, dst)
+    elif os.path.isdir(src):
+      staging.stage_tree(src, dst, links)
+    else:
+      staging.stage_file(src, dst, staging.StageStats(), links)
+    return existed
+
+  def prepare_dylib(
+      self, bn: str, tweaks: dict[str, str], tmpdir: str
+  ) -> tuple[str, set[str], list[str]]:
+    """
+    copy a dylib and fix its dependencies, without touching the bundle.
+
+    returns (the copy, common frameworks it needs, messages to print).
+    """
+    path = shutil.copy2(tweaks[bn], f"{tmpdir}/{bn}")
+    needed: set[str] = set()
+    messages: list[str] = []
 
-    return os.path.getsize(output) > 0
+    e = Executable(path)
+    e.fix_common_dependencies(needed, messages.append)
+    e.fix_dependencies(tweaks, messages.append)
+    return path, needed, messages
 
   def merge_entitlements(self, entitlements: str) -> None:
+    try:
+      with open(entitlements, "rb") as f:
+        new = plistlib.load(f)
+
+      current = self.get_entitlements()
+      if all(k in current and current[k] == v for k, v in new.items()):
+        return print("[?] entitlements were already set")
+    except Exception:
+      pass  # let ldid complain about it
+
     if self.sign_with_entitlements(entitlements):
       print("[*] merged new entitlements")
     else:
       print("[!] failed to merge new entitlements, are they valid?")
 
   def sign_with_entitlements(self, entitlements: str) -> bool:
-    return subprocess.run([
+    try:
+      with open(entitlements, "rb") as f:
+        new = plistlib.load(f)
+    except Exception:
+      new = None  # let ldid complain about it
+
+    if isinstance(new, dict) and self.sign(new):
+      return True
+
+    return self.edit(
       self.ldid,
-      f"-S{entitlements}", "-M", "-Cadhoc",
-      f"-Q{self.install_dir}/extras/zero.requirements",
+      f"-S{entitlements}", "-M", "-Cadhoc", f"-Q{self.requirements}",
       self.path
-    ]).returncode == 0
+    ).returncode == 0
 
   def lief_inject(self, cmd: str) -> None:
     if self.inj is None:  # type: ignore
       try:
         lief.logging.disable()  # type: ignore
       except Exception:
-        sys.exit("[!] did you forget to install lief?")
+        raise ToolError("did you forget to install lief?")
 
       self.inj = lief.parse(self.path)  # type: ignore
 
     try:
       self.inj.add(lief.MachO.DylibCommand.weak_lib(cmd))  # type: ignore
     except AttributeError:
-      sys.exit("[!] couldn't add LC (lief), did you use a valid app?")
+      raise ToolError("couldn't add LC (lief), did you use a valid app?")
 
   def idyl_inject(self, cmd: str) -> None:
-    proc = subprocess.run(
-      [
-        self.idylib, "--weak", "--inplace", "--all-yes",
-        cmd, self.path
-      ], capture_output=True, text=True
+    proc = self.edit(
+      self.idylib, "--weak", "--inplace", "--all-yes",
+      cmd, self.path, capture_output=True, text=True
     )
 
     if proc.returncode != 0:
-      sys.exit(f"[!] couldn't add LC (insert_dylib), error:\n{proc.stderr}")
+      raise ToolError(
+        f"couldn't add LC (insert_dylib), error:\n{proc.stderr}"
+      )
 
@@ -1,8 +1,10 @@
-import sys
 import plistlib
 from glob import glob
 from typing import Optional, Any
 
+from cyan import staging
+from cyan.errors import InvalidAppError
+
 class Plist:
     # ...existing code...
   def __init__(
@@ -15,13 +17,37 @@ class Plist:
       self.success = True
     except Exception:
       if throw:
-        sys.exit(f"[!] couldn't read {path}")
+        raise InvalidAppError(f"couldn't read {path}")
 
       self.success = False
 
     self.path = path
     self.app_path = app_path
 
+  @classmethod
+  def from_bytes(
+      cls, data: bytes, path: str = "Info.plist", throw: bool = True
+  ) -> "Plist":
+    """
+    a plist that was already read, e.g. straight out of an ipa.
+
+    it isn't on disk, so it can be looked at but not saved.
+    """
+    self = cls.__new__(cls)
+    try:
+      self.data = plistlib.loads(data)
+      self.success = True
+    except Exception:
+      if throw:
+        raise InvalidAppError(f"couldn't read {path}")
+
+      self.data = {}
+      self.success = False
+
+    self.path = path
+    self.app_path = None
+    return self
+
   def __getitem__(self, key: str) -> Any:
     return self.data.get(key, None)
 
@@ -35,6 +61,7 @@ class Plist:
   def save(self) -> None:
     # Only save if data changed (batching)
     if getattr(self, '_dirty', True):
+      staging.unshare(self.path)
       with open(self.path, "wb") as f:
         plistlib.dump(self.data, f)
       self._dirty = False
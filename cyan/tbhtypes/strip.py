@@ -0,0 +1,299 @@
+"""
+stripping symbols without a tool: debug (stab) symbols, and local
+symbols too unless they have to stay.
+
+dyld only ever looks at the exported and undefined symbols (or the
+export trie, for newer binaries), and those are kept, as is the
+indirect symbol table. substrate's `MSFindSymbol()` can find local
+symbols too, so tweaks that hook unexported functions need them,
+`keep_locals` leaves those alone.
+
+only the symbol table, indirect symbol table and string table are
+rewritten, the rest of the slice stays where it was. so anything laid
+out differently from what ld64 makes (those tables aren't the last
+thing in `__LINKEDIT`, old-style dylib tables, ..) is left unstripped.
+the code signature is kept, for its entitlements, but no longer
+matches: sign again afterwards.
+"""
+
+import os
+import io
+import mmap
+import struct
+import shutil
+import contextlib
+from typing import Optional
+
+from .macho import (
+  FAT_MAGIC, FAT_MAGIC_64, MH_MAGIC, MH_MAGIC_64, LC_SEGMENT,
+  LC_SEGMENT_64, LC_SYMTAB, LC_DYSYMTAB, LC_CODE_SIGNATURE, LC_REQ_DYLD,
+  MachO, read_slice
+)
+
+N_STAB = 0xe0
+INDIRECT_SYMBOL_LOCAL = 0x80000000
+INDIRECT_SYMBOL_ABS = 0x40000000
+
+# linkedit_data_commands, (dataoff, datasize) right after cmd/cmdsize
+LINKEDIT_DATA = (
+  0x1e,  # LC_SEGMENT_SPLIT_INFO
+  0x26,  # LC_FUNCTION_STARTS
+  0x29,  # LC_DATA_IN_CODE
+  0x2b,  # LC_DYLIB_CODE_SIGN_DRS
+  0x2e,  # LC_LINKER_OPTIMIZATION_HINT
+  0x33 | LC_REQ_DYLD,  # LC_DYLD_EXPORTS_TRIE
+  0x34 | LC_REQ_DYLD  # LC_DYLD_CHAINED_FIXUPS
+)
+# LC_DYLD_INFO(_ONLY), 5 pairs: rebase, bind, weak bind, lazy bind, export
+DYLD_INFO = (0x22, 0x22 | LC_REQ_DYLD)
+
+
+def _align(n: int, to: int) -> int:
+  return (n + to - 1) // to * to
+
+
+def _others(commands: list[tuple[int, int, bytes]]) -> list[tuple[int, int]]:
+  """(offset, size) of everything else in `__LINKEDIT`."""
+  found = []
+  for cmd, _, raw in commands:
+    if cmd in LINKEDIT_DATA:
+      found.append(struct.unpack_from("<II", raw, 8))
+    elif cmd in DYLD_INFO:
+      pairs = struct.unpack_from("<10I", raw, 8)
+      found += zip(pairs[::2], pairs[1::2])
+  return found
+
+
+def strip_slice(raw: bytes, keep_locals: bool = False) -> Optional[bytes]:
+  """
+  a stripped copy of one slice, or None if there's nothing to strip
+  (or it's laid out in a way this doesn't handle).
+  """
+  sl = read_slice(io.BytesIO(raw), 0, len(raw))
+  if sl is None:
+    return None
+
+  symtab = sl.find(LC_SYMTAB)
+  dysymtab = sl.find(LC_DYSYMTAB)
+  if not symtab or not dysymtab:
+    return None
+
+  symtab_pos, dysymtab_pos = symtab[0][1], dysymtab[0][1]
+  symoff, nsyms, stroff, strsize = struct.unpack_from(
+    "<4I", symtab[0][2], 8
+  )
+  (
+    ilocal, nlocal, iextdef, nextdef, iundef, nundef,
+    _, ntoc, _, nmodtab, _, nextref,
+    indoff, nind, extreloff, nextrel, locreloff, nlocrel
+  ) = struct.unpack_from("<18I", dysymtab[0][2], 8)
+
+  # old-style dylib tables point into the symbol table too
+  if ntoc or nmodtab or nextref:
+    return None
+  if (ilocal, iextdef, iundef) != (0, nlocal, nlocal + nextdef):
+    return None
+  if iundef + nundef != nsyms:
+    return None
+
+  nsize = 16 if sl.is64 else 12
+  syms = raw[symoff:symoff + nsyms * nsize]
+  strtab = raw[stroff:stroff + strsize]
+  indirect = raw[indoff:indoff + nind * 4]
+  if len(syms) != nsyms * nsize or len(strtab) != strsize:
+    return None
+  if len(indirect) != nind * 4:
+    return None
+
+  def n_type(ind: int) -> int:
+    return syms[ind * nsize + 4]
+
+  # ld64 only ever puts stabs with the locals
+  if any(n_type(ind) & N_STAB for ind in range(nlocal, nsyms)):
+    return None
+
+  kept = [
+    ind for ind in range(nlocal)
+    if not n_type(ind) & N_STAB and keep_locals
+  ]
+  removed = nlocal - len(kept)
+  if removed == 0:
+    return None
+  renumbered = {old: new for new, old in enumerate(kept)}
+
+  def renumber(ind: int) -> Optional[int]:
+    if ind >= nlocal:
+      return ind - removed
+    return renumbered.get(ind)
+
+  new_indirect = bytearray(indirect)
+  for at in range(0, len(indirect), 4):
+    ind = struct.unpack_from("<I", indirect, at)[0]
+    if ind & (INDIRECT_SYMBOL_LOCAL | INDIRECT_SYMBOL_ABS):
+      continue
+    if (new := renumber(ind)) is None:
+      return None  # a stub bound to a local that's going away
+    struct.pack_into("<I", new_indirect, at, new)
+
+  # external relocations (older binaries) name symbols by index
+  extrel = bytearray(raw[extreloff:extreloff + nextrel * 8])
+  for at in range(0, len(extrel), 8):
+    info = struct.unpack_from("<I", extrel, at + 4)[0]
+    if not info & (1 << 27):  # r_extern
+      continue
+    if (new := renumber(info & 0xffffff)) is None:
+      return None
+    struct.pack_into("<I", extrel, at + 4, info & ~0xffffff | new)
+
+  # the tables are rewritten where the first of them starts, which
+  # only works if nothing but the signature comes after them
+  tables = [(symoff, len(syms)), (stroff, strsize), (indoff, len(indirect))]
+  start = min(off for off, size in tables if size)
+  end = max(off + size for off, size in tables)
+  others = _others(sl.commands) + [
+    (extreloff, nextrel * 8), (locreloff, nlocrel * 8)
+  ]
+  if any(size and off + size > start for off, size in others):
+    return None
+
+  signature = sl.code_signature
+  if signature is not None and signature[0] < end:
+    return None
+
+  seg = "<16sQQQQ" if sl.is64 else "<16sIIII"
+  linkedit = None
+  for cmd, pos, cmd_raw in sl.commands:
+    if cmd in (LC_SEGMENT, LC_SEGMENT_64):
+      name, _, vmsize, fileoff, filesize = struct.unpack_from(
+        seg, cmd_raw, 8
+      )
+      if name.rstrip(b"\0") == b"__LINKEDIT":
+        linkedit = (pos, vmsize, fileoff, filesize)
+  if linkedit is None or linkedit[2] > start:
+    return None
+
+  # the string table only keeps what the kept symbols name, ld64's
+  # starts with " \0", so 1 is the empty string and 0 is no name
+  new_strtab = bytearray(b" \0")
+  names: dict[bytes, int] = {b"": 1}
+  new_syms = bytearray()
+  for ind in kept + list(range(nlocal, nsyms)):
+    entry = bytearray(syms[ind * nsize:(ind + 1) * nsize])
+    strx = struct.unpack_from("<I", entry, 0)[0]
+    if strx != 0:
+      if strx >= strsize:
+        return None
+      name = strtab[strx:].split(b"\0", 1)[0]
+      if name not in names:
+        names[name] = len(new_strtab)
+        new_strtab += name + b"\0"
+      struct.pack_into("<I", entry, 0, names[name])
+    new_syms += entry
+  new_strtab += bytes(-len(new_strtab) % (8 if sl.is64 else 4))
+
+  new_symoff = start
+  new_indoff = new_symoff + len(new_syms)
+  new_stroff = new_indoff + len(new_indirect)
+  new_end = new_stroff + len(new_strtab)
+
+  out = bytearray(raw[:start])
+  out[extreloff:extreloff + len(extrel)] = extrel
+  out += new_syms + new_indirect + new_strtab
+  if signature is not None:
+    sigoff, sigsize = signature
+    out += bytes(_align(new_end, 16) - new_end)
+    cs_pos = sl.find(LC_CODE_SIGNATURE)[0][1]
+    struct.pack_into("<I", out, cs_pos + 8, len(out))
+    out += raw[sigoff:sigoff + sigsize]
+    new_end = len(out)
+
+  struct.pack_into(
+    "<4I", out, symtab_pos + 8,
+    new_symoff, nsyms - removed, new_stroff, len(new_strtab)
+  )
+  struct.pack_into(
+    "<6I", out, dysymtab_pos + 8,
+    0, len(kept), len(kept), nextdef, len(kept) + nextdef, nundef
+  )
+  struct.pack_into("<I", out, dysymtab_pos + 8 + 12 * 4, new_indoff)
+
+  # vmsize stays page aligned, and never grows
+  pos, vmsize, fileoff, _ = linkedit
+  filesize = new_end - fileoff
+  vmsize = min(vmsize, _align(filesize, 0x4000))
+  if sl.is64:
+    struct.pack_into("<Q", out, pos + 32, vmsize)
+    struct.pack_into("<Q", out, pos + 48, filesize)
+  else:
+    struct.pack_into("<I", out, pos + 28, vmsize)
+    struct.pack_into("<I", out, pos + 36, filesize)
+
+  return bytes(out)
+
+
+def strip(path: str, keep_locals: bool = False) -> int:
+  """
+  strip every slice of `path` that can be, in place.
+  returns the bytes saved, 0 if nothing was stripped.
+  """
+  with open(path, "rb") as f:
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as src:
+      head = src[:8]
+      fat_magic = struct.unpack(">I", head[:4])[0]
+      fat = fat_magic in (FAT_MAGIC, FAT_MAGIC_64)
+
+      if fat:
+        entry = ">iiQQII" if fat_magic == FAT_MAGIC_64 else ">iiIII"
+        esize = struct.calcsize(entry)
+        nfat = struct.unpack(">I", head[4:])[0]
+        arches = [
+          struct.unpack_from(entry, src, 8 + ind * esize)
+          for ind in range(nfat)
+        ]
+      elif struct.unpack("<I", head[:4])[0] in (MH_MAGIC, MH_MAGIC_64):
+        cputype, cpusubtype = struct.unpack_from("<ii", src, 4)
+        arches = [(cputype, cpusubtype, 0, len(src), 0)]
+      else:
+        return 0
+
+      slices = []
+      for _, _, off, size, *_ in arches:
+        raw = src[off:off + size]
+        slices.append(strip_slice(raw, keep_locals) or raw)
+      old_size = len(src)
+
+  if all(len(s) == arch[3] for s, arch in zip(slices, arches)):
+    return 0
+
+  # new slice offsets, keeping each one's alignment
+  pos = 8 + len(arches) * esize if fat else 0
+  starts = []
+  for arch, sl in zip(arches, slices):
+    pos = _align(pos, 1 << arch[4]) if fat else pos
+    starts.append(pos)
+    pos += len(sl)
+
+  tmp = f"{path}.cyan-strip"
+  try:
+    with open(tmp, "wb") as out:
+      out.truncate(pos)  # gaps are zeros
+      if fat:
+        out.write(head)
+        for arch, sl, start in zip(arches, slices, starts):
+          out.write(struct.pack(
+            entry, arch[0], arch[1], start, len(sl), *arch[4:]
+          ))
+      for sl, start in zip(slices, starts):
+        out.seek(start)
+        out.write(sl)
+
+    shutil.copymode(path, tmp)
+    os.replace(tmp, path)
+  except BaseException:
+    with contextlib.suppress(FileNotFoundError):
+      os.remove(tmp)
+    raise
+  finally:
+    MachO.invalidate(path)
+
+  return old_size - pos
@@ -1,47 +1,69 @@
 import os
-import sys
+import re
 import json
+import time
+import mmap
+import zlib
+import stat
 import shutil
+import struct
+import hashlib
 import zipfile
 import platform
+import tempfile
+import threading
 import subprocess
+import contextvars
+import concurrent.futures
 from uuid import uuid4
-from glob import glob, iglob
+from collections import deque
+from glob import glob
 from argparse import Namespace
-from typing import Optional, Any
-from plistlib import load as pload
+from typing import Any, Callable, Optional, Sequence
+from plistlib import load as pload, loads as ploads
+
+from cyan import staging
+from cyan.errors import (
+  CyanFileError, InputError, InvalidAppError, OutputExistsError, ToolError,
+  UnsupportedPlatformError, UsageError
+)
+from cyan.runner import runner
 
-HAS_ZIP = shutil.which("zip") is not None
 HAS_UNZIP = shutil.which("unzip") is not None
 
+def in_context(func: Callable[..., Any]) -> Callable[..., Any]:
+  """
+  `func`, run in (a copy of) the caller's context, for pool threads:
+  whatever they print goes where the caller's prints go.
+  """
+  ctx = contextvars.copy_context()
+
+  def run(*args: Any, **kwargs: Any) -> Any:
+    return ctx.copy().run(func, *args, **kwargs)
+  return run
+
 
-def validate_inputs(args: Namespace) -> Optional[str]:
+def validate_inputs(args: Namespace) -> None:
+  """
+  raises a `CyanError` for anything wrong with `args`.
+
+  never asks anything: an existing output is only replaced
+  if `args.overwrite` is set, the cli asks before calling this.
+  """
   if not (
       args.i.endswith(".app")
       or args.i.endswith(".ipa")
       or args.i.endswith(".tipa")
   ):
-    return "the input file must be an ipa/tipa/app"
+    raise UsageError("the input file must be an ipa/tipa/app")
 
   if not os.path.exists(args.i):
-    return f"{args.i} does not exist"
+    raise UsageError(f"{args.i} does not exist")
 
-  if os.path.exists(args.o):
-    if args.overwrite:
-      print(f"[*] {args.o} already exists; overwriting")
-    else:
-      try:
-        overwrite = input(
-          f"[<] {args.o} already exists, overwrite it? [Y/n] "
-          if args.output is not None
-          else "[<] no output was specified. overwrite the input? [Y/n] "
-        ).strip().lower()
-      except KeyboardInterrupt:
-        sys.exit("[>] bye!")
-
-      if overwrite not in ("y", "yes", ""):
-        print("[>] quitting.")
-        sys.exit(0)
+  if os.path.exists(args.o) and args.plan is None:
+    if not args.overwrite:
+      raise OutputExistsError(f"{args.o} already exists")
+    print(f"[*] {args.o} already exists; overwriting")
 
   if args.f is not None:
     new: dict[str, str] = {}  # dictionary ensures unique names
@@ -51,7 +73,7 @@ def validate_inputs(args: Namespace) -> Optional[str]:
         f = f[:-1]
 
       if not os.path.exists(f):
-        sys.exit(f"[!] \"{f}\" does not exist")
+        raise InputError(f"\"{f}\" does not exist")
 
       new[os.path.basename(f)] = os.path.realpath(f)
 
@@ -62,69 +84,193 @@ def validate_inputs(args: Namespace) -> Optional[str]:
       args.m is not None
       and any(char not in "0123456789." for char in args.m)
   ):
-    sys.exit(f"[!] invalid OS version: {args.m}")
+    raise InputError(f"invalid OS version: {args.m}")
 
   if args.k is not None and not os.path.isfile(args.k):
-    sys.exit(f"[!] {args.k} does not exist")
+    raise InputError(f"{args.k} does not exist")
 
   if args.l is not None and not os.path.isfile(args.l):
-    sys.exit(f"[!] {args.l} does not exist")
+    raise InputError(f"{args.l} does not exist")
 
   if args.cyan is not None:
     for cyan in args.cyan:
       if not os.path.isfile(cyan):
-        sys.exit(f"[!] {cyan} does not exist")
+        raise InputError(f"{cyan} does not exist")
 
   if args.x is not None:
     if not os.path.isfile(args.x):
-      sys.exit(f"[!] {args.x} does not exist")
+      raise InputError(f"{args.x} does not exist")
 
     try:
       with open(args.x, "rb") as f:
         pload(f)
     except Exception:
-      sys.exit("[!] couldn't parse given entitlements file")
+      raise InputError("couldn't parse given entitlements file")
 
 
-def get_app(path: str, tmpdir: str, is_ipa: bool) -> str:
-  payload = f"{tmpdir}/Payload"
+class Extraction:
+  """
+  an app that's extracted in two stages: `start()` gets the Info.plist
+  and main binary out of an ipa, `finish()` everything else.
 
-  if is_ipa:
-    print("[*] extracting ipa..")
+  whatever only reads those two can run in between (and alongside
+  `finish()`), anything else has to wait for it. .app inputs are
+  staged all at once by `start()`.
+  """
+
+  def __init__(
+      self, path: str, tmpdir: str, is_ipa: bool, links: bool = False,
+      skip: Sequence[str] = ()
+  ):
+    self.path = path
+    self.tmpdir = tmpdir
+    self.is_ipa = is_ipa
+    self.links = links
+    self.head: set[str] = set()  # members `start()` extracted
+
+    # paths in the app that are removed anyway, so they're left out.
+    # only an optimization: anything not left out is removed later
+    self.skip = skip
+    self.excluded: list[str] = []  # as members of the ipa
+    self.finished = False
+    self.cancelled = threading.Event()
+
+  def start(self) -> str:
+    """extract what has to come first, returns the app's path."""
+    payload = f"{self.tmpdir}/Payload"
+
+    if not self.is_ipa:
+      if not os.path.isfile(f"{self.path}/Info.plist"):
+        raise InvalidAppError("no Info.plist, invalid app")
+
+      # only the files cyan modifies have to be really copied,
+      # `links` is only safe if the output won't be another .app
+      print("[*] copying app..")
+      app = f"{payload}/{os.path.basename(self.path)}"
+      stats = staging.stage_tree(
+        self.path, app, self.links,
+        {os.path.join(self.path, rel) for rel in self.skip}
+      )
+      print(f"[*] copied app ({stats})")
+      self.finished = True
+      return app
 
+    print("[*] extracting ipa..")
     try:
-      with zipfile.ZipFile(path) as ipa:
+      with zipfile.ZipFile(self.path) as ipa:
         names = ipa.namelist()
 
         if not any(name.startswith("Payload/") for name in names):
           raise KeyError
         elif not any(name.endswith(".app/Info.plist") for name in names):
-          sys.exit("[!] no Info.plist, invalid app")
-
-        # using unzip fixes extraction errors in ipas with chinese chars, etc
-        if HAS_UNZIP:
-          subprocess.run(
-            ["unzip", path, "-d", tmpdir],
-            stdout=subprocess.DEVNULL
-          )
-        else:
-          ipa.extractall(tmpdir)
-
-        app = glob(f"{payload}/*.app")[0]
+          raise InvalidAppError("no Info.plist, invalid app")
+
+        apps = [
+          name[:-len("Info.plist")] for name in names
+          if re.fullmatch(r"Payload/[^/]+\.app/Info\.plist", name)
+        ]
+        if len(apps) == 1:
+          self.excluded = [f"{apps[0]}{rel}/" for rel in self.skip]
+
+        if (app := self._extract_head(ipa, set(names))) is not None:
+          return app
+
+        # nothing can start early, so it's all extracted now
+        self._extract_rest(ipa)
+        self.finished = True
+        print("[*] extracted ipa")
+        return glob(f"{payload}/*.app")[0]
     except (KeyError, IndexError):
-      sys.exit("[!] couldn't find either Payload or app folder, invalid ipa")
+      raise InvalidAppError(
+        "couldn't find either Payload or app folder, invalid ipa"
+      )
     except zipfile.BadZipFile:
-      sys.exit(f"[!] {path} is not a zipfile (ipa)")
-
+      raise InvalidAppError(f"{self.path} is not a zipfile (ipa)")
+
+  def finish(self) -> None:
+    """extract everything `start()` didn't."""
+    if self.finished or self.cancelled.is_set():
+      return
+
+    with zipfile.ZipFile(self.path) as ipa:
+      self._extract_rest(ipa)
+    if self.cancelled.is_set():
+      return
+    self.finished = True
     print("[*] extracted ipa")
-  else:
-    if not os.path.isfile(f"{path}/Info.plist"):
-      sys.exit("[!] no Info.plist, invalid app")
-
-    print("[*] copying app..")
-    shutil.copytree(path, (app := f"{payload}/{os.path.basename(path)}"))
-    print("[*] copied app")
 
+  def cancel(self) -> None:
+    """
+    stop a `finish()` that's running (or hasn't started) in another
+    thread, whatever it extracted so far stays where it is.
+    """
+    self.cancelled.set()
+
+  def _extract_head(
+      self, ipa: zipfile.ZipFile, names: set[str]
+  ) -> Optional[str]:
+    plists = [
+      name for name in names
+      if re.fullmatch(r"Payload/[^/]+\.app/Info\.plist", name)
+    ]
+
+    # unzip may name things differently than zipfile does, so the
+    # head only goes first if both would call it the same
+    if len(plists) != 1 or not plists[0].isascii():
+      return None
+
+    app = plists[0][:-len("Info.plist")]
+    try:
+      exe = ploads(ipa.read(plists[0])).get("CFBundleExecutable")
+    except Exception:
+      return None  # `AppBundle` complains about it later
+    if (
+        not isinstance(exe, str) or not exe.isascii()
+        or f"{app}{exe}" not in names
+    ):
+      return None
+
+    for name in (plists[0], f"{app}{exe}"):
+      info = ipa.getinfo(name)
+      path = ipa.extract(info, self.tmpdir)
+
+      # zipfile keeps neither, unzip keeps both
+      if (mode := info.external_attr >> 16 & 0o777) != 0:
+        os.chmod(path, mode)
+      mtime = time.mktime(info.date_time + (0, 0, -1))
+      os.utime(path, (mtime, mtime))
+      self.head.add(name)
+
+    return os.path.join(self.tmpdir, app.rstrip("/"))
+
+  def _extract_rest(self, ipa: zipfile.ZipFile) -> None:
+    # using unzip fixes extraction errors in ipas with chinese chars, etc
+    if HAS_UNZIP:
+      # -n keeps the head, which may be in use already
+      cmd = ["unzip", "-n", self.path, "-d", self.tmpdir]
+      if len(self.excluded) != 0:
+        cmd += ["-x", *(
+          re.sub(r"([\[*?])", r"[\1]", prefix) + "*"
+          for prefix in self.excluded
+        )]
+      runner.run(cmd, stdout=subprocess.DEVNULL, cancel=self.cancelled)
+    else:
+      for info in ipa.infolist():
+        if self.cancelled.is_set():
+          break
+        if (
+            info.filename not in self.head
+            and not info.filename.startswith(tuple(self.excluded))
+        ):
+          ipa.extract(info, self.tmpdir)
+
+
+def get_app(
+    path: str, tmpdir: str, is_ipa: bool, links: bool = False
+) -> str:
+  extraction = Extraction(path, tmpdir, is_ipa, links)
+  app = extraction.start()
+  extraction.finish()
   return app
 
 
@@ -141,11 +287,102 @@ def get_tools_dir() -> tuple[str, str]:
   specific_dir = f"{install_dir}/tools/{system}/{mach}"
 
   if not os.path.isdir(specific_dir):
-    sys.exit(f"[!] cyan is not supported on: {system} {mach}")
+    raise UnsupportedPlatformError(
+      f"cyan is not supported on: {system} {mach}"
+    )
 
   return (install_dir, specific_dir)
 
 
+def get_cache_dir(*parts: str) -> str:
+  """a folder under `$CYAN_CACHE_DIR` (or ~/.cache/cyan), created if needed."""
+  root = os.environ.get("CYAN_CACHE_DIR") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "cyan"
+  )
+
+  path = os.path.join(root, *parts)
+  os.makedirs(path, exist_ok=True)
+  return path
+
+
+def hash_file(path: str) -> str:
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    while chunk := f.read(1 << 20):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def hash_tree(
+    path: str, executor: Optional[concurrent.futures.Executor] = None
+) -> str:
+  """
+  one hash for everything in a folder: names, contents, symlinks
+  and executable bits. files are hashed in parallel, on `executor`
+  if given (so hashing many trees doesn't start a pool per tree).
+  """
+  files: list[str] = []
+  links: list[tuple[str, str]] = []
+  for dp, dirs, fs in os.walk(path):
+    dirs.sort()
+    for name in sorted(fs + dirs):
+      full = f"{dp}/{name}"
+      if os.path.islink(full):
+        links.append((os.path.relpath(full, path), os.readlink(full)))
+      elif name in fs:
+        files.append(full)
+
+  if executor is None:
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+      digests = list(executor.map(hash_file, files))
+  else:
+    digests = list(executor.map(hash_file, files))
+
+  h = hashlib.sha256()
+  for full, digest in zip(files, digests):
+    exe = os.stat(full).st_mode & 0o111 != 0
+    h.update(f"F {os.path.relpath(full, path)} {exe} {digest}\n".encode())
+  for rel, target in links:
+    h.update(f"L {rel} {target}\n".encode())
+  return h.hexdigest()
+
+
+def identical(a: str, b: str) -> bool:
+  """whether two files (or folders) have exactly the same contents."""
+  if os.path.isfile(a) and os.path.isfile(b):
+    return (
+      os.path.getsize(a) == os.path.getsize(b)
+      and hash_file(a) == hash_file(b)
+    )
+  if os.path.isdir(a) and os.path.isdir(b):
+    return hash_tree(a) == hash_tree(b)
+  return False
+
+
+def get_size(path: str) -> int:
+  """size of a file, or of everything inside a folder."""
+  if not os.path.isdir(path):
+    return os.path.getsize(path)
+
+  total = 0
+  for dp, _, files in os.walk(path):
+    for f in files:
+      try:
+        total += os.lstat(f"{dp}/{f}").st_size
+      except FileNotFoundError:
+        pass
+  return total
+
+
+def human_size(size: float) -> str:
+  for unit in ("B", "KB", "MB", "GB"):
+    if size < 1024 or unit == "GB":
+      break
+    size /= 1024
+  return f"{size:.1f} {unit}" if unit != "B" else f"{size:.0f} B"
+
+
 def delete_if_exists(path: str, bn: str) -> bool:
   is_file = os.path.isfile(path)
 
@@ -161,34 +398,38 @@ def delete_if_exists(path: str, bn: str) -> bool:
     return False
 
 
-# damn it, literally EVERY FUCKING python version before 3.12 FUCKING SUCKS
-# no `delete` in `TemporaryDirectory` ?! GREAT !!!
-def extract_deb(deb: str, tweaks: dict[str, str], tmpdir: str) -> None:
+def extract_deb(deb: str, tmpdir: str) -> dict[str, str]:
+  """
+  the tweaks (dylibs, bundles, ..) inside a deb, name -> path.
+
+  every deb gets its own folder, so several can be extracted at once.
+  """
   t2 = f"{tmpdir}/{uuid4()}"
   os.mkdir(t2)
 
   if platform.system() == "Linux":
     tool = ["ar", "-x", deb, f"--output={t2}"]
   elif "iPhone" in platform.machine() or "iPad" in platform.machine():
-    os.chdir(t2)  # BAHAHAHAHHAHA.
-    tool = ["ar", "-x", deb]
+    tool = ["ar", "-x", deb]  # no --output, it extracts to the cwd
   else:
     tool = ["tar", "-xf", deb, f"--directory={t2}"]
 
   try:
-    subprocess.run(tool, check=True)
+    runner.run(tool, check=True, cwd=t2)
   except Exception:
-    sys.exit(f"[!] couldn't extract {os.path.basename(deb)}")
+    raise ToolError(f"couldn't extract {os.path.basename(deb)}")
 
   # it's not always "data.tar.gz"
   data_tar = glob(f"{t2}/data.*")[0]
-  subprocess.run(["tar", "-xf", data_tar, f"--directory={t2}"])
+  runner.run(["tar", "-xf", data_tar, f"--directory={t2}"])
 
+  found: dict[str, str] = {}
+  # sorted, so the load order doesn't depend on the filesystem
   for hi in sum((
-      glob(f"{t2}/**/*.dylib", recursive=True),
-      glob(f"{t2}/**/*.appex", recursive=True),
-      glob(f"{t2}/**/*.bundle", recursive=True),
-      glob(f"{t2}/**/*.framework", recursive=True)
+      sorted(glob(f"{t2}/**/*.dylib", recursive=True)),
+      sorted(glob(f"{t2}/**/*.appex", recursive=True)),
+      sorted(glob(f"{t2}/**/*.bundle", recursive=True)),
+      sorted(glob(f"{t2}/**/*.framework", recursive=True))
   ), []):  # type: ignore
     if (
         os.path.islink(hi)  # symlinks are broken iirc, also for security
@@ -197,74 +438,445 @@ def extract_deb(deb: str, tweaks: dict[str, str], tmpdir: str) -> None:
     ):
       continue
 
-    tweaks[os.path.basename(hi)] = hi
+    found[os.path.basename(hi)] = hi
 
-  print(f"[*] extracted {os.path.basename(deb)}")
-  del tweaks[os.path.basename(deb)]
+  return found
 
 
-def make_ipa(tmpdir: str, output: str, level: int) -> None:
-  # ensure names are written as Payload/...
-  os.chdir(tmpdir)
-  weird = 0
+def zipped(name: str) -> bool:
+  """
+  whether `make_ipa()` would zip the ipa member `name`: only what's
+  in Payload/, and nothing hidden (no `__MACOSX/..`, `._*`, ..).
+  """
+  parts = name.rstrip("/").split("/")
+  return parts[0] == "Payload" and not any(
+    p.startswith(".") for p in parts[1:]
+  )
 
-  if HAS_ZIP:
-    try:
-      os.remove(output)  # zip command updates zipfiles by default
-    except FileNotFoundError:
-      pass
 
+def make_ipa(
+    tmpdir: str, output: str, level: int,
+    reuse: Optional[dict[tuple, tuple[str, int, Any]]] = None
+) -> Any:
+  """
+  zip the Payload in `tmpdir` on every core, each file compressed
+  by its class (see `cyan/compression.py`).
+
+  `reuse` is shared by zips of the same files (like variants of one
+  app): files already compressed into an earlier one, told apart by
+  their inode and mtime, are copied from it instead.
+
+  returns the `compression.Policy`, it knows what each class cost.
+  """
+  from cyan import compression, zipwriter
+
+  policy = compression.Policy(level)
+  levels = tuple(sorted(policy.levels.items()))
+  output = os.path.abspath(output)
+
+  jobs: list[tuple[str, Optional[str]]] = []  # (name, None for folders)
+  for dp, dirs, files in os.walk(f"{tmpdir}/Payload", followlinks=True):
     # don't zip hidden files to fix an installd error sometimes
     # thanks a lot eevee 😭
-    subprocess.run(
-      ["zip", f"-{level}", "-r", output, "Payload", "-x", "*/.*"],
-      stdout=subprocess.DEVNULL
+    dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+    jobs.append((os.path.relpath(dp, tmpdir), None))
+    jobs += [
+      (os.path.relpath(f"{dp}/{f}", tmpdir), f"{dp}/{f}")
+      for f in sorted(files)
+      if not f.startswith(".") and os.path.exists(f"{dp}/{f}")
+    ]
+
+  def prepare(
+      job: tuple[str, Optional[str]]
+  ) -> tuple[zipwriter.Member, Optional[tuple]]:
+    """the member, and its key in `reuse` if it was just compressed."""
+    name, path = job
+    if path is None:
+      mtime = os.stat(f"{tmpdir}/{name}").st_mtime
+      return zipwriter.Member.directory(
+        name, date_time=time.localtime(mtime)[:6]
+      ), None
+
+    if reuse is None:
+      return policy.compress(name, path), None
+
+    st = os.stat(path)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, levels)
+    if (found := reuse.get(key)) is None:
+      return policy.compress(name, path), key
+
+    src, offset, m = found
+    policy.add_reused(m.size)
+    return zipwriter.Member(
+      name, m.method, m.crc, m.size, zipwriter.Slice(src, offset, m.csize),
+      m.csize, m.mode, m.date_time, m.sha256
+    ), None
+
+  # written next to the output, it only replaces it once complete.
+  # an existing output may be hardlinked elsewhere, so it's never
+  # written to in place
+  tmp = os.path.join(
+    os.path.dirname(output), f".{os.path.basename(output)}.{uuid4().hex}"
+  )
+
+  # members are written in order, so only a few are kept waiting
+  window = 2 * (os.cpu_count() or 1)
+  found: list[tuple[tuple, int, Any]] = []
+  try:
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+      with zipwriter.ZipWriter(tmp) as zf:
+        pending: deque = deque()
+        for ind, job in enumerate(jobs):
+          pending.append(executor.submit(prepare, job))
+          while pending and (
+              len(pending) >= window or ind == len(jobs) - 1
+          ):
+            m, key = pending.popleft().result()
+            offset = zf.write(m)
+            m.data.close()
+            if key is not None:
+              found.append((key, offset, m))
+    os.replace(tmp, output)
+  except BaseException:
+    if os.path.lexists(tmp):
+      os.remove(tmp)
+    raise
+
+  if reuse is not None:
+    for key, offset, m in found:
+      reuse[key] = (output, offset, m)
+  return policy
+
+
+def filter_ipa(
+    path: str, output: str, skip: Sequence[str]
+) -> tuple[int, int]:
+  """
+  copy the ipa at `path` to `output` without the members under any
+  of the `skip` prefixes, or what `make_ipa()` would leave out too
+  (see `zipped()`). the rest is copied still compressed, so
+  nothing is extracted or compressed again. `output` may be `path`.
+
+  raises `ValueError` for what can't be copied as it is (encrypted
+  members, or names that aren't ascii or utf-8).
+
+  returns (members left out, their uncompressed size).
+  """
+  from cyan import zipwriter
+
+  entries = zipwriter.read_central(path)
+  for e in entries:
+    if e.flags & 0x1:
+      raise ValueError(f"{e.name} is encrypted")
+    if not e.name.isascii() and not e.flags & 0x800:
+      raise ValueError(f"{e.name} isn't named in utf-8")
+
+  skip = tuple(skip)
+  kept = [
+    e for e in entries if not e.name.startswith(skip) and zipped(e.name)
+  ]
+
+  # written next to the output, it only replaces it once complete
+  output = os.path.abspath(output)
+  tmp = os.path.join(
+    os.path.dirname(output), f".{os.path.basename(output)}.{uuid4().hex}"
+  )
+  try:
+    with open(path, "rb") as f, zipwriter.ZipWriter(tmp) as zf:
+      for e in kept:
+        mode = e.mode or (
+          stat.S_IFDIR | 0o755 if e.name.endswith("/") else 0o644
+        )
+        offset = zipwriter.data_offset(f, e.header_offset)
+        m = zipwriter.Member(
+          e.name, e.method, e.crc, e.size,
+          zipwriter.Slice(path, offset, e.csize), e.csize, mode,
+          e.date_time
+        )
+        zf.write(m)
+        m.data.close()
+    os.replace(tmp, output)
+  except BaseException:
+    if os.path.lexists(tmp):
+      os.remove(tmp)
+    raise
+
+  return (
+    len(entries) - len(kept),
+    sum(e.size for e in entries) - sum(e.size for e in kept)
+  )
+
+
+# payloads that replace a whole argument, instead of adding to it
+CYAN_FILES = {"k": "icon.idk", "l": "merge.plist", "x": "new.entitlements"}
+
+# the first member of v2 .cyan files, says where every payload is
+CYAN_INDEX = "cyan.index"
+
+
+def read_cyan_index(cyan: str) -> Optional[tuple[dict[str, Any], bytes]]:
+  """
+  the index of a v2 .cyan, read straight from the first local header.
+
+  payload offsets in it are relative to the end of the index.
+  """
+  with open(cyan, "rb") as f:
+    head = f.read(30)
+    if len(head) < 30:
+      return None
+
+    sig, _, _, method, _, _, _, csize, _, nlen, elen = struct.unpack(
+      "<IHHHHHIIIHH", head
+    )
+    if (
+        sig != 0x04034b50 or method != 0
+        or f.read(nlen) != CYAN_INDEX.encode()
+    ):
+      return None
+
+    f.seek(elen, os.SEEK_CUR)
+    raw = f.read(csize)
+    index = json.loads(raw)
+    index["base"] = f.tell()
+
+  if index.get("version") != 2:
+    return None
+  return index, raw
+
+
+def safe_member(name: str) -> bool:
+  """
+  whether a payload name stays inside wherever it's extracted to:
+  relative, no `..`, `.` or empty parts, no backslashes.
+  """
+  parts = name.removesuffix("/").split("/")
+  return (
+    not name.startswith("/") and "\\" not in name and ":" not in parts[0]
+    and all(p not in ("", ".", "..") for p in parts)
+  )
+
+
+def _inside(root: str, path: str) -> str:
+  """`path`, if it really is under `root`, like `zipfile.extract()`."""
+  real = os.path.realpath(path)
+  if not real.startswith(os.path.realpath(root) + os.sep):
+    raise CyanFileError(f"{path} is outside of {root}")
+  return path
+
+
+def read_cyan(
+    cyan: str
+) -> tuple[dict[str, Any], list[str], Optional[str], Optional[dict]]:
+  """
+  only the config and the list of payloads, nothing is extracted.
+
+  v2 files get all of that from their index, older ones from
+  the central directory. if there is a manifest of every payload's
+  hash (or the index), hashing it identifies the archive's contents.
+  """
+  def check(names: list[str]) -> list[str]:
+    if bad := [n for n in names if not safe_member(n)]:
+      raise CyanFileError(
+        f"{os.path.basename(cyan)} has unsafe paths: {', '.join(bad)}"
+      )
+    return names
+
+  if (v2 := read_cyan_index(cyan)) is not None:
+    index, raw = v2
+    check(list(index["files"]))
+    return (
+      index["config"], list(index["files"]),
+      hashlib.sha256(raw).hexdigest(), index
     )
+
+  with zipfile.ZipFile(cyan) as zf:
+    with zf.open("config.json") as f:
+      config = json.load(f)
+
+    digest = None
+    if "manifest.json" in zf.NameToInfo:
+      digest = hashlib.sha256(zf.read("manifest.json")).hexdigest()
+
+    return config, check(zf.namelist()), digest, None
+
+
+def copy_cyan_member(
+    mm: mmap.mmap, base: int, entry: dict[str, Any], dst: str
+) -> None:
+  """write one payload of a v2 .cyan, checking its hash."""
+  start = base + entry["offset"]
+  sha = hashlib.sha256()
+
+  with memoryview(mm) as view, view[start:start + entry["csize"]] as data:
+    with open(dst, "wb") as f:
+      if entry["method"] == 0:  # stored, so a single copy from the map
+        sha.update(data)
+        f.write(data)
+      else:
+        comp = zlib.decompressobj(-15)
+        for pos in range(0, len(data), 1 << 20):
+          chunk = comp.decompress(data[pos:pos + (1 << 20)])
+          sha.update(chunk)
+          f.write(chunk)
+        chunk = comp.flush()
+        sha.update(chunk)
+        f.write(chunk)
+
+  if sha.hexdigest() != entry["sha256"]:
+    raise CyanFileError(f"{os.path.basename(dst)} is corrupted in the .cyan")
+  # no setuid and such, nothing writable by others, always readable
+  os.chmod(dst, entry["mode"] & 0o755 | 0o600)
+
+
+def _stage_payload(src: str, dst: str) -> str:
+  os.makedirs(os.path.dirname(dst), exist_ok=True)
+  if os.path.isdir(src):
+    staging.stage_tree(src, dst)
   else:
-    with zipfile.ZipFile(
-        output, "w", zipfile.ZIP_DEFLATED, compresslevel=level
-    ) as zf:
-      for f in iglob("Payload/**", recursive=True):
-        try:
-          zf.write(f)
-        except ValueError:
-          weird += 1
-
-  if weird != 0:
-    print(f"[?] was unable to zip {weird} file(s) due to timestamps")
-
-
-def parse_cyans(args: dict[str, Any], tmpdir: str) -> None:
-  for ind, cyan in enumerate(args["cyan"]):
-    print(f"[*] parsing {os.path.basename(cyan)} ..")
-
-    with zipfile.ZipFile(cyan) as zf:
-      DOT_PATH = f"{tmpdir}/cyan-{ind}"
-      os.mkdir(DOT_PATH)
-
-      with zf.open("config.json") as f:
-        config = json.load(f)
-
-      if "f" in config:
-        NAMES = [n for n in zf.namelist() if n.startswith("inject/")]
-        zf.extractall(DOT_PATH, NAMES)
-
-        # ensure not None
-        args["f"] = args["f"] if args["f"] is not None else {}
-        for e in os.scandir(f"{DOT_PATH}/inject"):
-          args["f"][e.name] = e.path
-        del config["f"]
-      if "k" in config:
-        args["k"] = zf.extract("icon.idk", DOT_PATH)
-        del config["k"]
-      if "l" in config:
-        args["l"] = zf.extract("merge.plist", DOT_PATH)
-        del config["l"]
-      if "x" in config:
-        args["x"] = zf.extract("new.entitlements", DOT_PATH)
-        del config["x"]
-
-      # the rest of the config (not the ones above, we `del` them)
-      for k, v in config.items():
-        args[k] = v
+    staging.stage_file(src, dst, staging.StageStats())
+  return dst
+
+
+def extract_cyan_payload(
+    cyan: str, digest: str, member: str, names: list[str],
+    index: Optional[dict[str, Any]], into: str
+) -> str:
+  """
+  extract one payload (a file, or a folder with everything in it)
+  into the cache for this archive, unless it's already there, and
+  stage it at `into/member`.
+
+  the job uses that copy (reflinked or hardlinked, so it's cheap),
+  the cache's entry can be evicted while the job's still running.
+
+  v2 payloads are copied out of a memory map using the index,
+  without having to go through the zip at all.
+  """
+  from cyan import cache
+
+  wanted = [
+    name for name in names
+    if name == member or name.startswith(f"{member}/")
+  ]
+  if len(wanted) == 0:
+    raise CyanFileError(
+      f"{member} is in the config of {os.path.basename(cyan)}, "
+      "but not in the .cyan itself"
+    )
 
+  # one entry per payload, they're small enough to rehash on every read
+  payloads = cache.Cache("cyans", check=True)
+  key = f"{digest}-{hashlib.sha256(member.encode()).hexdigest()[:16]}"
+  if (entry := payloads.get(key)) is not None:
+    try:
+      return _stage_payload(f"{entry}/{member}", f"{into}/{member}")
+    except FileNotFoundError:
+      # evicted after all, it's extracted again
+      shutil.rmtree(f"{into}/{member}", ignore_errors=True)
+
+  def extract(tmp: str) -> None:
+    os.mkdir(tmp)
+
+    if index is not None:
+      with open(cyan, "rb") as f, mmap.mmap(
+          f.fileno(), 0, access=mmap.ACCESS_READ
+      ) as mm:
+        for name in wanted:
+          dst = _inside(tmp, f"{tmp}/{name}")
+          os.makedirs(os.path.dirname(dst), exist_ok=True)
+          copy_cyan_member(mm, index["base"], index["files"][name], dst)
+    else:
+      with zipfile.ZipFile(cyan) as zf:
+        # the archive is cached by its manifest's hash, so what's
+        # extracted has to be what the manifest says
+        manifest = None
+        if "manifest.json" in zf.NameToInfo:
+          manifest = json.loads(zf.read("manifest.json")).get("files", {})
+
+        for name in wanted:
+          path = zf.extract(name, tmp)
+          if manifest is None or name.endswith("/"):
+            continue
+          expected = manifest.get(name, {}).get("sha256")
+          if expected is None or hash_file(path) != expected:
+            raise CyanFileError(
+              f"{name} doesn't match the manifest of the .cyan"
+            )
+
+  entry = payloads.publish(key, extract)
+  return _stage_payload(f"{entry}/{member}", f"{into}/{member}")
+
+
+def merge_cyans(
+    args: dict[str, Any], cyans: list[str], metas: list[tuple]
+) -> list[tuple[int, str]]:
+  """
+  merge every config into `args`, later ones win.
+
+  returns (cyan index, member) of the payloads that are still
+  needed, so overridden ones are never extracted.
+  """
+  injects: dict[str, int] = {}
+  files: dict[str, int] = {}
+  for ind, (config, names, _, _) in enumerate(metas):
+    print(f"[*] parsing {os.path.basename(cyans[ind])} ..")
+
+    if "f" in config:
+      for name in names:
+        if name.startswith("inject/") and len(name) > 7:
+          tweak = name[7:].split("/", 1)[0]
+          if not safe_member(tweak):
+            raise CyanFileError(f"invalid tweak name in .cyan: {tweak}")
+          injects[tweak] = ind
+      del config["f"]
+
+    for key in CYAN_FILES:
+      if key in config:
+        files[key] = ind
+        del config[key]
+
+    # the rest of the config (not the ones above, we `del` them)
+    for k, v in config.items():
+      args[k] = v
+
+  jobs = [(ind, f"inject/{name}") for name, ind in injects.items()]
+  jobs += [(ind, CYAN_FILES[key]) for key, ind in files.items()]
+  return jobs
+
+
+def parse_cyans(args: dict[str, Any], into: str) -> None:
+  """
+  merge the configs of `args["cyan"]` into `args`, and extract the
+  payloads they need into (a new folder in) `into`.
+  """
+  cyans: list[str] = args["cyan"]
+
+  with concurrent.futures.ThreadPoolExecutor() as executor:
+    metas = list(executor.map(read_cyan, cyans))
+
+  jobs = merge_cyans(args, cyans, metas)
+  if len(jobs) == 0:
+    return
+
+  # extracted payloads are cached by the archive's hash. each call
+  # gets its own folder, variants may be given other payloads
+  into = tempfile.mkdtemp(prefix="cyans-", dir=into)
+  with concurrent.futures.ThreadPoolExecutor() as executor:
+    needed = sorted({ind for ind, _ in jobs})
+    digests = dict(zip(needed, executor.map(
+      lambda ind: metas[ind][2] or hash_file(cyans[ind]), needed
+    )))
+    paths = list(executor.map(
+      lambda job: extract_cyan_payload(
+        cyans[job[0]], digests[job[0]], job[1], metas[job[0]][1],
+        metas[job[0]][3], into
+      ), jobs
+    ))
+
+  for (_, member), path in zip(jobs, paths):
+    if member.startswith("inject/"):
+      # ensure not None
+      args["f"] = args["f"] if args["f"] is not None else {}
+      args["f"][member[7:]] = path
+    else:
+      args[next(k for k, v in CYAN_FILES.items() if v == member)] = path
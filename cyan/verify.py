@@ -0,0 +1,207 @@
+"""
+`--verify`: checks a finished output before the job calls it done.
+
+every file of the app is read once, on every core: its crc is checked
+against the ipa's, and binaries are parsed and their signatures checked
+against their pages while they're mapped anyway. what's expected of
+them (thinned, signed, ..) follows from the job's options.
+"""
+
+import os
+import mmap
+import zlib
+import tempfile
+import posixpath
+import contextlib
+import concurrent.futures
+from argparse import Namespace
+from typing import Iterator, Optional
+
+from cyan import plugins, zipwriter
+from cyan.planner import Tree
+from cyan.tbhtypes import MachO, codesign
+
+
+def read_crc(tree: Tree, rel: str) -> int:
+  crc = 0
+  with tree.open(rel) as f:
+    while chunk := f.read(zipwriter.CHUNK):
+      crc = zlib.crc32(chunk, crc)
+  return crc
+
+
+@contextlib.contextmanager
+def mapped(tree: Tree, rel: str) -> Iterator[tuple[mmap.mmap, int]]:
+  """
+  a file mapped into memory, and its crc (0 outside of ipas). ipa
+  members are inflated to a temporary file next to the ipa first,
+  so no binary is ever held in memory as a whole.
+  """
+  with contextlib.ExitStack() as stack:
+    crc = 0
+    if tree.is_ipa:
+      f = stack.enter_context(tempfile.TemporaryFile(
+        dir=os.path.dirname(os.path.abspath(tree.path))
+      ))
+      with tree.open(rel) as src:
+        while chunk := src.read(zipwriter.CHUNK):
+          crc = zlib.crc32(chunk, crc)
+          f.write(chunk)
+      f.flush()
+    else:
+      f = stack.enter_context(open(f"{tree.path}/{rel}", "rb"))
+
+    if os.fstat(f.fileno()).st_size == 0:
+      raise ValueError("it's empty")
+    yield stack.enter_context(
+      mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    ), crc
+
+
+def check_binary(
+    rel: str, data: mmap.mmap, args: Namespace, main: str,
+    main_archs: list[str]
+) -> list[str]:
+  info = MachO.from_file(data, rel, len(data))  # type: ignore
+  if not info.valid:
+    return [f"{rel} isn't a valid mach-o"]
+
+  problems = []
+  if main_archs and not set(info.archs) & set(main_archs):
+    problems.append(
+      f"{rel} is {', '.join(info.archs)}, "
+      f"but the main binary is {', '.join(main_archs)}"
+    )
+  if args.thin and len(info.slices) > 1 and "arm64" in info.archs:
+    problems.append(f"{rel} wasn't thinned")
+
+  if info.encrypted:
+    if rel == main and not args.ignore_encrypted:
+      problems.append(f"{rel} is encrypted")
+    elif rel != main and args.remove_encrypted and rel.startswith(
+        tuple(f"{f}/" for f in plugins.FOLDERS)
+    ):
+      problems.append(f"{rel} is encrypted, but wasn't removed")
+
+  if args.fakesign:
+    for sl in info.slices:
+      if (problem := codesign.check(data, sl)) is not None:
+        problems.append(f"{rel} ({sl.arch}): {problem}")
+
+  return problems
+
+
+def check_bundles(tree: Tree, bundle_id: str) -> list[str]:
+  """nested bundles' ids have to start with the app's."""
+  problems = []
+  for rel in sorted(tree.dirs):
+    if not rel.endswith((".appex", ".app")) or "Frameworks/" in rel:
+      continue
+    if f"{rel}/Info.plist" not in tree.files:
+      continue
+
+    nested = tree.plist(f"{rel}/Info.plist").get("CFBundleIdentifier")
+    if not isinstance(nested, str) or not nested.startswith(
+        f"{bundle_id}."
+    ):
+      problems.append(
+        f"{rel} has bundle id {nested}, not prefixed with {bundle_id}"
+      )
+  return problems
+
+
+def resolve(
+    tree: Tree, dep: str, rpaths: list[str], loader: str
+) -> Optional[str]:
+  """
+  where the dependency `dep` of the binary at `loader` is in the app,
+  if it is. system paths (absolute ones) can't be checked from here.
+  """
+  if dep.startswith("@rpath/"):
+    candidates = [f"{rp}/{dep[7:]}" for rp in rpaths]
+  else:
+    candidates = [dep]
+
+  for path in candidates:
+    if path.startswith("@executable_path/"):
+      rel = path[17:]
+    elif path.startswith("@loader_path/"):
+      rel = posixpath.join(posixpath.dirname(loader), path[13:])
+    else:
+      continue
+    if (rel := posixpath.normpath(rel)) in tree.files:
+      return rel
+  return None
+
+
+def check_rpaths(tree: Tree, main: str, info: MachO) -> list[str]:
+  """
+  every `@rpath/` dependency of the main binary, and of whatever it
+  loads from the app (injected dylibs and frameworks), has to be in it.
+  """
+  problems = []
+
+  def check(rel: str, deps: list[str], rpaths: list[str]) -> None:
+    for dep in deps:
+      if not dep.startswith("@rpath/"):
+        continue
+      if any(resolve(tree, dep, rps, at) for rps, at in rpaths):
+        continue
+      # swift's libraries come with the os since ios 12.2
+      system = any(rp.startswith("/") for rps, _ in rpaths for rp in rps)
+      if system and posixpath.basename(dep).startswith("libswift"):
+        continue
+      problems.append(f"{dep} (loaded by {rel}) isn't in the app")
+
+  main_rpaths = (info.rpaths, main)
+  check(main, info.dependencies, [main_rpaths])
+  for dep in info.dependencies:
+    if (found := resolve(tree, dep, info.rpaths, main)) is None:
+      continue
+    sub = tree.macho(found)
+    check(found, sub.dependencies, [(sub.rpaths, found), main_rpaths])
+  return problems
+
+
+def verify(path: str, args: Namespace) -> list[str]:
+  """everything wrong with the output at `path`, made by `args`."""
+  tree = Tree(path, path.endswith((".ipa", ".tipa")))
+  pl = tree.plist("Info.plist")
+  main = pl.get("CFBundleExecutable")
+  if main is None or main not in tree.files:
+    return ["no main executable"]
+
+  info = tree.macho(main)
+  main_archs = info.archs
+  binaries = set(tree.executables()) | {main}
+
+  problems = check_rpaths(tree, main, info)
+  if isinstance(pl.get("CFBundleIdentifier"), str):
+    problems += check_bundles(tree, pl["CFBundleIdentifier"])
+  else:
+    problems.append("no bundle id")
+
+  def check(rel: str) -> list[str]:
+    found = []
+    crc = None
+    try:
+      if rel in binaries:
+        with mapped(tree, rel) as (data, crc):
+          found += check_binary(rel, data, args, main, main_archs)
+      elif tree.is_ipa:
+        crc = read_crc(tree, rel)
+    except (OSError, ValueError, zlib.error) as e:
+      return [f"{rel} can't be read: {e}"]
+
+    if tree.is_ipa and crc != tree.entries[rel].crc:
+      found.append(f"{rel} doesn't match its crc")
+    return found
+
+  # mostly reads, zlib and hashlib, which let go of the gil
+  with concurrent.futures.ThreadPoolExecutor(
+      min(32, 4 * (os.cpu_count() or 1))
+  ) as executor:
+    for found in executor.map(check, sorted(tree.files)):
+      problems += found
+
+  return problems
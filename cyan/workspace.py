@@ -0,0 +1,171 @@
+import os
+import shutil
+import weakref
+import zipfile
+import tempfile
+from typing import Optional
+
+from cyan import staging, tbhutils
+from cyan.errors import QuotaExceededError
+
+TMPFS = "/dev/shm"
+
+# apps smaller than this (unpacked) are worked on in tmpfs, if there's room
+TMPFS_LIMIT = 512 << 20
+
+
+def parse_size(size: str) -> int:
+  """`1048576`, `512M`, `2g`, .. into bytes."""
+  size = size.strip().upper().removesuffix("B")
+  for shift, unit in ((30, "G"), (20, "M"), (10, "K")):
+    if size.endswith(unit):
+      return int(float(size[:-1]) * (1 << shift))
+  return int(size)
+
+
+def input_size(path: str, is_ipa: bool) -> int:
+  """how big an input will be once it's unpacked, without unpacking it."""
+  if not is_ipa:
+    return tbhutils.get_size(path)
+
+  try:
+    with zipfile.ZipFile(path) as zf:
+      return sum(zi.file_size for zi in zf.infolist())
+  except (OSError, zipfile.BadZipFile):
+    return 0  # `get_app()` will complain about it
+
+
+def choose_root(size_hint: int) -> Optional[str]:
+  """
+  `$CYAN_WORKDIR` if it's set, tmpfs for small jobs,
+  otherwise the system's temporary directory (`None`).
+  """
+  if root := os.environ.get("CYAN_WORKDIR"):
+    return root
+
+  limit = TMPFS_LIMIT
+  if "CYAN_TMPFS_LIMIT" in os.environ:
+    limit = parse_size(os.environ["CYAN_TMPFS_LIMIT"])
+
+  if 0 < size_hint <= limit and os.path.isdir(TMPFS):
+    try:
+      # the app, plus room for tweaks and the new ipa
+      if shutil.disk_usage(TMPFS).free > size_hint * 3:
+        return TMPFS
+    except OSError:
+      pass
+
+  return None
+
+
+class Workspace:
+  """
+  the temporary folder a job works in.
+
+  owns its folder and nothing else: no `chdir`, so several jobs can
+  run in one process. the folder is removed when the `with` block
+  ends, however it ends (exceptions included), or at exit at worst.
+  """
+
+  def __init__(
+      self, root: Optional[str] = None, quota: Optional[int] = None
+  ):
+    if quota is None and "CYAN_WORKSPACE_QUOTA" in os.environ:
+      quota = parse_size(os.environ["CYAN_WORKSPACE_QUOTA"])
+
+    if root is not None:
+      os.makedirs(root, exist_ok=True)
+
+    self.path = tempfile.mkdtemp(prefix="cyan-", dir=root)
+    self.quota = quota
+    self.peak = 0
+
+    # what `usage()` found shared last time, by (dev, inode): (mtime,
+    # size, shared bytes). only new or changed files are asked again
+    self._shared: dict[tuple[int, int], tuple[int, int, int]] = {}
+    self._reflinks = True  # until the filesystem says it can't tell
+    self._finalizer = weakref.finalize(
+      self, shutil.rmtree, self.path, ignore_errors=True
+    )
+
+  @classmethod
+  def for_input(cls, path: str, is_ipa: bool) -> "Workspace":
+    return cls(choose_root(input_size(path, is_ipa)))
+
+  def __enter__(self) -> "Workspace":
+    return self
+
+  def __exit__(self, *exc: object) -> None:
+    self.cleanup()
+
+  def usage(self) -> int:
+    """
+    bytes the folder takes up, in one walk. a file with several links
+    in it is only counted once, and blocks a reflink shares with
+    another file (its source, usually outside) not at all.
+
+    the walk only stats, the filesystem is only asked what's shared
+    for files that are new or changed since the last call.
+    """
+    total = 0
+    seen: set[tuple[int, int]] = set()
+    shared: dict[tuple[int, int], tuple[int, int, int]] = {}
+    todo = [self.path]
+    while todo:
+      try:
+        it = os.scandir(todo.pop())
+      except FileNotFoundError:
+        continue
+
+      with it:
+        for entry in it:
+          try:
+            if entry.is_dir(follow_symlinks=False):
+              todo.append(entry.path)
+              continue
+            st = entry.stat(follow_symlinks=False)
+          except FileNotFoundError:
+            continue
+
+          key = (st.st_dev, st.st_ino)
+          if st.st_nlink > 1:
+            if key in seen:
+              continue
+            seen.add(key)
+
+          size = st.st_size
+          if (
+              self._reflinks and size != 0
+              and entry.is_file(follow_symlinks=False)
+          ):
+            stamp = (st.st_mtime_ns, size)
+            known = self._shared.get(key)
+            if known is not None and known[:2] == stamp:
+              shared[key] = known
+            elif (found := staging.shared_bytes(entry.path)) is None:
+              self._reflinks = False
+            else:
+              shared[key] = (*stamp, found)
+            if key in shared:
+              size -= min(shared[key][2], size)
+          total += size
+
+    self._shared = shared  # forgets what's gone
+    return total
+
+  def check(self, step: str) -> int:
+    """record how much space is used, exiting if it's over the quota."""
+    used = self.usage()
+    self.peak = max(self.peak, used)
+
+    if self.quota is not None and used > self.quota:
+      raise QuotaExceededError(
+        f"used {tbhutils.human_size(used)} while {step}, "
+        f"over the quota of {tbhutils.human_size(self.quota)}"
+      )
+    return used
+
+  def cleanup(self) -> None:
+    if self._finalizer.alive:
+      print("[*] deleting temporary directory..")
+      self._finalizer()
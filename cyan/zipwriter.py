@@ -0,0 +1,442 @@
+import io
+import os
+import stat
+import time
+import zlib
+import shutil
+import struct
+import hashlib
+import tempfile
+from typing import Any, BinaryIO, Iterable, Iterator, Optional
+
+STORED = 0
+DEFLATED = 8
+
+# already compressed (or encrypted) formats, deflating them is wasted cpu
+INCOMPRESSIBLE = frozenset((
+  ".deb", ".zip", ".ipa", ".tipa", ".gz", ".tgz", ".xz", ".bz2", ".zst",
+  ".lzma", ".7z", ".png", ".jpg", ".jpeg", ".heic", ".webp", ".gif",
+  ".car", ".mp3", ".mp4", ".m4a", ".m4v", ".aac", ".mov", ".caf"
+))
+
+# the earliest time a zip can store, also used for reproducible output
+EPOCH = (1980, 1, 1, 0, 0, 0)
+
+CHUNK = 1 << 20
+SPOOL = 16 << 20  # bigger entries are spooled to disk while waiting
+ZIP64_LIMIT = 0xffffffff
+
+
+def dos_time(date_time: tuple[int, ...]) -> tuple[int, int]:
+  y, mo, d, h, mi, s = date_time[:6]
+  if y < 1980:  # zips can't go back any further
+    y, mo, d, h, mi, s = EPOCH
+  elif y > 2107:  # or forward
+    y, mo, d, h, mi, s = 2107, 12, 31, 23, 59, 58
+  return (
+    (y - 1980) << 9 | mo << 5 | d,
+    h << 11 | mi << 5 | s // 2
+  )
+
+
+class Member:
+  """
+  an entry that's ready to be written: already compressed and hashed.
+
+  preparing members is the expensive part and can run on any thread,
+  writing them is just copying bytes.
+  """
+
+  def __init__(
+      self, name: str, method: int, crc: int, size: int,
+      data: BinaryIO, csize: int, mode: int = 0o644,
+      date_time: tuple[int, ...] = EPOCH, sha256: Optional[str] = None
+  ):
+    self.name = name
+    self.method = method
+    self.crc = crc
+    self.size = size
+    self.data = data
+    self.csize = csize
+    self.mode = mode
+    self.date_time = date_time
+    self.sha256 = sha256
+
+  @classmethod
+  def directory(
+      cls, name: str, mode: int = 0o755, date_time: tuple[int, ...] = EPOCH
+  ) -> "Member":
+    return cls(
+      name.rstrip("/") + "/", STORED, 0, 0, tempfile.SpooledTemporaryFile(),
+      0, stat.S_IFDIR | mode, date_time
+    )
+
+
+def compress(
+    name: str, src: Iterable[bytes], level: int, mode: int = 0o644,
+    date_time: tuple[int, ...] = EPOCH
+) -> Member:
+  """compress chunks from `src` into a member, level 0 stores it."""
+  crc = 0
+  size = 0
+  sha = hashlib.sha256()
+  out = tempfile.SpooledTemporaryFile(SPOOL)
+  comp = zlib.compressobj(level, zlib.DEFLATED, -15) if level > 0 else None
+
+  # zlib and hashlib release the gil, so this scales with threads
+  for chunk in src:
+    crc = zlib.crc32(chunk, crc)
+    size += len(chunk)
+    sha.update(chunk)
+    out.write(comp.compress(chunk) if comp is not None else chunk)
+  if comp is not None:
+    out.write(comp.flush())
+
+  return Member(
+    name, DEFLATED if comp is not None else STORED, crc, size,
+    out, out.tell(), mode, date_time, sha.hexdigest()
+  )
+
+
+class Slice(io.RawIOBase):
+  """
+  `size` bytes of the file at `path` from `offset`, read like a file
+  of their own. used as a member's data to copy an entry that's
+  already compressed out of another zip.
+  """
+
+  def __init__(self, path: str, offset: int, size: int):
+    self.fp = open(path, "rb")
+    self.offset = offset
+    self.size = size
+    self.pos = 0
+
+  def readable(self) -> bool:
+    return True
+
+  def seekable(self) -> bool:
+    return True
+
+  def seek(self, pos: int, whence: int = os.SEEK_SET) -> int:
+    base = {os.SEEK_SET: 0, os.SEEK_CUR: self.pos, os.SEEK_END: self.size}
+    self.pos = max(base[whence] + pos, 0)
+    return self.pos
+
+  def tell(self) -> int:
+    return self.pos
+
+  def readinto(self, b: Any) -> int:
+    n = min(len(b), self.size - self.pos)
+    if n <= 0:
+      return 0
+    self.fp.seek(self.offset + self.pos)
+    got = self.fp.readinto(memoryview(b)[:n])
+    self.pos += got
+    return got
+
+  def close(self) -> None:
+    self.fp.close()
+    super().close()
+
+
+def read_chunks(path: str) -> Iterator[bytes]:
+  with open(path, "rb") as f:
+    while chunk := f.read(CHUNK):
+      yield chunk
+
+
+def compress_file(
+    name: str, path: str, level: int,
+    date_time: Optional[tuple[int, ...]] = None
+) -> Member:
+  """
+  `date_time=None` keeps the file's mtime, pass `EPOCH`
+  (and normalized modes follow) for reproducible archives.
+  """
+  st = os.stat(path)
+  mode = 0o755 if st.st_mode & 0o111 else 0o644
+  if date_time is None:
+    date_time = time.localtime(st.st_mtime)[:6]
+  return compress(name, read_chunks(path), level, mode, date_time)
+
+
+def header_size(name: str, m: Member) -> int:
+  """
+  size of the local header written before `m`'s data, which makes
+  data offsets known before anything is written.
+  """
+  zip64 = m.size >= ZIP64_LIMIT or m.csize >= ZIP64_LIMIT
+  return 30 + len(name.encode()) + (20 if zip64 else 0)
+
+
+class Entry:
+  """a member of an existing zip, as its central directory has it."""
+
+  __slots__ = (
+    "name", "flags", "method", "crc", "csize", "size", "header_offset",
+    "mode", "date_time"
+  )
+
+  def __init__(
+      self, name: str, flags: int, method: int, crc: int, csize: int,
+      size: int, header_offset: int, mode: int, date_time: tuple[int, ...]
+  ):
+    self.name = name
+    self.flags = flags
+    self.method = method
+    self.crc = crc
+    self.csize = csize
+    self.size = size
+    self.header_offset = header_offset
+    self.mode = mode  # 0 if the zip didn't say
+    self.date_time = date_time
+
+
+def read_central(path: str) -> list[Entry]:
+  """
+  every entry of the zip at `path`, only reading its central directory.
+
+  a lot less work than `zipfile.ZipFile()` for zips with many entries,
+  raises `ValueError` for anything that isn't a zip.
+  """
+  with open(path, "rb") as f:
+    end = f.seek(0, os.SEEK_END)
+    f.seek(max(end - (0xffff + 22), 0))
+    tail = f.read()
+
+    pos = tail.rfind(b"PK\x05\x06")
+    if pos == -1 or len(tail) - pos < 22:
+      raise ValueError("not a zip file")
+    count, size, start = struct.unpack_from("<HII", tail, pos + 10)
+
+    # zip64 keeps the real values in its own record
+    if pos >= 20 and tail[pos - 20:pos - 16] == b"PK\x06\x07":
+      f.seek(struct.unpack_from("<Q", tail, pos - 12)[0])
+      end64 = f.read(56)
+      if end64[:4] == b"PK\x06\x06":
+        count, size, start = struct.unpack_from("<QQQ", end64, 32)
+
+    f.seek(start)
+    raw = f.read(size)
+
+  entries = []
+  pos = 0
+  for _ in range(count):
+    if raw[pos:pos + 4] != b"PK\x01\x02":
+      raise ValueError("bad central directory")
+    (
+      flags, method, tm, date, crc, csize, usize, nlen, elen, clen, attrs,
+      offset
+    ) = struct.unpack_from("<8xHHHHIIIHHH4xII", raw, pos)
+
+    pos += 46
+    name = raw[pos:pos + nlen].decode(
+      "utf-8" if flags & 0x800 else "cp437"
+    )
+    extra = raw[pos + nlen:pos + nlen + elen]
+    pos += nlen + elen + clen
+
+    if ZIP64_LIMIT in (csize, usize, offset):
+      # the fields that didn't fit, in this order
+      epos = 0
+      while epos + 4 <= len(extra):
+        tag, tlen = struct.unpack_from("<HH", extra, epos)
+        if tag == 1:
+          values = list(struct.unpack_from(
+            f"<{tlen // 8}Q", extra, epos + 4
+          ))
+          if usize == ZIP64_LIMIT:
+            usize = values.pop(0)
+          if csize == ZIP64_LIMIT:
+            csize = values.pop(0)
+          if offset == ZIP64_LIMIT:
+            offset = values.pop(0)
+          break
+        epos += 4 + tlen
+
+    entries.append(Entry(
+      name, flags, method, crc, csize, usize, offset, attrs >> 16, (
+        (date >> 9) + 1980, date >> 5 & 0xf, date & 0x1f,
+        tm >> 11, tm >> 5 & 0x3f, (tm & 0x1f) * 2
+      )
+    ))
+
+  return entries
+
+
+class Inflated(io.RawIOBase):
+  """
+  a deflated member, decompressed only as far as it's read.
+
+  seeking forward decompresses what's skipped, seeking back
+  starts over, so it's meant for reading headers.
+  """
+
+  def __init__(self, path: str, offset: int, csize: int, size: int):
+    self.fp = open(path, "rb")
+    self.offset = offset
+    self.csize = csize
+    self.size = size
+    self._restart()
+
+  def _restart(self) -> None:
+    self.fp.seek(self.offset)
+    self.left = self.csize
+    self.inflater = zlib.decompressobj(-15)
+    self.buf = b""
+    self.pos = 0
+
+  def readable(self) -> bool:
+    return True
+
+  def seekable(self) -> bool:
+    return True
+
+  def tell(self) -> int:
+    return self.pos
+
+  def seek(self, pos: int, whence: int = os.SEEK_SET) -> int:
+    base = {os.SEEK_SET: 0, os.SEEK_CUR: self.pos, os.SEEK_END: self.size}
+    target = min(max(base[whence] + pos, 0), self.size)
+    if target < self.pos:
+      self._restart()
+    while self.pos < target:
+      if len(self.read(min(target - self.pos, CHUNK))) == 0:
+        break
+    return self.pos
+
+  def readinto(self, b: Any) -> int:
+    while len(self.buf) < len(b) and (
+        self.left > 0 or self.inflater.unconsumed_tail
+    ):
+      data = self.inflater.unconsumed_tail
+      if not data:
+        data = self.fp.read(min(self.left, 64 << 10))
+        self.left -= len(data)
+        if not data:
+          break
+      self.buf += self.inflater.decompress(data, len(b) - len(self.buf))
+
+    n = min(len(b), len(self.buf))
+    b[:n] = self.buf[:n]
+    self.buf = self.buf[n:]
+    self.pos += n
+    return n
+
+  def close(self) -> None:
+    self.fp.close()
+    super().close()
+
+
+def data_offset(f: BinaryIO, header_offset: int) -> int:
+  """where a member's data starts, from its local header in `f`."""
+  f.seek(header_offset)
+  head = f.read(30)
+  if len(head) != 30 or head[:4] != b"PK\x03\x04":
+    raise ValueError("bad local header")
+  nlen, elen = struct.unpack_from("<HH", head, 26)
+  return header_offset + 30 + nlen + elen
+
+
+class ZipWriter:
+  """
+  writes prepared `Member`s to a zip, in the order they're given.
+
+  zip64 is used automatically where a size or offset needs it.
+  """
+
+  def __init__(self, path: str):
+    self.fp = open(path, "wb")
+    self.central: list[bytes] = []
+    self.names: set[str] = set()
+
+  def __enter__(self) -> "ZipWriter":
+    return self
+
+  def __exit__(self, *exc: object) -> None:
+    if exc[0] is None:
+      self.close()
+    else:
+      self.fp.close()
+
+  def write(self, m: Member, arcname: Optional[str] = None) -> int:
+    """
+    `arcname` writes the member under another name, so identical
+    files only have to be compressed once.
+
+    returns the offset of the member's data in the zip.
+    """
+    arcname = arcname or m.name
+    if arcname in self.names:
+      raise ValueError(f"duplicate zip entry: {arcname}")
+    self.names.add(arcname)
+
+    offset = self.fp.tell()
+    name = arcname.encode()
+    flags = 0 if arcname.isascii() else 0x800  # utf-8 names
+    date, tm = dos_time(m.date_time)
+
+    zip64 = m.size >= ZIP64_LIMIT or m.csize >= ZIP64_LIMIT
+    version = 45 if zip64 else 20
+    extra = b""
+    if zip64:
+      extra = struct.pack("<HHQQ", 1, 16, m.size, m.csize)
+
+    self.fp.write(struct.pack(
+      "<IHHHHHIIIHH", 0x04034b50, version, flags, m.method, tm, date,
+      m.crc, ZIP64_LIMIT if zip64 else m.csize,
+      ZIP64_LIMIT if zip64 else m.size, len(name), len(extra)
+    ) + name + extra)
+
+    start = self.fp.tell()
+    m.data.seek(0)
+    shutil.copyfileobj(m.data, self.fp, CHUNK)
+
+    # the central directory only gets the zip64 fields it needs
+    fields = []
+    if m.size >= ZIP64_LIMIT:
+      fields.append(m.size)
+    if m.csize >= ZIP64_LIMIT:
+      fields.append(m.csize)
+    if offset >= ZIP64_LIMIT:
+      fields.append(offset)
+    cextra = b""
+    if fields:
+      cextra = struct.pack(f"<HH{len(fields)}Q", 1, 8 * len(fields), *fields)
+      version = 45
+
+    mode = m.mode if stat.S_IFMT(m.mode) else stat.S_IFREG | m.mode
+    attrs = (mode & 0xffff) << 16
+    if arcname.endswith("/"):
+      attrs |= 0x10  # ms-dos directory flag
+
+    self.central.append(struct.pack(
+      "<IHHHHHHIIIHHHHHII", 0x02014b50, 3 << 8 | version, version, flags,
+      m.method, tm, date, m.crc, min(m.csize, ZIP64_LIMIT),
+      min(m.size, ZIP64_LIMIT), len(name), len(cextra), 0, 0, 0, attrs,
+      min(offset, ZIP64_LIMIT)
+    ) + name + cextra)
+
+    return start
+
+  def close(self) -> None:
+    start = self.fp.tell()
+    for entry in self.central:
+      self.fp.write(entry)
+    size = self.fp.tell() - start
+    count = len(self.central)
+
+    if count >= 0xffff or start >= ZIP64_LIMIT or size >= ZIP64_LIMIT:
+      end64 = self.fp.tell()
+      self.fp.write(struct.pack(
+        "<IQHHIIQQQQ", 0x06064b50, 44, 45, 45, 0, 0,
+        count, count, size, start
+      ))
+      self.fp.write(struct.pack("<IIQI", 0x07064b50, 0, end64, 1))
+
+    self.fp.write(struct.pack(
+      "<IHHHHIIH", 0x06054b50, 0, 0, min(count, 0xffff),
+      min(count, 0xffff), min(size, ZIP64_LIMIT),
+      min(start, ZIP64_LIMIT), 0
+    ))
+    self.fp.close()
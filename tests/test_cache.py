@@ -0,0 +1,221 @@
+import os
+import time
+import random
+import hashlib
+import multiprocessing
+
+import pytest
+
+from cyan import cache
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+  monkeypatch.setenv("CYAN_CACHE_DIR", str(tmp_path))
+  return tmp_path
+
+
+def content(key: str) -> bytes:
+  """what every process publishes for `key`, 100 bytes to ~40K."""
+  n = int(key[1:]) * 1000 + 100
+  return (hashlib.sha256(key.encode()).digest() * (n // 32 + 1))[:n]
+
+
+def age(c: cache.Cache, key: str, seconds: float) -> None:
+  """make `key` look like it was last used `seconds` ago."""
+  then = time.time() - seconds
+  os.utime(f"{c.path(key)}.json", (then, then))
+
+
+def test_publish_and_get():
+  c = cache.Cache("test", size=1 << 20)
+  entry = c.put_bytes("k1", b"hello")
+  assert c.get("k1") == entry
+  with open(entry, "rb") as f:
+    assert f.read() == b"hello"
+
+  meta = c.meta("k1")
+  assert meta["size"] == 5
+  assert meta["sha256"] == hashlib.sha256(b"hello").hexdigest()
+  assert c.get("missing") is None
+
+
+def test_publish_folder():
+  c = cache.Cache("test", size=1 << 20, check=True)
+
+  def fill(tmp):
+    os.mkdir(tmp)
+    with open(f"{tmp}/f", "wb") as f:
+      f.write(b"data")
+
+  entry = c.publish("k1", fill)
+  assert c.get("k1") == entry
+  assert os.listdir(entry) == ["f"]
+  assert c.verify() == []
+
+
+def test_publish_leaves_nothing_behind():
+  c = cache.Cache("test", size=1 << 20)
+  c.put_bytes("k1", b"x")
+  with pytest.raises(RuntimeError):
+    def fill(tmp):
+      with open(tmp, "wb") as f:
+        f.write(b"half")
+      raise RuntimeError("died")
+    c.publish("k2", fill)
+
+  assert sorted(os.listdir(c.root)) == [".lock", "k1", "k1.json"]
+
+
+def test_lost_race_keeps_the_winner():
+  c = cache.Cache("test", size=1 << 20)
+  entry = c.put_bytes("k1", b"first")
+  assert c.put_bytes("k1", b"second, and longer") == entry
+
+  with open(entry, "rb") as f:
+    assert f.read() == b"first"
+  assert c.meta("k1")["size"] == 5
+  assert c.verify() == []
+
+
+def test_get_drops_corrupted():
+  c = cache.Cache("test", size=1 << 20, check=True)
+  entry = c.put_bytes("k1", b"hello")
+  with open(entry, "wb") as f:
+    f.write(b"jello")
+
+  assert c.get("k1") is None
+  assert not os.path.exists(entry)
+  assert c.meta("k1") is None
+
+
+def test_verify_removes_corrupted():
+  c = cache.Cache("test", size=1 << 20)
+  c.put_bytes("k1", b"hello")
+  entry = c.put_bytes("k2", b"world")
+  with open(entry, "wb") as f:
+    f.write(b"wurld")
+
+  assert c.verify() == ["k2"]
+  assert [key for _, _, key in c.entries()] == ["k1"]
+
+
+def test_evict_least_recently_used(monkeypatch):
+  monkeypatch.setattr(cache, "GRACE", 0)
+  c = cache.Cache("test", size=1 << 20)
+  for ind, key in enumerate(("k1", "k2", "k3")):
+    c.put_bytes(key, b"x" * 100)
+    age(c, key, 300 - ind * 100)
+
+  c.get("k1")  # used again, so it's the most recent now
+  assert c.evict(200) == (1, 100)
+  assert sorted(key for _, _, key in c.entries()) == ["k1", "k3"]
+
+
+def test_evict_spares_recent_entries():
+  c = cache.Cache("test", size=1 << 20)
+  c.put_bytes("k1", b"x" * 100)
+  c.put_bytes("k2", b"x" * 100)
+  age(c, "k1", cache.GRACE + 10)
+
+  # k2 is in its grace period, even if that leaves the cache too big
+  assert c.evict(0) == (1, 100)
+  assert [key for _, _, key in c.entries()] == ["k2"]
+
+
+def test_evict_unused_for():
+  c = cache.Cache("test", size=1 << 20)
+  c.put_bytes("k1", b"x")
+  c.put_bytes("k2", b"x")
+  age(c, "k1", 3 * 86400)
+
+  assert c.evict(unused_for=86400) == (1, 1)
+  assert [key for _, _, key in c.entries()] == ["k2"]
+
+
+def test_junk():
+  c = cache.Cache("test", size=1 << 20)
+  c.put_bytes("k1", b"x")
+  c.put_bytes("k2", b"x")
+
+  # a publish that died long ago, one that's still going, and a
+  # sidecar whose entry was removed
+  stale = os.path.join(c.root, ".k3.dead")
+  fresh = os.path.join(c.root, ".k4.busy")
+  for path in (stale, fresh):
+    with open(path, "w") as f:
+      f.write("x")
+  then = time.time() - cache.STALE_AFTER - 10
+  os.utime(stale, (then, then))
+  os.remove(c.path("k2"))
+
+  found = set(c.junk())
+  assert found == {stale, f"{c.path('k2')}.json"}
+
+  c.evict()
+  assert sorted(os.listdir(c.root)) == [
+    ".k4.busy", ".lock", "k1", "k1.json"
+  ]
+
+
+def test_limit_from_env(monkeypatch):
+  monkeypatch.setenv("CYAN_OUTPUT_CACHE", "1M")
+  assert cache.limit("outputs") == 1 << 20
+  assert cache.Cache("icons").size == cache.LIMITS["icons"]
+
+
+def _worker(seed: int, root: str, ops: int) -> tuple[int, int]:
+  """random gets, publishes, evictions and rehashes, (hits, bad reads)."""
+  os.environ["CYAN_CACHE_DIR"] = root
+  cache.GRACE = 0  # evict as eagerly as possible
+  random.seed(seed)
+  c = cache.Cache("stress", size=200_000, check=seed % 2 == 0)
+
+  hits = bad = 0
+  for _ in range(ops):
+    key = f"k{random.randrange(40)}"
+    folder = int(key[1:]) % 2 == 0
+    roll = random.random()
+    if roll < 0.6:
+      entry = c.get(key)
+      if entry is None:
+        if folder:
+          def fill(tmp, key=key):
+            os.mkdir(tmp)
+            with open(f"{tmp}/f", "wb") as f:
+              f.write(content(key))
+          c.publish(key, fill)
+        else:
+          c.put_bytes(key, content(key))
+        continue
+
+      try:
+        with open(f"{entry}/f" if folder else entry, "rb") as f:
+          data = f.read()
+      except FileNotFoundError:
+        continue  # evicted under us, just a miss
+      hits += 1
+      bad += data != content(key)
+    elif roll < 0.9:
+      c.evict()
+    else:
+      c.verify()
+
+  return hits, bad
+
+
+def test_stress_concurrent_processes(cache_dir):
+  procs = 8
+  ctx = multiprocessing.get_context("spawn")
+  with ctx.Pool(procs) as pool:
+    results = pool.starmap(
+      _worker, [(seed, str(cache_dir), 150) for seed in range(procs)]
+    )
+
+  assert sum(hits for hits, _ in results) > 0
+  assert sum(bad for _, bad in results) == 0
+
+  # whatever's left matches its sidecar, and nothing was left behind
+  c = cache.Cache("stress", size=200_000)
+  assert c.verify() == []
+  assert c.junk() == []
@@ -0,0 +1,83 @@
+import plistlib
+
+import pytest
+
+from bench import fixtures
+from cyan.tbhtypes import codesign
+from cyan.tbhtypes.executable import Executable
+from cyan.tbhtypes.macho import MachO
+
+
+@pytest.fixture
+def requirements():
+  with open(Executable.requirements, "rb") as f:
+    return f.read()
+
+
+def write_binary(tmp_path, archs, **kwargs):  # type: ignore
+  path = tmp_path / "bin"
+  path.write_bytes(fixtures.macho(archs, **kwargs))
+  return str(path)
+
+
+def problems(path: str) -> list:
+  """what `codesign.check()` says about each slice, None if it's fine."""
+  with open(path, "rb") as f:
+    data = f.read()
+  return [codesign.check(data, sl) for sl in MachO.load(path).slices]
+
+
+def entitlements(path: str) -> dict:
+  raw = MachO.load(path).entitlements
+  return plistlib.loads(raw) if raw else {}
+
+
+@pytest.mark.parametrize("archs", [("arm64",), ("arm64", "arm64e")])
+def test_sign(tmp_path, requirements, archs):
+  path = write_binary(tmp_path, archs, code_size=fixtures.PAGE * 3)
+  assert problems(path) == ["not signed"] * len(archs)
+
+  assert codesign.sign(path, requirements)
+  assert problems(path) == [None] * len(archs)
+
+
+def test_sign_dylib(tmp_path, requirements):
+  path = write_binary(
+    tmp_path, ("arm64", "arm64e"), dylib_id="@rpath/T.dylib"
+  )
+  assert codesign.sign(path, requirements)
+  assert problems(path) == [None, None]
+
+
+def test_resign_keeps_entitlements(tmp_path, requirements):
+  path = write_binary(tmp_path, ("arm64", "arm64e"))
+  assert codesign.sign(
+    path, requirements, {"get-task-allow": True, "groups": ["a", "b"]}
+  )
+  assert entitlements(path) == {"get-task-allow": True, "groups": ["a", "b"]}
+  assert MachO.load(path).der_entitlements != b""
+
+  # nothing new: they're kept as they were
+  assert codesign.sign(path, requirements)
+  assert problems(path) == [None, None]
+  assert entitlements(path) == {"get-task-allow": True, "groups": ["a", "b"]}
+
+  # new ones are merged over them
+  assert codesign.sign(path, requirements, {"groups": ["c"], "n": 1})
+  assert problems(path) == [None, None]
+  assert entitlements(path) == {
+    "get-task-allow": True, "groups": ["c"], "n": 1
+  }
+
+
+def test_changed_page_is_caught(tmp_path, requirements):
+  path = write_binary(tmp_path, ("arm64",), code_size=fixtures.PAGE * 2)
+  assert codesign.sign(path, requirements)
+
+  with open(path, "r+b") as f:
+    f.seek(fixtures.PAGE + 100)  # in the code, not the headers
+    byte = f.read(1)
+    f.seek(-1, 1)
+    f.write(bytes([byte[0] ^ 0xff]))
+
+  assert problems(path)[0].endswith("doesn't match its hash")
@@ -0,0 +1,204 @@
+import io
+import struct
+from typing import Optional, Sequence
+
+from bench import fixtures
+from cyan.tbhtypes import strip
+from cyan.tbhtypes.macho import LC_SYMTAB, LC_DYSYMTAB, MachO, read_slice
+
+LOCALS = 16  # `macho_slice()`'s default, then _exported and _dep
+N_FUN = 0x24  # a stab
+INDIRECT_SYMBOL_LOCAL = 0x80000000
+LC_FUNCTION_STARTS = 0x26
+
+
+def find(raw: bytes, cmd: int) -> int:
+  """position of the first `cmd` load command."""
+  sl = read_slice(io.BytesIO(raw), 0, len(raw))
+  return sl.find(cmd)[0][1]
+
+
+def symbols(raw: bytes) -> list[tuple[str, int]]:
+  """(name, n_type) of every symbol."""
+  symoff, nsyms, stroff, _ = struct.unpack_from(
+    "<4I", raw, find(raw, LC_SYMTAB) + 8
+  )
+  found = []
+  for ind in range(nsyms):
+    strx, ntype = struct.unpack_from("<IB", raw, symoff + ind * 16)
+    name = raw[stroff + strx:].split(b"\0", 1)[0]
+    found.append((name.decode(), ntype))
+  return found
+
+
+def dysymtab(raw: bytes) -> tuple[int, ...]:
+  return struct.unpack_from("<18I", raw, find(raw, LC_DYSYMTAB) + 8)
+
+
+def table(raw: bytes, off: int, count: int, size: int) -> list[int]:
+  """indirect symbols, or the r_symbolnum of external relocations."""
+  return [
+    struct.unpack_from("<I", raw, off + ind * size + size - 4)[0]
+    for ind in range(count)
+  ]
+
+
+def relayout(
+    raw: bytes, indirect: Sequence[int] = (), extrel: Sequence[int] = (),
+    types: Optional[dict[int, int]] = None
+) -> bytes:
+  """
+  a fixture slice with an indirect symbol table and external
+  relocations added (naming symbols by index), laid out like ld64
+  does: relocations, symbols, indirect symbols, strings.
+  `types` changes some symbols' n_type.
+  """
+  symtab_pos = find(raw, LC_SYMTAB)
+  symoff, nsyms, stroff, strsize = struct.unpack_from(
+    "<4I", raw, symtab_pos + 8
+  )
+  syms = bytearray(raw[symoff:symoff + nsyms * 16])
+  for ind, ntype in (types or {}).items():
+    syms[ind * 16 + 4] = ntype
+
+  rel = b"".join(
+    struct.pack("<iI", 0, 1 << 27 | (3 << 25) | ind) for ind in extrel
+  )
+  ind_raw = struct.pack(f"<{len(indirect)}I", *indirect)
+  ind_raw += bytes(-len(ind_raw) % 8)
+
+  new_symoff = symoff + len(rel)
+  new_indoff = new_symoff + len(syms)
+  new_stroff = new_indoff + len(ind_raw)
+  out = bytearray(
+    raw[:symoff] + rel + syms + ind_raw + raw[stroff:stroff + strsize]
+  )
+
+  struct.pack_into(
+    "<4I", out, symtab_pos + 8, new_symoff, nsyms, new_stroff, strsize
+  )
+  dysymtab_pos = find(raw, LC_DYSYMTAB)
+  struct.pack_into(
+    "<4I", out, dysymtab_pos + 8 + 12 * 4,
+    new_indoff, len(indirect), symoff, len(extrel)
+  )
+
+  # __LINKEDIT is the last segment, and starts at the symbols
+  sl = read_slice(io.BytesIO(raw), 0, len(raw))
+  for _, pos, cmd_raw in sl.commands:
+    if cmd_raw[8:18] == b"__LINKEDIT":
+      filesize = len(out) - symoff
+      vmsize = (filesize + fixtures.PAGE - 1) // fixtures.PAGE * fixtures.PAGE
+      struct.pack_into("<Q", out, pos + 32, vmsize)
+      struct.pack_into("<Q", out, pos + 48, filesize)
+  return bytes(out)
+
+
+def add_command(raw: bytes, cmd: bytes) -> bytes:
+  """append a load command, into the room after the others."""
+  out = bytearray(raw)
+  ncmds, sizeofcmds = struct.unpack_from("<II", out, 16)
+  out[32 + sizeofcmds:32 + sizeofcmds + len(cmd)] = cmd
+  struct.pack_into("<II", out, 16, ncmds + 1, sizeofcmds + len(cmd))
+  return bytes(out)
+
+
+def test_strip_slice():
+  raw = fixtures.macho_slice()
+  stripped = strip.strip_slice(raw)
+  assert stripped is not None and len(stripped) < len(raw)
+
+  assert [name for name, _ in symbols(stripped)] == ["_exported", "_dep"]
+  (
+    ilocal, nlocal, iextdef, nextdef, iundef, nundef, *_
+  ) = dysymtab(stripped)
+  assert (ilocal, nlocal, iextdef, nextdef, iundef, nundef) == (
+    0, 0, 0, 1, 1, 1
+  )
+  assert read_slice(io.BytesIO(stripped), 0, len(stripped)) is not None
+
+  # nothing left to strip
+  assert strip.strip_slice(stripped) is None
+
+
+def test_keep_locals():
+  raw = relayout(fixtures.macho_slice(), types={0: N_FUN, 3: N_FUN})
+  stripped = strip.strip_slice(raw, keep_locals=True)
+  assert stripped is not None
+
+  names = [name for name, _ in symbols(stripped)]
+  assert names == [
+    f"_local_{i}" for i in range(LOCALS) if i not in (0, 3)
+  ] + ["_exported", "_dep"]
+  assert dysymtab(stripped)[:2] == (0, LOCALS - 2)
+
+  # without stabs and keeping locals, there's nothing to do
+  assert strip.strip_slice(fixtures.macho_slice(), keep_locals=True) is None
+
+
+def test_renumbers_indirect_and_extrel():
+  dep = LOCALS + 1
+  raw = relayout(
+    fixtures.macho_slice(),
+    indirect=[dep, INDIRECT_SYMBOL_LOCAL, LOCALS, dep],
+    extrel=[dep, LOCALS]
+  )
+  stripped = strip.strip_slice(raw)
+  assert stripped is not None
+
+  d = dysymtab(stripped)
+  indoff, nind, extreloff, nextrel = d[12], d[13], d[14], d[15]
+  assert table(stripped, indoff, nind, 4) == [
+    1, INDIRECT_SYMBOL_LOCAL, 0, 1
+  ]
+  assert [
+    info & 0xffffff for info in table(stripped, extreloff, nextrel, 8)
+  ] == [1, 0]
+  assert symbols(stripped)[1][0] == "_dep"
+
+
+def test_stub_bound_to_a_local():
+  raw = relayout(fixtures.macho_slice(), indirect=[2])
+  assert strip.strip_slice(raw) is None
+  # unless locals are kept, then it's renumbered like the rest
+  raw = relayout(fixtures.macho_slice(), indirect=[2], types={0: N_FUN})
+  stripped = strip.strip_slice(raw, keep_locals=True)
+  assert table(stripped, dysymtab(stripped)[12], 1, 4) == [1]
+
+
+def test_unhandled_layouts():
+  raw = fixtures.macho_slice()
+
+  # a stab that isn't with the locals
+  assert strip.strip_slice(relayout(raw, types={LOCALS: N_FUN})) is None
+
+  # old-style dylib tables
+  for field in (7, 9, 11):  # ntoc, nmodtab, nextrefsyms
+    changed = bytearray(raw)
+    struct.pack_into("<I", changed, find(raw, LC_DYSYMTAB) + 8 + field * 4, 1)
+    assert strip.strip_slice(bytes(changed)) is None
+
+  # something else in __LINKEDIT after the tables
+  end = len(raw)
+  assert strip.strip_slice(
+    add_command(raw, struct.pack("<IIII", LC_FUNCTION_STARTS, 16, end - 8, 8))
+  ) is None
+
+
+def test_strip_file(tmp_path):
+  for archs in (("arm64",), ("arm64", "arm64e")):
+    path = tmp_path / "bin"
+    path.write_bytes(fixtures.macho(archs))
+    before = path.stat().st_size
+
+    saved = strip.strip(str(path))
+    assert saved == before - path.stat().st_size > 0
+
+    info = MachO.load(str(path))
+    assert info.archs == list(archs)
+    raw = path.read_bytes()
+    for sl in info.slices:
+      part = raw[sl.offset:sl.offset + sl.size]
+      assert [n for n, _ in symbols(part)] == ["_exported", "_dep"]
+
+    assert strip.strip(str(path)) == 0